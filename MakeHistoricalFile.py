@@ -2,8 +2,9 @@ import os, sys, arcpy
 import pandas as pd
 from arcgis.gis import GIS
 from arcgis.features import GeoAccessor
-from arcgis.features import FeatureLayer
+from arcgis.features import FeatureLayer, FeatureSet
 from dotenv import load_dotenv
+from paged_download import clear_staging, download_pages, read_staged_features
 
 arcpy.env.overwriteOutput = True
 '''
@@ -27,9 +28,22 @@ def auto_download_data(data_url, outGDB, outname, from_date, to_date):
         data_url = os.path.join(data_url, '0')
     
     query = "EditDate BETWEEN TIMESTAMP '{}' AND TIMESTAMP '{}'".format(from_date, to_date)
+    # Pages are staged beside the GDB so an interrupted download picks up where it left off
+    # and are requested through the session of the Pro login, which signs every request
+    staging_dir = os.path.join(os.path.dirname(outGDB), outname + '_pages')
+    manifest = download_pages(data_url, query, staging_dir, 
+                              page_size= int(os.getenv('NGD_DOWNLOAD_PAGE_SIZE', 1000)), 
+                              workers= int(os.getenv('NGD_DOWNLOAD_WORKERS', 4)), 
+                              session= gis.session)
     if arcpy.Exists(os.path.join(outGDB, outname)):
         arcpy.Delete_management(os.path.join(outGDB, outname))
-    arcpy.FeatureClassToFeatureClass_conversion(data_url, outGDB, outname, where_clause= query)
+    if len(manifest['pages']) == 0:
+        # Nothing matched, let arcpy create the empty feature class with the layer schema
+        arcpy.FeatureClassToFeatureClass_conversion(data_url, outGDB, outname, where_clause= query)
+    else:
+        features = FeatureSet.from_dict(read_staged_features(staging_dir)).sdf
+        features.spatial.to_featureclass(os.path.join(outGDB, outname), sanitize_columns= False)
+    clear_staging(staging_dir)
     return os.path.join(outGDB, outname)
 
 #--------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,202 @@
+# Address range overlap detection between redline arcs and the NGD_AL
+#
+# Each side of an arc is turned into an interval (the min and max of its AF and AT values) keyed on the street UID of
+# that side. All intervals of the NGD_AL are sorted by street and start once, so finding every overlap for a batch of
+# redline intervals is a pair of binary searches plus one vectorized filter rather than a query per redline row.
+#
+# Two ranges only conflict when they can hold the same address: an even-only and an odd-only range on the same street
+# never do, and neither do ranges with different address types.
+
+import importlib.util
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from address_parity import range_parity
+
+SIDES = ['L', 'R']
+
+# columns of the NGD_AL needed to build address intervals
+INTERVAL_FIELDS = ['NGD_UID', 'NGD_STR_UID_L', 'NGD_STR_UID_R', 'AFL_VAL', 'ATL_VAL', 'AFR_VAL', 'ATR_VAL',
+                   'ADDR_PRTY_L', 'ADDR_PRTY_R', 'ADDR_TYP_L', 'ADDR_TYP_R', 'CSD_UID_L', 'CSD_UID_R']
+
+
+def side_intervals(df, side):
+    """Address intervals for one side of every arc that has a street UID and both ends of its range.
+
+    Returns a frame with the row position in df, NGD_UID, street UID, the original AF/AT values, the interval
+    bounds lo/hi, the parity (ADDR_PRTY, or derived from the range when it is null), the address type and the CSD."""
+
+    af = pd.to_numeric(df[f'AF{side}_VAL'], errors='coerce').to_numpy(dtype='float64')
+    at = pd.to_numeric(df[f'AT{side}_VAL'], errors='coerce').to_numpy(dtype='float64')
+    street = pd.to_numeric(df[f'NGD_STR_UID_{side}'], errors='coerce').to_numpy(dtype='float64')
+    keep = ~np.isnan(af) & ~np.isnan(at) & ~np.isnan(street)
+
+    # AF and AT can run in either direction, so the interval is always min to max (compared as whole numbers)
+    af = np.trunc(af[keep])
+    at = np.trunc(at[keep])
+    parity = column_values(df, f'ADDR_PRTY_{side}', keep)
+    parity = np.where(pd.isna(parity), range_parity(af, at), parity)
+    return pd.DataFrame({'row': np.flatnonzero(keep),
+                         'NGD_UID': df['NGD_UID'].to_numpy()[keep],
+                         'street': street[keep].astype('int64'),
+                         'af': af,
+                         'at': at,
+                         'lo': np.minimum(af, at),
+                         'hi': np.maximum(af, at),
+                         'parity': parity,
+                         'typ': column_values(df, f'ADDR_TYP_{side}', keep),
+                         'csd': column_values(df, f'CSD_UID_{side}', keep)})
+
+
+def column_values(df, field, keep):
+    """Values of field for the kept rows, all null when the frame doesn't have the field."""
+
+    if field not in df.columns:
+        return np.full(keep.sum(), None, dtype=object)
+    return df[field].to_numpy(dtype=object)[keep]
+
+
+def shares_address(left, right):
+    """Whether each pair of overlapping intervals can hold the same address number.
+
+    An E range only holds even numbers and an O range only odd ones, M or unknown parity holds both. The pair shares
+    an address when the intersection of the ranges contains a number every side allows, and the address types don't
+    differ."""
+
+    start = np.maximum(left['lo'].to_numpy(), right['lo'].to_numpy())
+    end = np.minimum(left['hi'].to_numpy(), right['hi'].to_numpy())
+    left_parity = left['parity'].to_numpy(dtype=object)
+    right_parity = right['parity'].to_numpy(dtype=object)
+    even = (left_parity == 'E') | (right_parity == 'E')
+    odd = (left_parity == 'O') | (right_parity == 'O')
+
+    # first number of the required parity inside the intersection
+    start_odd = np.fmod(start, 2) != 0
+    first = start + (even & start_odd) + (odd & ~start_odd)
+    shared = ~(even & odd) & (first <= end)
+
+    left_typ = left['typ'].to_numpy(dtype=object)
+    right_typ = right['typ'].to_numpy(dtype=object)
+    both_typ = ~pd.isna(left_typ) & ~pd.isna(right_typ)
+    shared[both_typ] &= left_typ[both_typ] == right_typ[both_typ]
+    return shared
+
+
+def overlapping_pairs(left, right):
+    """Every pair of intervals from left and right on the same street whose ranges intersect.
+
+    Returns two position arrays (into left and into right) of equal length, ordered by left position."""
+
+    if len(left) == 0 or len(right) == 0:
+        return np.empty(0, dtype='int64'), np.empty(0, dtype='int64')
+
+    # rank streets so a (street, lo) pair sorts as a single integer key
+    streets, codes = np.unique(np.concatenate([right['street'].to_numpy(), left['street'].to_numpy()]),
+                               return_inverse=True)
+    right_code = codes[:len(right)]
+    left_code = codes[len(right):]
+    lo_min = min(right['lo'].min(), left['lo'].min())
+    span = max(right['hi'].max(), left['hi'].max()) - lo_min + 2
+
+    right_key = right_code * span + (right['lo'].to_numpy() - lo_min)
+    order = np.argsort(right_key, kind='stable')
+    sorted_key = right_key[order]
+
+    # candidates start with the first interval on the street and stop after the last one starting at or before hi
+    first = np.searchsorted(sorted_key, left_code * span, side='left')
+    last = np.searchsorted(sorted_key, left_code * span + (left['hi'].to_numpy() - lo_min), side='right')
+    counts = np.maximum(last - first, 0)
+
+    left_pos = np.repeat(np.arange(len(left)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_pos = order[np.repeat(first, counts) + step]
+
+    # a candidate only overlaps when it also ends at or after the start of the left interval
+    hit = right['hi'].to_numpy()[right_pos] >= left['lo'].to_numpy()[left_pos]
+    return left_pos[hit], right_pos[hit]
+
+
+def find_overlaps(redline, ngdal, parity_aware=True, check_redline=True):
+    """Find every redline address range that overlaps another range on the same street and side.
+
+    Redline ranges are compared against the NGD_AL and, when check_redline is set, against each other. An NGD_AL arc
+    that also appears in the redline is then replaced by its redline version instead of being compared as it was.
+    With parity_aware set, ranges that can't hold the same address (see shares_address) aren't reported. Pairs of the
+    same NGD_UID are always ignored.
+
+    Returns one row per overlap with the columns of the overlap_test output plus Compared_to (NGD_AL or Redline) and
+    the redline CSD_UID, taking SHAPE from the redline."""
+
+    if check_redline:
+        ngdal = ngdal[~ngdal['NGD_UID'].isin(redline['NGD_UID'])]
+
+    results = []
+    for side in SIDES:
+        red = side_intervals(redline, side)
+        al = side_intervals(ngdal, side)
+        comparisons = [('NGD_AL', al, overlapping_pairs(red, al))]
+        if check_redline:
+            red_pos, other_pos = overlapping_pairs(red, red)
+            # each redline pair is reported once
+            first = red_pos < other_pos
+            comparisons.append(('Redline', red, (red_pos[first], other_pos[first])))
+
+        for compared_to, other, (red_pos, other_pos) in comparisons:
+            left = red.iloc[red_pos].reset_index(drop=True)
+            right = other.iloc[other_pos].reset_index(drop=True)
+            keep = (left['NGD_UID'] != right['NGD_UID']).to_numpy()
+            if parity_aware:
+                keep = keep & shares_address(left, right)
+            left = left[keep]
+            right = right[keep]
+            results.append(pd.DataFrame({'row': left['row'].to_numpy(),
+                                         'side': side,
+                                         'Redline_NGD_UID': left['NGD_UID'].to_numpy(),
+                                         'Redline_AF_VAL': left['af'].to_numpy(),
+                                         'Redline_AT_VAL': left['at'].to_numpy(),
+                                         'AL_NGD_UID': right['NGD_UID'].to_numpy(),
+                                         'AL_AF_VAL': right['af'].to_numpy(),
+                                         'AL_AT_VAL': right['at'].to_numpy(),
+                                         'overlap_flag': f'overlap on {side}',
+                                         'Compared_to': compared_to,
+                                         'CSD_UID': left['csd'].to_numpy()}))
+
+    out = (pd.concat(results, ignore_index=True)
+          .sort_values(['row', 'side'], kind='stable')
+          .reset_index(drop=True))
+    out['SHAPE'] = redline['SHAPE'].to_numpy()[out['row'].to_numpy()]
+    return out.drop(columns=['row', 'side'])
+
+
+def overlap_counts(overlaps):
+    """Number of overlaps per CSD, side and comparison."""
+
+    return (overlaps.groupby(['CSD_UID', 'overlap_flag', 'Compared_to'], dropna=False)
+           .size()
+           .rename('COUNT')
+           .reset_index())
+
+
+def write_overlap_report(overlaps, path):
+    """Write the overlaps to a columnar report next to a CSV of counts per CSD.
+
+    The report is Parquet when pyarrow is installed and CSV otherwise, with the geometry stored as Esri JSON text.
+    Returns the paths of the report and the counts."""
+
+    report = overlaps.copy()
+    # shapes missing after a merge are NaN rather than None
+    report['SHAPE'] = [json.dumps(dict(shape)) if pd.notna(shape) else None for shape in report['SHAPE']]
+    base = os.path.splitext(path)[0]
+    if importlib.util.find_spec('pyarrow') is not None:
+        report_path = base + '.parquet'
+        report.to_parquet(report_path, index=False)
+    else:
+        report_path = base + '.csv'
+        report.to_csv(report_path, index=False)
+
+    counts_path = base + '_counts.csv'
+    overlap_counts(overlaps).to_csv(counts_path, index=False)
+    return report_path, counts_path
@@ -0,0 +1,64 @@
+# Address parity (ADDR_PRTY) derivation for whole columns of address ranges
+#
+# The parity of a side of an arc is E when both ends of its address range are even, O when both are odd and M when
+# they are mixed. Address values can come through as numbers, numeric strings or strings with a suffix ('12A'); only
+# the leading house number counts. A side without a usable number at both ends has no parity.
+
+import numpy as np
+import pandas as pd
+
+SIDES = ['L', 'R']
+
+
+def address_numbers(values):
+    """Leading house number of every value in a column as floats, with NaN for nulls and unparseable values."""
+
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype('float64')
+    numbers = pd.to_numeric(values, errors='coerce')
+    # strings with a suffix keep only their leading digits
+    text = values.where(numbers.isna() & values.notna()).astype(str)
+    suffixed = pd.to_numeric(text.str.extract(r'^\s*(\d+)', expand=False), errors='coerce')
+    return numbers.fillna(suffixed).astype('float64')
+
+
+def range_parity(af_values, at_values):
+    """Parity of every address range given by the from and to columns: 'E', 'O', 'M', or None when either end is
+    missing."""
+
+    af = address_numbers(af_values).to_numpy()
+    at = address_numbers(at_values).to_numpy()
+    known = ~np.isnan(af) & ~np.isnan(at)
+    af_odd = np.fmod(af, 2) != 0
+    at_odd = np.fmod(at, 2) != 0
+
+    parity = np.where(af_odd == at_odd, np.where(af_odd, 'O', 'E'), 'M').astype(object)
+    parity[~known] = None
+    return parity
+
+
+def side_parity(df, side):
+    """Parity derived from the AF and AT values of one side ('L' or 'R') of every row, aligned on the frame's index."""
+
+    return pd.Series(range_parity(df[f'AF{side}_VAL'], df[f'AT{side}_VAL']), index=df.index, dtype=object)
+
+
+def fill_parity(df):
+    """Copy of df with null ADDR_PRTY_L/R values filled from their address ranges. Existing values are kept."""
+
+    df = df.copy()
+    for side in SIDES:
+        field = f'ADDR_PRTY_{side}'
+        df[field] = df[field].astype(object).where(df[field].notna(), side_parity(df, side))
+    return df
+
+
+def parity_conflicts(df, side):
+    """Mask of rows whose ADDR_PRTY value on side disagrees with the parity of the address range on that side.
+
+    Rows without a parity value or without a full address range are never flagged."""
+
+    declared = df[f'ADDR_PRTY_{side}']
+    derived = side_parity(df, side)
+    return declared.notna() & derived.notna() & (declared != derived)
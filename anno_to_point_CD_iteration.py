@@ -1,6 +1,12 @@
 
 import arcpy
-from datetime import datetime
+import hashlib
+import json
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from instrumentation import stage, start_run
+from ngd_staging import source_mtime
 arcpy.env.overwriteOutput = True
 project = r"D:\GIS\Work\ngd_redline\ngd_redline_canada\ngd_redline_canada_3.aprx"
 map_name = "Address Labels All Scales"
@@ -8,13 +14,17 @@ feature_field = "CSD_UID_L"
 feature_extent_buffer = 10
 search_query = "PR_L IS NOT NULL"
 output_gdb = r"D:\GIS\Work\ngd_redline\ngd_redline_canada\can_anno_pts.gdb" 
+#each worker process keeps its copy of the project and its annotation gdb in this folder
+work_folder = r"D:\GIS\Work\ngd_redline\ngd_redline_canada\anno_workers"
+workers = max(1, os.cpu_count() - 1)
 
 #parameters to create CD_UID dictionary
 params_uid_dict = {"project": project,
                    "map_name": map_name,
                    "feature_lyr": "ngd_al_2_aux_4K",    #any of the layers will be fine
                    "feature_field": feature_field,
-                   "search_query": search_query
+                   "search_query": search_query,
+                   "cache_folder": work_folder
                    }
 
 #parameters for creating annotations and points for each scale
@@ -67,190 +77,229 @@ def createGdb(output_gdb):
     else:
         print("{} exists.".format(output_gdb))
 
-def createCduidDict(project, map_name, feature_lyr, feature_field, search_query):
+#address fields counted per CD and the value they are read as when null
+ADDR_FIELDS = ["AFL_VAL", "ATL_VAL", "AFR_VAL", "ATR_VAL"]
+NULL_NUMBER = -9999999
 
-    aprx = arcpy.mp.ArcGISProject(project)
-
-    m = aprx.listMaps(map_name)[0]
+def sourceModified(path):
+    #latest change to the data of a feature class, for a gdb that is the newest of its tables, so the lock files
+    #opening it creates don't count as a change
+    folder = path
+    while folder and not os.path.exists(folder):
+        folder = os.path.dirname(folder)
+    return source_mtime(folder)
 
-    lyr = m.listLayers(feature_lyr)[0]
-    uid_dict = {}
-    print("Building CD feature dictionary...")
-    rows = arcpy.da.SearchCursor(lyr, [feature_field, "AFL_VAL", \
-                                              "ATL_VAL", \
-                                              "AFR_VAL", \
-                                              "ATR_VAL", "SHAPE@"], search_query)
-                                            
-    for row in rows:
-           
-        feature, afl, atl, afr, atr, geom = row
-
-        #in case any null values that can't be parsed happened to have address values... 
-        if feature is None:
-            feature = 0000
-        else:
-            feature = feature[:4]
-
-        xmin = geom.extent.XMin
-        xmax = geom.extent.XMax
-        ymin = geom.extent.YMin
-        ymax = geom.extent.YMax
-
-        if feature not in uid_dict:
-            uid_dict[feature] = {"XMIN": xmin, "YMIN": ymin, "XMAX": xmax, "YMAX": ymax, \
-                                "F_COUNT": 1, "AFL_COUNT": 0, "ATL_COUNT": 0, "AFR_COUNT": 0, "ATR_COUNT": 0}
-            
-        else:
-            uid_dict[feature]["F_COUNT"] += 1
-            if xmin < uid_dict[feature]["XMIN"]:
-                uid_dict[feature]["XMIN"] = xmin
-
-            if ymin < uid_dict[feature]["YMIN"]:
-                uid_dict[feature]["YMIN"] = ymin
-
-            if xmax > uid_dict[feature]["XMAX"]:
-                uid_dict[feature]["XMAX"] = xmax
-
-            if ymax > uid_dict[feature]["YMAX"]:
-                uid_dict[feature]["YMAX"] = ymax
-           
-        if afl is not None:
-            uid_dict[feature]["AFL_COUNT"] += 1
+def aggregateCds(features, vertices, feature_field):
+    """Reduce the feature table (OID@, feature_field, ADDR_FIELDS as 'has a value' flags) and the exploded vertex
+    table (OID@, SHAPE@X, SHAPE@Y) to the CD dictionary: extents from the vertices, feature and address counts from
+    the features, grouped on the first 4 characters of feature_field (0 when it is null)."""
 
-        if atl is not None:
-            uid_dict[feature]["ATL_COUNT"] += 1
+    cd = features[feature_field].str[:4].astype(object)
+    cd[features[feature_field].isna()] = 0
+    counts = features[ADDR_FIELDS].groupby(cd.values, sort=False).sum()
+    counts["F_COUNT"] = features.groupby(cd.values, sort=False).size()
 
-        if afr is not None:
-            uid_dict[feature]["AFR_COUNT"] += 1
-            
-        if atr is not None:
-            uid_dict[feature]["ATR_COUNT"] += 1
+    vertex_cd = vertices["OID@"].map(pd.Series(cd.values, index=features["OID@"].values))
+    extents = vertices.groupby(vertex_cd.values, sort=False).agg(XMIN=("SHAPE@X", "min"), YMIN=("SHAPE@Y", "min"), \
+                                                                 XMAX=("SHAPE@X", "max"), YMAX=("SHAPE@Y", "max"))
 
+    uid_dict = {}
+    for feature, row in counts.iterrows():
+        extent = extents.loc[feature]
+        uid_dict[feature] = {"XMIN": float(extent["XMIN"]), "YMIN": float(extent["YMIN"]), \
+                             "XMAX": float(extent["XMAX"]), "YMAX": float(extent["YMAX"]), \
+                             "F_COUNT": int(row["F_COUNT"]), \
+                             "AFL_COUNT": int(row["AFL_VAL"]), "ATL_COUNT": int(row["ATL_VAL"]), \
+                             "AFR_COUNT": int(row["AFR_VAL"]), "ATR_COUNT": int(row["ATR_VAL"])}
     return uid_dict
-    #del lyr
-    #del m            
-    #del aprx
-                                    
-def iterateAnnoByCD(project, map_name, feature_lyr, feature_field, conversion_scale, \
-                    feature_extent_buffer, output_gdb, anno_out_suffix, \
-                    final_pt_fc_name, uid_dict):
-    
-    arcpy.env.workspace = output_gdb
-    arcpy.env.overwriteOutput = True
-    anno_pt_list = []
+
+def createCduidDict(project, map_name, feature_lyr, feature_field, search_query, cache_folder=None):
+
     aprx = arcpy.mp.ArcGISProject(project)
 
     m = aprx.listMaps(map_name)[0]
 
     lyr = m.listLayers(feature_lyr)[0]
-        
 
-    print("Accessing feature dictionary to create annotations and points...")
+    #the dictionary only changes with the data, so reruns and the other scales read it back from disk
+    source = lyr.dataSource
+    cache_path = None
+    if cache_folder is not None:
+        cache_key = "{}|{}|{}|{}".format(source, search_query, feature_field, sourceModified(source))
+        cache_path = os.path.join(cache_folder, "cd_dict_{}.json".format(hashlib.sha1(cache_key.encode()).hexdigest()))
+        if os.path.exists(cache_path):
+            print("Reading CD feature dictionary from {}".format(cache_path))
+            with open(cache_path) as f:
+                return {feature: feature_dict for feature, feature_dict in json.load(f)}
 
-    for feature, feature_dict in uid_dict.items():
-
-        f_count = feature_dict["F_COUNT"]
-        addr_sum = feature_dict["AFL_COUNT"] + feature_dict["ATL_COUNT"] + feature_dict["AFR_COUNT"]+ feature_dict["ATR_COUNT"]
+    print("Building CD feature dictionary...")
+    #address values are only counted, so nulls are read as a value no address can have
+    null_values = {field.name: ("" if field.type == "String" else NULL_NUMBER) \
+                   for field in arcpy.ListFields(lyr) if field.name in ADDR_FIELDS}
+    features = pd.DataFrame(arcpy.da.FeatureClassToNumPyArray(lyr, ["OID@", feature_field] + ADDR_FIELDS, \
+                                                              search_query, null_value=dict(null_values, \
+                                                              **{feature_field: ""})))
+    for field in ADDR_FIELDS:
+        features[field] = features[field] != null_values.get(field, NULL_NUMBER)
+    features[feature_field] = features[feature_field].where(features[feature_field] != "")
+    vertices = pd.DataFrame(arcpy.da.FeatureClassToNumPyArray(lyr, ["OID@", "SHAPE@X", "SHAPE@Y"], search_query, \
+                                                              explode_to_points=True))
+    uid_dict = aggregateCds(features, vertices, feature_field)
+
+    if cache_path is not None:
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        with open(cache_path, "w") as f:
+            json.dump(list(uid_dict.items()), f)
+    return uid_dict
+                                    
+def addrSum(feature_dict):
+    return feature_dict["AFL_COUNT"] + feature_dict["ATL_COUNT"] + feature_dict["AFR_COUNT"]+ feature_dict["ATR_COUNT"]
 
-        xmin = feature_dict["XMIN"]
-        ymin = feature_dict["YMIN"]
-        xmax = feature_dict["XMAX"]
-        ymax = feature_dict["YMAX"]
-        
-        print("Creating annotations from {}.".format(feature))
-        
-        xmin = feature_dict["XMIN"]
-        ymin = feature_dict["YMIN"]
-        xmax = feature_dict["XMAX"]
-        ymax = feature_dict["YMAX"]
+def initAnnoWorker(project, work_folder):
+    #every worker gets its own copy of the project and its own output gdb so no two processes
+    #change the same layer definition query or write to the same gdb
+    global worker_aprx, worker_gdb
+    arcpy.env.overwriteOutput = True
+    worker_name = "anno_worker_{}".format(os.getpid())
+    worker_project = os.path.join(work_folder, "{}.aprx".format(worker_name))
+    arcpy.mp.ArcGISProject(project).saveACopy(worker_project)
+    worker_aprx = arcpy.mp.ArcGISProject(worker_project)
+    worker_gdb = os.path.join(work_folder, "{}.gdb".format(worker_name))
+    if arcpy.Exists(worker_gdb) == False:
+        arcpy.CreateFileGDB_management(work_folder, "{}.gdb".format(worker_name))
+
+def annotateCD(map_name, feature_lyr, feature_field, conversion_scale, feature_extent_buffer, \
+               anno_out_suffix, final_pt_fc_name, feature, feature_dict):
+    """Create the annotations of one CD at one scale in the worker's project and gdb, and the points made from them.
+    Returns the path of the points, or None when no points are wanted."""
+
+    arcpy.env.workspace = worker_gdb
+    m = worker_aprx.listMaps(map_name)[0]
+    lyr = m.listLayers(feature_lyr)[0]
 
-        feature_extents = "{} {} {} {}".format(xmin - feature_extent_buffer, ymin - feature_extent_buffer,\
-                                            xmax + feature_extent_buffer, ymax + feature_extent_buffer)
+    addr_sum = addrSum(feature_dict)
 
+    print("Creating annotations from {}.".format(feature))
+    
+    xmin = feature_dict["XMIN"]
+    ymin = feature_dict["YMIN"]
+    xmax = feature_dict["XMAX"]
+    ymax = feature_dict["YMAX"]
 
-        print("CD {} address count: {}".format(feature, addr_sum))
+    feature_extents = "{} {} {} {}".format(xmin - feature_extent_buffer, ymin - feature_extent_buffer,\
+                                        xmax + feature_extent_buffer, ymax + feature_extent_buffer)
 
-        
-        anno_output = "{}_{}".format(anno_out_suffix, feature)
-        lyr.definitionQuery = "{} LIKE '{}%'".format(feature_field, feature)
-        
-        if lyr.supports("SHOWLABELS"):
-            lyr.showLabels = True
-            for label_class in lyr.listLabelClasses():
-                if "AFL" in label_class.name or \
-                    "ATL" in label_class.name or \
-                    "AFR" in label_class.name or \
-                    "ATR" in label_class.name:
-                    label_class.visible = True
-        
-        aprx.save()
-        anno_name = "{}{}".format(feature_lyr, anno_output)
-        print("Creating annotations {} from feature {}".format(anno_name, feature))
-        start_time = datetime.now()
-        print(start_time)
-
-        #if not using arcgis/google need to update service_file parameter
-        #may need to update extent param to the feature extents if possible
-
-        parameters = {"input_map": m,
-                    "conversion_scale": conversion_scale,
-                    "output_geodatabase": output_gdb,
-                    "anno_suffix": anno_output,
-                    "extent": feature_extents,
-                    "generate_unplaced": "GENERATE_UNPLACED",
-                    "feature_linked": "STANDARD",
-                    "which_layers": "SINGLE_LAYER",
-                    "single_layer": feature_lyr 
-                    }
-               
-        arcpy.cartography.ConvertLabelsToAnnotation(**parameters)
 
-        end_time = datetime.now()
-        duration = end_time - start_time
-        
-        print("{} created in {}.".format(anno_name, duration))
+    print("CD {} address count: {}".format(feature, addr_sum))
 
+    
+    anno_output = "{}_{}".format(anno_out_suffix, feature)
+    lyr.definitionQuery = "{} LIKE '{}%'".format(feature_field, feature)
+    
+    if lyr.supports("SHOWLABELS"):
+        lyr.showLabels = True
+        for label_class in lyr.listLabelClasses():
+            if "AFL" in label_class.name or \
+                "ATL" in label_class.name or \
+                "AFR" in label_class.name or \
+                "ATR" in label_class.name:
+                label_class.visible = True
+    
+    worker_aprx.save()
+    anno_name = "{}{}".format(feature_lyr, anno_output)
+    print("Creating annotations {} from feature {}".format(anno_name, feature))
+
+    #if not using arcgis/google need to update service_file parameter
+    #may need to update extent param to the feature extents if possible
+
+    parameters = {"input_map": m,
+                "conversion_scale": conversion_scale,
+                "output_geodatabase": worker_gdb,
+                "anno_suffix": anno_output,
+                "extent": feature_extents,
+                "generate_unplaced": "GENERATE_UNPLACED",
+                "feature_linked": "STANDARD",
+                "which_layers": "SINGLE_LAYER",
+                "single_layer": feature_lyr 
+                }
+           
+    #worker stages are logged under the run of the script that started the pool
+    with stage("convert labels", rows_in=addr_sum):
+        arcpy.cartography.ConvertLabelsToAnnotation(**parameters)
 
-        if final_pt_fc_name is not None and final_pt_fc_name is not "":
-            start_time = datetime.now()
-            print("Creating points from feature {} annotations".format(feature))
-            pt_anno_fc = "pts{}_{}".format(anno_out_suffix, feature)
+    print("{} created.".format(anno_name))
 
-            parameters = {"in_features": "{}\\{}".format(output_gdb, anno_name),
-                          "out_feature_class": "{}\\{}".format(output_gdb, pt_anno_fc),
-                          "point_location": "INSIDE"
-                          }
-            arcpy.FeatureToPoint_management(**parameters)
-            end_time = datetime.now()
-            duration = end_time - start_time
-        
-            print("{} created in {}.\n".format(pt_anno_fc, duration))
-            anno_pt_list.append("{}\\{}".format(output_gdb, pt_anno_fc))
-    print("annoptlist")
-    print(anno_pt_list)   
-    if final_pt_fc_name is not None and final_pt_fc_name is not "":            
+    lyr.definitionQuery = ""
+    if final_pt_fc_name is None or final_pt_fc_name == "":
+        return None
+
+    print("Creating points from feature {} annotations".format(feature))
+    pt_anno_fc = "pts{}_{}".format(anno_out_suffix, feature)
+
+    parameters = {"in_features": "{}\\{}".format(worker_gdb, anno_name),
+                  "out_feature_class": "{}\\{}".format(worker_gdb, pt_anno_fc),
+                  "point_location": "INSIDE"
+                  }
+    with stage("feature to point"):
+        arcpy.FeatureToPoint_management(**parameters)
+
+    print("{} created.\n".format(pt_anno_fc))
+    return "{}\\{}".format(worker_gdb, pt_anno_fc)
+
+def iterateAnnoByCD(scale_params, uid_dict, project, work_folder, workers):
+    """Create the annotations and points of every CD at every scale on a pool of worker processes, then merge the
+    points of each scale into its final feature class in that scale's output gdb.
+
+    Jobs are handed out largest CD first (by address count) so the smallest ones fill in at the end instead of one big
+    CD running alone on a single core."""
+
+    jobs = [(params, feature) for params in scale_params for feature in uid_dict]
+    jobs.sort(key=lambda job: addrSum(uid_dict[job[1]]), reverse=True)
+    print("Scheduling {} annotation jobs on {} workers...".format(len(jobs), workers))
+
+    anno_pt_lists = {params["final_pt_fc_name"]: {} for params in scale_params}
+    if not os.path.exists(work_folder):
+        os.makedirs(work_folder)
+    with ProcessPoolExecutor(max_workers=workers, initializer=initAnnoWorker, \
+                             initargs=(project, work_folder)) as pool:
+        futures = {}
+        for params, feature in jobs:
+            job_params = {key: params[key] for key in ("map_name", "feature_lyr", "feature_field", \
+                                                       "conversion_scale", "feature_extent_buffer", \
+                                                       "anno_out_suffix", "final_pt_fc_name")}
+            future = pool.submit(annotateCD, feature=feature, feature_dict=uid_dict[feature], **job_params)
+            futures[future] = (params["final_pt_fc_name"], feature)
+        for future in as_completed(futures):
+            final_pt_fc_name, feature = futures[future]
+            pt_fc = future.result()
+            if pt_fc is not None:
+                anno_pt_lists[final_pt_fc_name][feature] = pt_fc
+
+    for params in scale_params:
+        final_pt_fc_name = params["final_pt_fc_name"]
+        if final_pt_fc_name is None or final_pt_fc_name == "":
+            continue
+        #merge in the CD order of the dictionary so the output doesn't depend on which job finished first
+        anno_pt_list = [anno_pt_lists[final_pt_fc_name][feature] for feature in uid_dict \
+                        if feature in anno_pt_lists[final_pt_fc_name]]
         print("Merging points together to create {}".format(final_pt_fc_name))
-        #print(anno_pt_list)
         parameters = {"inputs": anno_pt_list,
-                      "output": "{}\\{}".format(output_gdb, final_pt_fc_name)
+                      "output": "{}\\{}".format(params["output_gdb"], final_pt_fc_name)
                       }
         
-        arcpy.Merge_management(**parameters)
+        with stage("merge points", rows_in=len(anno_pt_list)):
+            arcpy.Merge_management(**parameters)
 
         print("{} created.\n".format(final_pt_fc_name))
-            
-    lyr.definitionQuery = ""
-    aprx.save()
-    del lyr
-    del feature_lyr
-    del m
-    del aprx
-
-createGdb(output_gdb)                                    
-uid_dict = createCduidDict(**params_uid_dict)
-params_4k["uid_dict"] = uid_dict
-params_2k["uid_dict"] = uid_dict
-params_1k["uid_dict"] = uid_dict
-iterateAnnoByCD(**params_4k)
-iterateAnnoByCD(**params_2k)
-iterateAnnoByCD(**params_1k)
+
+#worker processes import this file, so the run only starts when it is called as a script
+if __name__ == "__main__":
+    #run and stage times are printed when the script exits
+    start_run("anno_to_point_CD_iteration")
+    createGdb(output_gdb)                                    
+    with stage("CD feature dictionary") as building:
+        uid_dict = createCduidDict(**params_uid_dict)
+        building.rows_out = len(uid_dict)
+    with stage("annotate CDs", rows_in=len(uid_dict)):
+        iterateAnnoByCD([params_4k, params_2k, params_1k], uid_dict, project, work_folder, workers)
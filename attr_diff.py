@@ -0,0 +1,92 @@
+# Column-wise attribute comparison between the redline and the NGD_AL
+#
+# Rather than looking up the NGD_AL record for every redline row and field, both tables are aligned on NGD_UID once
+# and each field is compared as a whole column. The result is a tidy table with one row per changed field that the
+# SQL writer can turn straight into UPDATE statements.
+
+import numpy as np
+import pandas as pd
+
+# columns of the table returned by diff_fields
+CHANGE_COLUMNS = ['uid', 'field', 'old', 'new', 'date_field']
+
+# NGD_AL fields compared by detect_changes that set ATTRBT_DTE when they change
+# 'STR_CLS_CDE', 'STR_RNK_CDE' - fields ignored due to AGOL editor data replication issues
+ATTRBT_FIELDS = ['SGMNT_SRC', 'ADDR_TYP_L', 'ADDR_TYP_R', 'ADDR_PRTY_L', 'ADDR_PRTY_R']
+# NGD_AL address fields compared by detect_changes, each sets the date field named after it
+ADDRESS_FIELDS = ['AFL_VAL', 'AFL_SFX', 'AFL_SRC', 'ATL_VAL', 'ATL_SFX', 'ATL_SRC', 
+                  'AFR_VAL', 'AFR_SFX', 'AFR_SRC', 'ATR_VAL', 'ATR_SFX', 'ATR_SRC']
+
+
+def sql_normalize_value(value):
+    """Ensure a value is either a string or an integer."""
+
+    # nothing to do when the value is None or NaN
+    if value is None or pd.isna(value):
+        return None
+
+    # if it is a string just send it as is
+    if type(value) is str:
+        return value
+
+    # probably a number, so force an integer (there are no floats in what we care about)
+    try:
+        return int(value)
+    except:
+        pass
+
+    # nothing else worked, just return None
+    return None
+
+
+def address_date_field(fieldname):
+    """Date field set when an address field changes, AFL_DTE for AFL_VAL, AFL_SFX and AFL_SRC."""
+
+    return fieldname.split('_')[0] + "_DTE"
+
+
+def diff_fields(redline, ngdal, uid_field, date_fields, carry=()):
+    """Compare the redline against the NGD_AL for every field in date_fields.
+
+    date_fields maps each field to compare to the date field that records when it changed. Redline values are
+    normalized with sql_normalize_value and two nulls are considered equal. Rows whose UID is not in the NGD_AL are
+    not compared, and when the NGD_AL holds a UID more than once the first record wins. Redline columns listed in
+    carry are copied onto each change.
+
+    Returns a tuple of (changes, missing, same): changes is a table with CHANGE_COLUMNS ordered by redline row and then
+    by field, missing lists the UIDs not found in the NGD_AL and same counts the comparisons that found no change."""
+
+    fields = list(date_fields)
+    ngd = ngdal.drop_duplicates(subset=uid_field, keep='first').set_index(uid_field)
+
+    found = redline[uid_field].isin(ngd.index)
+    missing = redline.loc[~found, uid_field].unique().tolist()
+    red = redline.loc[found]
+    uids = red[uid_field].to_numpy()
+    old_values = ngd.loc[uids, fields]
+
+    changes = []
+    for order, fieldname in enumerate(fields):
+        # normalized one value at a time, Series.map would turn the ints and Nones of a float column back into floats
+        new = np.array([sql_normalize_value(value) for value in red[fieldname].to_numpy(dtype=object)], dtype=object)
+        old = old_values[fieldname].astype(object).to_numpy()
+        new_null = pd.isna(new)
+        old_null = pd.isna(old)
+
+        # null-aware equality: two nulls match, a null never matches a value
+        differs = (new_null != old_null) | (~new_null & ~old_null & (old != new))
+        rows = differs.nonzero()[0]
+        changes.append(pd.DataFrame({'row': rows,
+                                     'order': order,
+                                     'uid': uids[rows],
+                                     'field': fieldname,
+                                     'old': old[rows],
+                                     'new': new[rows],
+                                     'date_field': date_fields[fieldname],
+                                     **{column: red[column].to_numpy()[rows] for column in carry}}))
+
+    changes = (pd.concat(changes, ignore_index=True)
+              .sort_values(['row', 'order'], kind='stable')
+              .reset_index(drop=True)[CHANGE_COLUMNS + list(carry)])
+    same = len(red) * len(fields) - len(changes)
+    return changes, missing, same
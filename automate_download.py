@@ -3,12 +3,20 @@ import sys
 
 import arcpy
 import pandas as pd
-from arcgis.features import FeatureLayer, GeoAccessor
+from arcgis.features import FeatureLayer, FeatureSet, GeoAccessor
 from arcgis.gis import GIS
 from dotenv import load_dotenv
 
+from ec_linkage import load_linkage_index
+from instrumentation import stage, start_run, timed
+from ngd_staging import read_ngdal
+from paged_download import clear_staging, download_pages, read_staged_features
+from redline_qc import run_qc
+from redline_sync import drop_seen, load_checkpoint, merge_latest, save_checkpoint, sync_end, sync_start
+
 arcpy.env.overwriteOutput = True
 
+@timed('download')
 def auto_download_data(data_url, outGDB, outname, from_date, to_date):
     """ Requires you to be logged into arcgis pro on this computer with an account that has access to the data you are trying to 
     download. You must be logged into arcGIS pro with your statscan AGOL account in order for this to work. This funtion will
@@ -22,7 +30,20 @@ def auto_download_data(data_url, outGDB, outname, from_date, to_date):
         data_url = os.path.join(data_url, '0')
     
     query = "EditDate BETWEEN TIMESTAMP '{}' AND TIMESTAMP '{}'".format(from_date, to_date)
-    arcpy.FeatureClassToFeatureClass_conversion(data_url, outGDB, outname, where_clause= query)
+    # Pages are staged beside the GDB so an interrupted download picks up where it left off
+    # and are requested through the session of the Pro login, which signs every request
+    staging_dir = os.path.join(os.path.dirname(outGDB), outname + '_pages')
+    manifest = download_pages(data_url, query, staging_dir, 
+                              page_size= int(os.getenv('NGD_DOWNLOAD_PAGE_SIZE', 1000)), 
+                              workers= int(os.getenv('NGD_DOWNLOAD_WORKERS', 4)), 
+                              session= gis.session)
+    if len(manifest['pages']) == 0:
+        # Nothing matched, let arcpy create the empty feature class with the layer schema
+        arcpy.FeatureClassToFeatureClass_conversion(data_url, outGDB, outname, where_clause= query)
+    else:
+        features = FeatureSet.from_dict(read_staged_features(staging_dir)).sdf
+        features.spatial.to_featureclass(os.path.join(outGDB, outname), sanitize_columns= False)
+    clear_staging(staging_dir)
     return os.path.join(outGDB, outname)
 
 def rename_the_fields(NGD_data):
@@ -106,146 +127,11 @@ def rename_the_fields(NGD_data):
         if fieldName in ngdal_col_map:
             arcpy.AlterField_management(NGD_data, fieldName, ngdal_col_map[fieldName])
 
-def unique_values(fc, field):
-    # Returns a list off unique values for a given field in the unput dataset
-    fl = arcpy.MakeFeatureLayer_management(fc, 'fl', where_clause= 'NGD_UID IS NOT NULL')
-    with arcpy.da.SearchCursor(fc, field_names= [field]) as cursor:
-        return sorted({row[0] for row in cursor})
-
-def filter_data_remove_duplicates(Redline_data, outGDB, outName):
-    # Read rows into a pandas dataframe
-    df = pd.DataFrame.spatial.from_featureclass(Redline_data, sr= '3347')
-    if len(df) == 0:
-        print('Length of rows is 0 continuing')
-        return None
-    KeepRows = []
-    for uid in unique_values(Redline_data, 'NGD_UID'):
-        uid_rows = df.loc[df['NGD_UID'] == uid ]
-        maxDateRow = uid_rows.loc[uid_rows['EditDate'] == uid_rows.EditDate.max()]
-        KeepRows.append(maxDateRow.iloc[0]['OBJECTID'])
-    print('Keeping ' + str(len(KeepRows)) + ' rows from Redline data')
-    arcpy.FeatureClassToFeatureClass_conversion(Redline_data, 
-                                                outGDB, 
-                                                outName + '_uniques', 
-                                                where_clause= "OBJECTID IN " + str(tuple(KeepRows)))
-    return os.path.join(outGDB, outName + '_uniques')
-
-def address_field_check(redline_data, out_gdb, out_base_name, w_NGD_UID= True):
-    if arcpy.GetCount_management(redline_data) == 0:
-        print('Redline data has no records returning None')
-        return [None, None]
-    print('Running address field changes check')
-    # check redline fields against the NGD_AL fields. If fields change from valid to invalid flag those rows
-    uid_field = 'NGD_UID'
-    if w_NGD_UID == False:
-        uid_field = 'OBJECTID'
-    
-    fields_to_qc = [uid_field, 'AFL_VAL','AFL_SRC', 'AFR_VAL', 'AFR_SRC', 'ATL_VAL', 'ATL_SRC', 'ATR_VAL', 'ATR_SRC', 'ADDR_TYP_L',
-                    'ADDR_TYP_R', 'ADDR_PRTY_L', 'ADDR_PRTY_R']
-    
-    fail_rows = []
-    good_rows = []
-    with arcpy.da.SearchCursor(redline_data, field_names= fields_to_qc ) as cursor:
-        for row in cursor:
-            #If the row breaks the rule then add to the fail_rows list for correction
-            #if AFL_VAL IS NOT NULL THEN ATL_VAL, ADDR_TYP_L, ADDR_PRTY_L NOT NULL
-            if row[1] != None and row[5] == None or  row[9] == None or row[11] == None:
-                fail_rows.append(row[0])
-                continue
-            #if ATL_VAL IS NOT NULL THEN AFL_VAL ADDR_TYP_L, ADDR_PRTY_L NOT NULL
-            if row[5] != None and row[1] == None or  row[9] == None or row[11] == None:
-                fail_rows.append(row[0])
-                continue
-            # if AFR_VAL not NULL, then ATR_VAL, ADDR_TYP_R, ADDR_PRTY_R not NULL 
-            if row[3] != None and row[7] == None or row[10] == None or row[12] == None:
-                fail_rows.append(row[0])
-                continue
-            #if ATR_VAL not NULL, then AFR_VAL, ADDR_TYP_R, ADDR_PRTY_R not NULL 
-            if row[7] != None and row[3] == None or row[10] == None or row[12] == None:
-                fail_rows.append(row[0])
-                continue
-            good_rows.append(row[0])
-    print('Exporting sorted rows')
-    outlist = [None, None]
-    print('Good rows: ' + str(len(good_rows)) + ' Rows to QC: ' + str(len(fail_rows)))
-    if len(good_rows) > 0:
-        if len(good_rows) == 1:
-            arcpy.FeatureClassToFeatureClass_conversion(redline_data, out_gdb, out_base_name + '_goodAddr',  
-                                                        where_clause= uid_field + ' = ' + str(good_rows[0]))
-            outlist[0] = os.path.join(out_gdb, out_base_name + '_goodAddr')
-        if len(good_rows) > 1:
-            arcpy.FeatureClassToFeatureClass_conversion(redline_data, out_gdb, out_base_name + '_goodAddr',  
-                                                        where_clause= uid_field + ' IN ' + str(tuple(good_rows)))
-            outlist[0] = os.path.join(out_gdb, out_base_name + '_goodAddr')
-    if len(fail_rows)> 0:
-        if len(fail_rows) == 1:
-            arcpy.FeatureClassToFeatureClass_conversion(redline_data, out_gdb, out_base_name + '_badAddr',  
-                                                    where_clause= uid_field + ' = ' + str(fail_rows[0]))
-            outlist[1] = os.path.join(out_gdb, out_base_name + '_badAddr') 
-        if len(fail_rows) > 1:
-            arcpy.FeatureClassToFeatureClass_conversion(redline_data, out_gdb, out_base_name + '_badAddr',  
-                                                        where_clause= uid_field + ' IN ' + str(tuple(fail_rows)))
-            outlist[1] = os.path.join(out_gdb, out_base_name + '_badAddr')
-    return outlist
-
-
-def fix_address_field_errors(bad_redline_rows, o_gdb, o_name):
-    fl = arcpy.MakeFeatureLayer_management(bad_redline_rows, 'fl')
-    for d in ['L', 'R']:
-        #Fill in AF and AT holes
-        query1 = 'AT{}_VAL IS NULL AND AF{}_VAL IS NOT NULL'.format(d, d)
-        query2 = 'AT{}_VAL IS NOT NULL AND AF{}_VAL IS NULL'.format(d, d)
-        arcpy.SelectLayerByAttribute_management(fl, where_clause= query1)
-        arcpy.CalculateField_management(fl, 'AT' + d + '_VAL', '!AF' + d + '_VAL!')
-        arcpy.SelectLayerByAttribute_management(fl, 'NEW_SELECTION', query2)
-        arcpy.CalculateField_management(fl, 'AF' + d + '_VAL', '!AT' + d + '_VAL!')    
-    #Export changes and overwrite prior redline file
-    arcpy.SelectLayerByAttribute_management(fl, 'CLEAR_SELECTION')
-    arcpy.FeatureClassToFeatureClass_conversion(fl, o_gdb, o_name + '_bad_addr')
-    return os.path.join(o_gdb, o_name + '_bad_addr') 
-
-def qc_PRTY_vals(redline_rows, o_gdb, o_name):
-    # This needs to check every row so put after merge 
-    fl = arcpy.MakeFeatureLayer_management(redline_rows, 'fl')
-    code = '''
-def ADDR_PRTY_FIXER(AF_VAL, AT_VAL):
-    AF_int = int(AF_VAL)
-    AT_int = int(AT_VAL)
-    if (AF_int % 2) == 0 and (AT_int % 2) == 0:
-        return 'E'
-    if (AF_int % 2) != 0 and (AT_int % 2) != 0:
-        return 'O'
-    if (AF_int % 2) == 0 and (AT_int % 2) != 0:
-        return 'M'
-    if (AF_int % 2) != 0 and (AT_int % 2) == 0:
-        return 'M'
-        '''
-    for d in ['L', 'R']:
-        
-        arcpy.SelectLayerByAttribute_management(fl, 'NEW_SELECTION', where_clause= 'ADDR_PRTY_' + d + ' IS NULL')
-        arcpy.CalculateField_management(fl, 'ADDR_PRTY_' + d, 'ADDR_PRTY_FIXER(!AF' + d + '_VAL!, !AT' + d + '_VAL!)', 
-                                        'PYTHON3', code_block= code)
-    arcpy.FeatureClassToFeatureClass_conversion(fl, o_gdb, o_name)
-    return os.path.join(o_gdb, o_name)
-
-def fix_null_src_vals(bad_redline_rows, o_gdb, o_name):
-    fl = arcpy.MakeFeatureLayer_management(bad_redline_rows, 'fl')
-    #Select all rows in which the F_SRC val is not null and the T_SRC val is null and make the same
-    for d in ['L', 'R']:
-        query1 = 'AT{}_SRC IS NULL AND AF{}_SRC IS NOT NULL'.format(d, d)
-        query2 = 'AF{}_SRC IS NOT NULL AND AT{}_SRC IS NULL'.format(d, d)
-        arcpy.SelectLayerByAttribute_management(fl, 'NEW_SELECTION', where_clause= query1)
-        arcpy.CalculateField_management(fl, 'AT' + d +'_SRC', '!AF' + d + '_SRC!')
-        arcpy.SelectLayerByAttribute_management(fl, 'NEW_SELECTION', where_clause= query2)
-        arcpy.CalculateField_management(fl, 'AF' + d + '_SRC', '!AT' + d + '_SRC!')
-    #Export Corrected data
-    arcpy.SelectLayerByAttribute_management(fl, 'CLEAR_SELECTION')
-    arcpy.FeatureClassToFeatureClass_conversion(fl, o_gdb, o_name + '_bad_addr')
-    return os.path.join(o_gdb, o_name + '_bad_addr')
-
 #------------------------------------------------------------------------------------------------------------
 # inputs
 load_dotenv(os.path.join(os.getcwd(), 'environments.env'))
+# run and stage times are printed when the script exits, and logged to NGD_METRICS_LOG when it is set
+start_run('automate_download')
 
 directory = os.getcwd() # Will return the directory that this file is currently in.
 url = r'https://services7.arcgis.com/bRi0AN5rG57dCDE4/arcgis/rest/services/NGD_STREET_Redline_V2_61/FeatureServer/0' # URL for AGOL NGD_Redline data
@@ -263,47 +149,58 @@ from_date = os.getenv('FROM_DATE_TIME')
 to_date = os.getenv('TO_DATE_TIME')
 print('Settings: From Date- {}, To Date- {}'.format(from_date, to_date))
 
+# Incremental mode only downloads edits made since the last sync and keeps every record in a local store
+incremental = os.getenv('NGD_INCREMENTAL_SYNC', 'false').lower() in ('1', 'true', 'yes')
+checkpoint_path = os.getenv('NGD_SYNC_CHECKPOINT', os.path.join(directory, 'redline_sync_checkpoint.json'))
+store_name = o_name + '_store'
+checkpoint = None
+sync_to = None
+if incremental:
+    checkpoint = load_checkpoint(checkpoint_path)
+    from_date = sync_start(checkpoint, from_date)
+    # The window ends shortly before now instead of at TO_DATE_TIME, so each run picks up every edit since the last one
+    sync_to = sync_end(int(os.getenv('NGD_SYNC_LAG_SECONDS', 300)))
+    to_date = sync_to.strftime('%Y-%m-%d %H:%M:%S')
+    print('Incremental sync from {} to {}'.format(from_date, to_date))
+
 #--------------------------------------------------------------------------------------------------------------
 #Calls
 print('Running script')
-results = auto_download_data(url, o_gdb, o_name, from_date, to_date)
+results = auto_download_data(url, o_gdb, o_name + '_download', from_date, to_date)
 rename_the_fields(results)
 
 if int(arcpy.GetCount_management(results).getOutput(0)) == 0:
     print('No records for given date range. Exiting script')
+    if incremental:
+        # Nothing was edited in the window, the next sync can start at its end
+        save_checkpoint(checkpoint_path, None, checkpoint, window_end= sync_to)
     sys.exit()
 print('Total number of imported records: ' + str(int(arcpy.GetCount_management(results).getOutput(0))))
-print('Splitting records into NGD_UIDs and Null NGD_UIDs')
-w_NGD_UIDs = arcpy.FeatureClassToFeatureClass_conversion(results, o_gdb, o_name + '_w_NGD_UID', 'NGD_UID IS NOT NULL')
-no_NGD_UIDs = arcpy.FeatureClassToFeatureClass_conversion(results, o_gdb, o_name + '_w_no_NGD_UID', 'NGD_UID IS NULL')
-
-print('Records with NGD_UIDs: {}  Records with NULL NGD_UIDs: {}'.format(arcpy.GetCount_management(w_NGD_UIDs), 
-                                                                        arcpy.GetCount_management(no_NGD_UIDs)))
-
-print('Filtering to remove records that contain duplicate NGD_UIDs')
-filtered = filter_data_remove_duplicates(w_NGD_UIDs, o_gdb, o_name)
 
-print('Running address fields QC checks')
-checked_w_NGD_UID = address_field_check(filtered, o_gdb, o_name + '_ch_w_uid', True)
-checked_no_NGD_UID = address_field_check(no_NGD_UIDs, o_gdb, o_name + '_ch_no_uid', w_NGD_UID= False)
-
-files = []
-for fc in checked_no_NGD_UID + checked_w_NGD_UID:
-    if type(fc) != None: files.append(fc)
-
-print('Merging ' + str(len(files)) + ' files') 
-merged = arcpy.Merge_management(files, os.path.join(o_gdb, o_name + '_merged'))
+# Load the download once and run every QC step in memory
+downloaded = pd.DataFrame.spatial.from_featureclass(results, sr= '3347')
+redline = downloaded
+if incremental:
+    with stage('incremental merge', rows_in= len(downloaded)) as merging:
+        redline = drop_seen(downloaded, checkpoint)
+        print('New edits since the last sync: ' + str(len(redline)))
+        store_path = os.path.join(o_gdb, store_name)
+        if arcpy.Exists(store_path):
+            redline = merge_latest(pd.DataFrame.spatial.from_featureclass(store_path, sr= '3347'), redline)
+        redline.spatial.to_featureclass(store_path, sanitize_columns= False)
+        # Only move the checkpoint once the store holds the new edits
+        save_checkpoint(checkpoint_path, downloaded, checkpoint, window_end= sync_to)
+        merging.rows_out = len(redline)
+with stage('QC', rows_in= len(redline)) as qc:
+    redline, addr_failed = run_qc(redline)
+    qc.rows_out = len(redline)
 
 #Get only NGD_UIDs in redline data for NGD_AL filtering
-uids = unique_values(filtered, 'NGD_UID')
+uids = sorted(redline['NGD_UID'].dropna().astype(int).unique().tolist())
 
-outFC_nme = os.path.join(o_gdb, o_name)
-print('Performing final address QC')
-fix_address_field_errors(merged, o_gdb, o_name)
-fix_null_src_vals(merged, o_gdb, o_name)
-qc_PRTY_vals(merged, o_gdb, o_name)
-print('Merging all records and exporting to final feature class')
-arcpy.Merge_management(merged, os.path.join(o_gdb, o_name ))
+print('Exporting ' + str(len(redline)) + ' records to final feature class')
+with stage('export redline', rows_out= len(redline)):
+    redline.spatial.to_featureclass(os.path.join(o_gdb, o_name), sanitize_columns= False)
 
 # #REMOVE ONT EDITS ONLY FOR FRI DEC 12 2020 PULL
 # fl = arcpy.MakeFeatureLayer_management(NGD_STREET_REDLINE)
@@ -315,25 +212,32 @@ arcpy.Merge_management(merged, os.path.join(o_gdb, o_name ))
 # arcpy.SelectLayerByLocation_management(fl, 'INTERSECT', csd_filtered , invert_spatial_relationship= True)
 # arcpy.FeatureClassToFeatureClass_conversion(fl, o_gdb, o_name)
 
+# Records that broke the address rules are exported with their filled values so they can be reviewed
+keep_fcs = [o_name, store_name]
+if addr_failed.any():
+    keep_fcs.append(o_name + '_addr_qc')
+    print('Exporting ' + str(addr_failed.sum()) + ' records that failed the address QC to ' + keep_fcs[-1])
+    redline[addr_failed].spatial.to_featureclass(os.path.join(o_gdb, keep_fcs[-1]), sanitize_columns= False)
+
 print('Deleting non essential feature classes')
 arcpy.env.workspace = o_gdb
 for fc in arcpy.ListFeatureClasses():
-    if fc != o_name:
+    if fc not in keep_fcs:
         arcpy.Delete_management(fc) 
 
 print('Filtering NGD_AL data')
+# The NGD_AL is read through the Parquet staging cache so only the redline arcs are decoded
 NGD_AL_path = os.path.join(directory, 'Final_Export_2020-09-28_2.gdb', 'NGD_AL')
-arcpy.FeatureClassToFeatureClass_conversion(NGD_AL_path,
-                                            os.path.join(directory, o_gdb), 
-                                            'NGD_AL_filtered',
-                                            'NGD_UID IN ' + str(tuple(uids)))  
-
-if not os.path.exists(os.getenv('NDG_EC_LINKS')):
-    print('Creating NGD_STR_UID and EC_STR_ID linkage table')
-    ngd_ec_str_id = pd.DataFrame.spatial.from_featureclass(NGD_AL_path, fields= ['NGD_STR_UID_L', 
-                                                                            'NGD_STR_UID_R', 
-                                                                            'EC_STR_ID_L',
-                                                                            'EC_STR_ID_R'])
-    ngd_ec_str_id.to_csv(os.getenv('NDG_EC_LINKS'))
+with stage('filter NGD_AL', rows_in= len(uids)) as filtering:
+    NGD_AL_filtered = read_ngdal(*os.path.split(NGD_AL_path), uids= uids, crs= 'EPSG:3347')
+    (pd.DataFrame.spatial.from_geodataframe(NGD_AL_filtered, column_name= 'SHAPE')
+        .spatial.to_featureclass(os.path.join(o_gdb, 'NGD_AL_filtered'), sanitize_columns= False))
+    filtering.rows_out = len(NGD_AL_filtered)
+
+# The linkage index is rebuilt from the staged NGD_AL whenever a new vintage is staged, so it is never stale
+with stage('linkage index') as linking:
+    ngd_ec_linkage = load_linkage_index(*os.path.split(NGD_AL_path))
+    linking.rows_out = len(ngd_ec_linkage)
+print('NGD_STR_UID and EC_STR_ID linkage index holds ' + str(len(ngd_ec_linkage)) + ' links')
 
 print('DONE!')
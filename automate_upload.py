@@ -6,11 +6,16 @@ from arcgis.features import GeoAccessor
 from arcgis.features import FeatureLayerCollection
 from datetime import date
 
+from csd_assigner import load_csd_assigner
+from instrumentation import stage, start_run
+
 arcpy.env.overwriteOutput = True
 
 #---------------------------------------------------------------------------
 #Inputs
 load_dotenv(os.path.join(os.getcwd(), 'environments.env'))
+# run and stage times are printed when the script exits, and logged to NGD_METRICS_LOG when it is set
+start_run('automate_upload')
 changesGDB = os.getenv('GEOM_CHANGES_DATA')
 changes_layer = os.getenv('GEOM_LAYER')
 
@@ -20,22 +25,19 @@ print('GDB source: ' + changesGDB + ' changes fc: ' + changes_layer)
 fl_title= changes_layer + '_' + str(os.getenv('TO_DATE_TIME').split(' ')[0])
 
 #---------------------------------------------------------------------------
-# Remove NULL CSD_UIDs from output 
-query = 'CSD_UID_R IS NULL OR CSD_UID_R IS NULL'
-no_csd_uid = arcpy.MakeFeatureLayer_management(os.path.join(changesGDB, changes_layer), 'fl', where_clause= query)
-for d in ['l', 'r']:
-    direction = 'LEFT'
-    print('Looking for CSD_UIDs on ' + direction.lower() + ' side')
-    if d == 'r':
-        direction = 'RIGHT'
-    buffer = arcpy.Buffer_analysis(no_csd_uid, os.path.join(changesGDB, 'buffer_' + d), '5 METERS', direction)
-    print('Making Spatial Join')
-    sj = arcpy.SpatialJoin_analysis(buffer, CSD_data, os.path.join(changesGDB, d + '_sj'), join_operation= 'JOIN_ONE_TO_ONE', 
-                                join_type= 'KEEP_ALL')
-    joined = arcpy.AddJoin_management(no_csd_uid, 'OBJECTID', sj, 'TARGET_FID')
-    print('Calculating CSD_UIDS')
-    arcpy.CalculateField_management(joined, 'redline_geom.CSD_UID_' + d.upper(), '!{}.CSD_UID!'.format(d + '_sj'), 'PYTHON3')
-    arcpy.RemoveJoin_management(no_csd_uid, d + '_sj')
+# Fill NULL CSD_UIDs from the CSD polygons on each side of the line
+geom_changes = pd.DataFrame.spatial.from_featureclass(os.path.join(changesGDB, changes_layer), sr= '3347')
+no_csd_uid = geom_changes['CSD_UID_L'].isna() | geom_changes['CSD_UID_R'].isna()
+if no_csd_uid.any():
+    print('Looking for CSD_UIDs on ' + str(no_csd_uid.sum()) + ' records')
+    with stage('assign CSD_UIDs', rows_in= no_csd_uid.sum()):
+        csd_l, csd_r = load_csd_assigner(*os.path.split(CSD_data)).assign(geom_changes.loc[no_csd_uid, 'SHAPE'])
+    for side, csd_uids in [('L', csd_l), ('R', csd_r)]:
+        field = 'CSD_UID_' + side
+        found = pd.Series(csd_uids, index= geom_changes.index[no_csd_uid])
+        if pd.api.types.is_numeric_dtype(geom_changes[field]):
+            found = pd.to_numeric(found)
+        geom_changes[field] = geom_changes[field].fillna(found)
 
 
 #---------------------------------------------------------------------------
@@ -48,13 +50,13 @@ print('Logged in as: ' + str(gis.properties.user.username))
 for item in gis.content.search('title: ' + fl_title):
     item.delete()
 
-geom_changes = pd.DataFrame.spatial.from_featureclass(os.path.join(changesGDB, changes_layer), sr= '3347')
 print( 'Uploading feature layer with ' + str(len(geom_changes)) + ' records to AGOL')
 
-geom_fl = geom_changes.spatial.to_featurelayer(
-                                    title= fl_title, 
-                                    gis= GIS('pro'), 
-                                    tags= 'NGD_AL, Redline, ' + str(date.today()))
+with stage('upload', rows_out= len(geom_changes)):
+    geom_fl = geom_changes.spatial.to_featurelayer(
+                                        title= fl_title, 
+                                        gis= GIS('pro'), 
+                                        tags= 'NGD_AL, Redline, ' + str(date.today()))
 
 # Make into a feature layer collection to change properties
 geom_flc = FeatureLayerCollection.fromitem(geom_fl)
@@ -0,0 +1 @@
+# Benchmarks of the change detection pipeline on synthetic NGD data, see benchmarks/run.py
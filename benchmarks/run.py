@@ -0,0 +1,189 @@
+# Run the benchmark stages on synthetic data and record the results
+#
+# Usage, from the repository root:
+#
+#     python -m benchmarks.run --arcs 1000000 --edit-share 0.01 --seed 0
+#
+# The synthetic data is generated once, then every stage runs in a forked child process so its peak memory is its
+# own and one stage can't warm caches or leak memory into the next. Each stage reports wall time, CPU time, peak RSS
+# and rows per second. The run is appended to a JSON history and printed next to the last run of the same size.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime
+
+from benchmarks.stages import STAGES, Inputs
+from benchmarks.synthetic import SyntheticNgd
+from instrumentation import reset_peak_rss, status_kb
+
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.json')
+
+
+def measure(prepare, run, inputs, conn):
+    """Prepare and run one stage, sending its measurements (or the error it raised) down conn."""
+
+    try:
+        args = prepare(inputs)
+        reset = reset_peak_rss()
+        start_rss = status_kb('VmRSS')
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        rows = run(*args)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        peak = status_kb('VmHWM') if reset else None
+        if peak is None:
+            # ru_maxrss is in kB on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send({'wall_seconds': round(wall, 4),
+                   'cpu_seconds': round(cpu, 4),
+                   'peak_rss_mb': round(peak / 1024, 1),
+                   'start_rss_mb': round(start_rss / 1024, 1) if start_rss is not None else None,
+                   # memory the stage itself added on top of the inherited data
+                   'rss_growth_mb': round((peak - start_rss) / 1024, 1) if start_rss is not None else None,
+                   'peak_includes_setup': not reset,
+                   'rows': int(rows),
+                   'rows_per_second': round(rows / wall, 1) if wall > 0 else None})
+    except Exception:
+        conn.send({'error': traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def run_stage(name, inputs):
+    """Run a stage in a forked child and return its measurements."""
+
+    prepare, run = STAGES[name]
+    context = multiprocessing.get_context('fork')
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(prepare, run, inputs, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        # the child died without reporting, most likely killed for running out of memory
+        result = {'error': f'stage process exited with code {process.exitcode}'}
+    process.join()
+    if 'error' not in result and process.exitcode:
+        result['error'] = f'stage process exited with code {process.exitcode}'
+    return result
+
+
+def git_commit():
+    """The commit the code under test is at, None outside a git checkout."""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_history(history, path):
+    """Write the history, replacing the old file in one step."""
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def previous_run(history, record):
+    """The latest run in history with the same data as record, None when there is none."""
+
+    same = ('arcs', 'seed', 'edit_share')
+    for old in reversed(history):
+        if all(old.get(key) == record[key] for key in same):
+            return old
+    return None
+
+
+def summary(record, previous=None):
+    """Table of the stage results of a run, with the change in wall time against the previous run."""
+
+    header = f"{'stage':<18}{'rows':>10}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'+MB':>8}{'rows/s':>14}{'vs last':>10}"
+    lines = [header, '-' * len(header)]
+    for name, result in record['stages'].items():
+        if 'error' in result:
+            lines.append(f"{name:<18}  failed: {result['error'].strip().splitlines()[-1]}")
+            continue
+        change = ''
+        old = (previous or {}).get('stages', {}).get(name, {})
+        if old.get('wall_seconds'):
+            change = f"{(result['wall_seconds'] / old['wall_seconds'] - 1) * 100:+.0f}%"
+        rate = result['rows_per_second']
+        growth = result.get('rss_growth_mb')
+        lines.append(f"{name:<18}{result['rows']:>10}{result['wall_seconds']:>10.3f}{result['cpu_seconds']:>10.3f}"
+                     f"{result['peak_rss_mb']:>10.1f}{growth if growth is not None else '':>8}"
+                     f"{rate if rate is not None else '':>14}{change:>10}")
+    return os.linesep.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the NGD change detection stages on synthetic data.')
+    parser.add_argument('--arcs', type=int, default=100000, help='number of NGD_AL arcs to generate')
+    parser.add_argument('--edit-share', type=float, default=0.01, help='share of the arcs edited in the redline')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES), help='stages to run')
+    parser.add_argument('--history', default=HISTORY_PATH, help='JSON file the results are appended to')
+    parser.add_argument('--label', help='note stored with the run, such as the change being measured')
+    args = parser.parse_args(argv)
+
+    print(f'Generating {args.arcs} synthetic NGD_AL arcs (seed {args.seed})')
+    start = time.perf_counter()
+    data = SyntheticNgd(args.arcs, args.seed)
+    workdir = tempfile.mkdtemp(prefix='ngd_benchmark_')
+    inputs = Inputs(data, workdir, args.edit_share)
+    # the shared inputs are built before forking so every stage finds them ready
+    inputs.redline()
+    inputs.linkage()
+    generate_seconds = time.perf_counter() - start
+    print(f'Generated {len(inputs.download())} redline edits in {generate_seconds:.1f} s')
+
+    record = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'commit': git_commit(),
+              'label': args.label,
+              'host': platform.node(),
+              'python': platform.python_version(),
+              'cpus': os.cpu_count(),
+              'arcs': args.arcs,
+              'seed': args.seed,
+              'edit_share': args.edit_share,
+              'redline_rows': len(inputs.download()),
+              'generate_seconds': round(generate_seconds, 2),
+              'stages': {}}
+    try:
+        for name in args.stages:
+            print('Running', name)
+            record['stages'][name] = run_stage(name, inputs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    history = load_history(args.history)
+    print(summary(record, previous_run(history, record)))
+    history.append(record)
+    save_history(history, args.history)
+    print('Results appended to', args.history)
+    return 1 if any('error' in result for result in record['stages'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+# Benchmark stages over the synthetic data
+#
+# Each stage pairs a prepare function, which builds the inputs of the stage from a SyntheticNgd and is not timed,
+# with a run function that does the work being measured and returns the number of rows it processed. The
+# detect_changes stages call the step functions of detect_steps the script runs, without the AGOL and GDB reads
+# around them. A step works on the redline as the steps before it left it, so preparing a late step runs the earlier
+# ones first.
+
+import os
+from collections import Counter
+
+import numpy as np
+
+from address_overlap import INTERVAL_FIELDS, find_overlaps
+from change_log import ChangeLog
+from detect_steps import (ALIAS_UID_FIELDS, diff_address_ranges, find_csd_boundaries, find_geometry_changes,
+                          find_new_geometries, find_rh_diff_flags, match_street_names)
+from ec_linkage import LinkageIndex
+from redline_field_update_counts import field_list, sqlVariableCounts
+from redline_qc import run_qc
+from sql_writer import SqlWriter
+from street_match import STREET_KEY_FIELDS
+
+UID_FIELD = 'NGD_UID'
+DATE_FIELD = 'EditDate'
+# defaults detect_changes reads from the environment
+GEOM_ROUNDING_FACTOR = 0.1
+DISPLACEMENT_TOLERANCE = 10
+VINTAGE_DATE = '2020-03-13'
+
+
+class Inputs:
+    """Data shared by the stages of one run, built the first time a stage asks for it.
+
+    The runner builds it in the parent process, so what one stage prepares is not there for the next one."""
+
+    def __init__(self, data, workdir, edit_share):
+        self.data = data
+        self.workdir = workdir
+        self.edit_share = edit_share
+        self._cache = {}
+
+    def cached(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    def download(self):
+        """The redline as it comes down from AGOL, duplicate edits included."""
+
+        return self.cached('download', lambda: self.data.redline(self.edit_share))
+
+    def redline(self):
+        """The redline after the download QC, with the alias street UIDs added from the NGD_AL."""
+
+        def build():
+            redline, _ = run_quietly(run_qc, self.download().drop(columns=['OBJECTID']))
+            ngdal = self.ngdal()
+            return redline.merge(ngdal[[UID_FIELD] + ALIAS_UID_FIELDS], on=UID_FIELD, how='left')
+        return self.cached('redline', build)
+
+    def ngdal(self):
+        """The NGD_AL records of the arcs the redline touches, with their geometry."""
+
+        def build():
+            positions = self.download()['position'].unique()
+            return self.data.ngdal_with_shapes(np.sort(positions))
+        return self.cached('ngdal', build)
+
+    def ngdstreet(self):
+        return self.cached('ngdstreet', lambda: self.data.ngdstreet()[STREET_KEY_FIELDS + ['NGD_STR_UID']])
+
+    def linkage(self):
+        return self.cached('linkage', lambda: LinkageIndex().update(self.data.ec_linkage()))
+
+
+def run_quietly(function, *args, **kwargs):
+    """Call function with its progress output thrown away."""
+
+    from contextlib import redirect_stdout
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        return function(*args, **kwargs)
+
+
+def detect_through(inputs, last):
+    """A fresh copy of the redline after detect_changes steps 1 to last, with the attribute changes left by step 5
+    once last is 5."""
+
+    redline = inputs.redline().copy()
+    for step in range(1, last + 1):
+        if step == 2:
+            run_quietly(find_geometry_changes, redline, inputs.ngdal(), UID_FIELD, GEOM_ROUNDING_FACTOR,
+                        DISPLACEMENT_TOLERANCE)
+        elif step == 5:
+            with SqlWriter(os.devnull, 'NGD.NGD_AL', UID_FIELD, VINTAGE_DATE) as writer:
+                return run_quietly(match_street_names, redline, inputs.ngdal(), inputs.ngdstreet(), inputs.linkage(),
+                                   writer, ChangeLog(), Counter(), UID_FIELD, DATE_FIELD)
+        else:
+            run_quietly(STEPS[step], redline, UID_FIELD)
+    return redline
+
+
+def prepare_download_qc(inputs):
+    return (inputs.download().drop(columns=['OBJECTID']),)
+
+
+def run_download_qc(download):
+    run_quietly(run_qc, download)
+    return len(download)
+
+
+def prepare_step_1(inputs):
+    return (detect_through(inputs, 0),)
+
+
+def prepare_step_2(inputs):
+    return detect_through(inputs, 1), inputs.ngdal()
+
+
+def prepare_step_3(inputs):
+    return (detect_through(inputs, 2),)
+
+
+def prepare_step_4(inputs):
+    return (detect_through(inputs, 3),)
+
+
+def prepare_step_5(inputs):
+    return (detect_through(inputs, 4), inputs.ngdal(), inputs.ngdstreet(), inputs.linkage(),
+            os.path.join(inputs.workdir, 'step_5.sql'))
+
+
+def prepare_step_6(inputs):
+    return detect_through(inputs, 5), inputs.ngdal(), os.path.join(inputs.workdir, 'step_6.sql')
+
+
+def run_redline_step(step):
+    """Run function of the detect_changes steps that only look at the redline."""
+
+    def run(redline):
+        run_quietly(STEPS[step], redline, UID_FIELD)
+        return len(redline)
+    return run
+
+
+def run_step_2(redline, ngdal):
+    run_quietly(find_geometry_changes, redline, ngdal, UID_FIELD, GEOM_ROUNDING_FACTOR, DISPLACEMENT_TOLERANCE)
+    return len(redline)
+
+
+def run_step_5(redline, ngdal, ngdstreet, linkage, sql_path):
+    with SqlWriter(sql_path, 'NGD.NGD_AL', UID_FIELD, VINTAGE_DATE) as writer:
+        run_quietly(match_street_names, redline, ngdal, ngdstreet, linkage, writer, ChangeLog(), Counter(), UID_FIELD,
+                    DATE_FIELD)
+    return len(redline)
+
+
+def run_step_6(attr_change, ngdal, sql_path):
+    with SqlWriter(sql_path, 'NGD.NGD_AL', UID_FIELD, VINTAGE_DATE) as writer:
+        run_quietly(diff_address_ranges, attr_change, ngdal, writer, ChangeLog(), Counter(), UID_FIELD, DATE_FIELD)
+    return len(attr_change)
+
+
+def prepare_linkage(inputs):
+    return (inputs.data.ec_linkage(),)
+
+
+def run_linkage(links):
+    index = LinkageIndex().update(links)
+    index.resolve(links['NGD_STR_UID_L'].to_numpy(), '_L')
+    return len(links)
+
+
+def prepare_overlaps(inputs):
+    redline = inputs.redline()
+    redline = redline[redline[UID_FIELD].notna()]
+    # topology_check reads the NGD_AL arcs on the streets of the redline
+    ngdal = inputs.data.ngdal
+    on_street = (ngdal['NGD_STR_UID_L'].isin(redline['NGD_STR_UID_L'].dropna())
+                 | ngdal['NGD_STR_UID_R'].isin(redline['NGD_STR_UID_R'].dropna()))
+    return redline, ngdal.loc[on_street, INTERVAL_FIELDS]
+
+
+def run_overlaps(redline, ngdal):
+    find_overlaps(redline, ngdal)
+    return len(redline) + len(ngdal)
+
+
+def prepare_sql_counts(inputs):
+    # the address statements detect_changes would write for the redline
+    sql_path = os.path.join(inputs.workdir, 'counts.sql')
+    run_step_6(detect_through(inputs, 5), inputs.ngdal(), sql_path)
+    return sql_path, os.path.join(inputs.workdir, 'counts.csv')
+
+
+def run_sql_counts(sql_path, csv_path):
+    run_quietly(sqlVariableCounts, sql_path, csv_path, field_list)
+    with open(sql_path) as sql:
+        return sum(1 for _ in sql)
+
+
+# the detect_changes steps that only look at the redline
+STEPS = {1: find_new_geometries, 3: find_rh_diff_flags, 4: find_csd_boundaries}
+
+# every stage in the order they run, as (prepare, run) pairs
+STAGES = {'download_qc': (prepare_download_qc, run_download_qc),
+          'detect_step_1': (prepare_step_1, run_redline_step(1)),
+          'detect_step_2': (prepare_step_2, run_step_2),
+          'detect_step_3': (prepare_step_3, run_redline_step(3)),
+          'detect_step_4': (prepare_step_4, run_redline_step(4)),
+          'detect_step_5': (prepare_step_5, run_step_5),
+          'detect_step_6': (prepare_step_6, run_step_6),
+          'ec_linkage': (prepare_linkage, run_linkage),
+          'topology_overlap': (prepare_overlaps, run_overlaps),
+          'sql_counts': (prepare_sql_counts, run_sql_counts)}
@@ -0,0 +1,338 @@
+# Synthetic NGD_AL, NGD_STREET, EC linkage and redline data for the benchmarks
+#
+# Arcs are laid out the way the NGD_AL is: clustered into CSDs of very different sizes, split into streets of a few
+# consecutive arcs, with odd addresses on the left and even ones on the right counting up along the street. Every
+# column is generated with whole-array operations so 10 million arcs only take a few seconds. Geometries are built on
+# demand from the position of an arc on its street, so only the arcs a stage actually reads are ever materialized.
+#
+# The redline is a sample of arcs with a mix of edits that each end up on a known detect_changes route.
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from attr_diff import ADDRESS_FIELDS, ATTRBT_FIELDS
+
+# share of the arcs in each province, roughly as in the NGD_AL
+PROVINCE_WEIGHTS = {10: 0.02, 11: 0.005, 12: 0.03, 13: 0.03, 24: 0.23, 35: 0.36, 46: 0.04, 47: 0.05, 48: 0.11,
+                    59: 0.12, 60: 0.002, 61: 0.002, 62: 0.001}
+# average number of arcs in a CSD and on a street
+ARCS_PER_CSD = 2000
+ARCS_PER_STREET = 8
+# length of every arc in metres and the house numbers it spans on each side
+ARC_LENGTH = 100.0
+ADDRESS_STEP = 100
+# first NGD_UID, NGD_STR_UID and EC_STR_ID handed out
+NGD_UID_BASE = 1000000
+STREET_UID_BASE = 100000
+EC_ID_BASE = 5000000
+
+STREET_NAMES = ['MAIN', 'KING', 'QUEEN', 'CHURCH', 'PARK', 'MAPLE', 'OAK', 'CEDAR', 'LAKE', 'HILL', 'RIVER',
+                'VICTORIA', 'ELGIN', 'BANK', 'WELLINGTON', 'PRINCIPALE', 'SAINT-JEAN', 'DU LAC', 'FRONT', 'WATER']
+STREET_TYPES = ['ST', 'AVE', 'RD', 'DR', 'CRES', 'BLVD', 'RUE', 'CH']
+STREET_DIRS = ['N', 'S', 'E', 'W']
+
+# share of arcs with an address range, on a CSD boundary, with aliases and whose street has no EC_STR_ID
+ADDRESSED_SHARE = 0.75
+BOUNDARY_SHARE = 0.02
+ALIAS1_SHARE = 0.05
+ALIAS2_SHARE = 0.01
+UNLINKED_SHARE = 0.03
+
+# share of the redline edits of each kind, the kind names the route detect_changes should send them down
+CHANGE_MIX = {'none': 0.30, 'address': 0.20, 'street_rename': 0.10, 'new_street': 0.05, 'alias': 0.03,
+              'new_geometry': 0.10, 'length_change': 0.08, 'displacement': 0.05, 'rh_diff': 0.04, 'csd_boundary': 0.05}
+# share of the edited arcs that were also edited once before in the same pull
+DUPLICATE_SHARE = 0.05
+
+# columns of the NGD_AL frame, the geometry is built separately by SyntheticNgd.arc_lines
+NGDAL_COLUMNS = (['NGD_UID', 'CSD_UID_L', 'CSD_UID_R', 'NGD_STR_UID_L', 'NGD_STR_UID_R', 'NAME_SRC_L', 'NAME_SRC_R',
+                  'EC_STR_ID_L', 'EC_STR_ID_R', 'ALIAS1_STR_UID_L', 'ALIAS1_STR_UID_R', 'ALIAS2_STR_UID_L',
+                  'ALIAS2_STR_UID_R']
+                 + ATTRBT_FIELDS + ADDRESS_FIELDS)
+
+
+def nullable(values, keep):
+    """Float copy of values with NaN wherever keep is False, the way nullable integer columns come out of a GDB."""
+
+    values = values.astype('float64')
+    values[~keep] = np.nan
+    return values
+
+
+def labels(keep, value=None):
+    """Categorical column holding value where keep is set and nulls elsewhere, at one byte per arc."""
+
+    if value is None:
+        return pd.Categorical.from_codes(np.full(len(keep), -1, dtype='int8'), dtype=pd.CategoricalDtype([]))
+    return pd.Categorical.from_codes(np.where(keep, 0, -1).astype('int8'), categories=[value])
+
+
+class SyntheticNgd:
+    """A synthetic NGD_AL of a given number of arcs, with its NGD_STREET table and redline edits."""
+
+    def __init__(self, arcs, seed=0):
+        self.arcs = arcs
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+
+        # CSDs with lognormal sizes give a handful of cities and a long tail of small places
+        csd_count = max(5, arcs // ARCS_PER_CSD)
+        provinces = np.array(list(PROVINCE_WEIGHTS))
+        weights = np.array(list(PROVINCE_WEIGHTS.values()))
+        csd_pr = np.sort(rng.choice(provinces, size=csd_count, p=weights / weights.sum()))
+        order_in_pr = np.arange(csd_count) - np.searchsorted(csd_pr, csd_pr)
+        self.csd_uids = (csd_pr * 100000 + (1 + order_in_pr // 20 % 99) * 1000 + order_in_pr % 20 + 1).astype('int32')
+        sizes = rng.lognormal(0, 1.5, csd_count)
+        csd_arcs = rng.multinomial(arcs, sizes / sizes.sum())
+        # CSDs sit in a band per province, each with room for its streets around its centre
+        self.csd_centre = np.column_stack([(csd_pr - 10) * 100000 + rng.uniform(0, 400000, csd_count),
+                                           rng.uniform(0, 400000, csd_count)])
+        self.csd_radius = np.sqrt(np.maximum(csd_arcs, 1)) * ARC_LENGTH
+
+        # arcs are clustered by CSD and cut into streets of consecutive arcs
+        arc_csd = np.repeat(np.arange(csd_count), csd_arcs)
+        starts = rng.random(arcs) < 1 / ARCS_PER_STREET
+        starts[np.concatenate([[0], np.cumsum(csd_arcs)[:-1]])[csd_arcs > 0]] = True
+        arc_street = (np.cumsum(starts) - 1).astype('int32')
+        street_first = np.flatnonzero(starts)
+        self.arc_street = arc_street
+        self.arc_step = (np.arange(arcs) - street_first[arc_street]).astype('int32')
+        street_count = len(street_first)
+        self.street_csd = arc_csd[street_first]
+        self.street_origin = (self.csd_centre[self.street_csd]
+                              + rng.uniform(-1, 1, (street_count, 2)) * self.csd_radius[self.street_csd, None])
+        self.street_angle = rng.uniform(0, 2 * np.pi, street_count)
+        self.arc_vertices = 2 + rng.integers(0, 4, arcs, dtype='int8')
+
+        # whole streets are addressed, on a boundary with the next CSD or unlinked to EC
+        addressed = (rng.random(street_count) < ADDRESSED_SHARE)[arc_street]
+        boundary_street = (rng.random(street_count) < BOUNDARY_SHARE) & (csd_count > 1)
+        boundary = boundary_street[arc_street]
+        self.street_boundary = boundary_street
+        self.street_linked = rng.random(2 * street_count) >= UNLINKED_SHARE
+        self.street_names = self.name_streets(self.street_csd, rng)
+        street_uid = STREET_UID_BASE + arc_street
+        # the right side of a boundary street is its twin in the neighbouring CSD, numbered after every street
+        right_uid = np.where(boundary, street_uid + street_count, street_uid)
+        csd_uid = self.csd_uids[arc_csd]
+        right_csd = np.where(boundary, self.csd_uids[(arc_csd + 1) % csd_count], csd_uid)
+        # aliases point at the street before in the same CSD
+        alias_street = np.where(self.street_csd[np.maximum(arc_street - 1, 0)] == arc_csd, arc_street - 1, -1)
+        has_alias1 = (rng.random(arcs) < ALIAS1_SHARE) & (alias_street >= 0)
+        has_alias2 = has_alias1 & (rng.random(arcs) < ALIAS2_SHARE / ALIAS1_SHARE)
+        alias_uid = STREET_UID_BASE + alias_street
+
+        step = self.arc_step
+        # UIDs are 32 bit like the Long fields of the geodatabase, text fields are categorical to keep 10 million arcs
+        # in a few GB
+        frame = {'NGD_UID': (NGD_UID_BASE + rng.permutation(arcs)).astype('int32'),
+                 'CSD_UID_L': csd_uid,
+                 'CSD_UID_R': right_csd,
+                 'NGD_STR_UID_L': street_uid.astype('int32'),
+                 'NGD_STR_UID_R': right_uid.astype('int32'),
+                 'NAME_SRC_L': labels(np.ones(arcs, dtype=bool), 'NGD'),
+                 'NAME_SRC_R': labels(np.ones(arcs, dtype=bool), 'NGD'),
+                 'EC_STR_ID_L': nullable(EC_ID_BASE + street_uid, self.street_linked[street_uid - STREET_UID_BASE]),
+                 'EC_STR_ID_R': nullable(EC_ID_BASE + right_uid, self.street_linked[right_uid - STREET_UID_BASE]),
+                 'ALIAS1_STR_UID_L': nullable(alias_uid, has_alias1),
+                 'ALIAS1_STR_UID_R': nullable(alias_uid, has_alias1 & ~boundary),
+                 'ALIAS2_STR_UID_L': nullable(alias_uid, has_alias2),
+                 'ALIAS2_STR_UID_R': nullable(alias_uid, has_alias2 & ~boundary),
+                 'SGMNT_SRC': labels(np.ones(arcs, dtype=bool), 'NGD'),
+                 'ADDR_TYP_L': labels(addressed, 'C'),
+                 'ADDR_TYP_R': labels(addressed, 'C'),
+                 'ADDR_PRTY_L': labels(addressed, 'O'),
+                 'ADDR_PRTY_R': labels(addressed, 'E')}
+        for side, first in (('L', 1), ('R', 2)):
+            frame[f'AF{side}_VAL'] = nullable(first + ADDRESS_STEP * step, addressed)
+            frame[f'AT{side}_VAL'] = nullable(first + ADDRESS_STEP * step + ADDRESS_STEP - 2, addressed)
+            for end in ('AF', 'AT'):
+                frame[f'{end}{side}_SFX'] = labels(np.zeros(arcs, dtype=bool))
+                frame[f'{end}{side}_SRC'] = labels(addressed, 'NGD')
+        self.ngdal = pd.DataFrame(frame)[NGDAL_COLUMNS]
+
+    @staticmethod
+    def name_streets(street_csd, rng):
+        """Name, type and direction of every street, unique within its CSD."""
+
+        # the position of each street within its CSD picks a name and type, with a number once those run out
+        local = np.arange(len(street_csd)) - np.searchsorted(street_csd, street_csd)
+        name_count = len(STREET_NAMES)
+        type_count = len(STREET_TYPES)
+        names = pd.Series(np.array(STREET_NAMES, dtype=object)[local % name_count])
+        repeat = local // (name_count * type_count)
+        names = names.where(repeat == 0, names + ' ' + pd.Series(repeat).astype(str))
+        directions = np.where(rng.random(len(street_csd)) < 0.1,
+                              np.array(STREET_DIRS, dtype=object)[rng.integers(0, len(STREET_DIRS), len(street_csd))],
+                              None)
+        return pd.DataFrame({'STR_NME': names.to_numpy(dtype=object),
+                             'STR_TYP': np.array(STREET_TYPES, dtype=object)[local // name_count % type_count],
+                             'STR_DIR': directions.astype(object)})
+
+    def ngdstreet(self):
+        """The NGD_STREET table, with a twin record in the neighbouring CSD for every boundary street."""
+
+        street_count = len(self.street_csd)
+        streets = self.street_names.assign(NGD_STR_UID=STREET_UID_BASE + np.arange(street_count),
+                                           CSD_UID=self.csd_uids[self.street_csd],
+                                           NAME_SRC='NGD')
+        twins = np.flatnonzero(self.street_boundary)
+        twin_streets = streets.iloc[twins].assign(
+            NGD_STR_UID=STREET_UID_BASE + street_count + twins,
+            CSD_UID=self.csd_uids[(self.street_csd[twins] + 1) % len(self.csd_uids)])
+        columns = ['NGD_STR_UID', 'CSD_UID', 'STR_NME', 'STR_TYP', 'STR_DIR', 'NAME_SRC']
+        return pd.concat([streets, twin_streets], ignore_index=True)[columns]
+
+    def ec_linkage(self):
+        """The NGD_STR_UID to EC_STR_ID pairs of every arc, as held by the NGD_AL."""
+
+        from ec_linkage import LINK_FIELDS
+
+        return self.ngdal[LINK_FIELDS]
+
+    def arc_coords(self, positions):
+        """Vertices of the arcs at positions (row positions in the NGD_AL frame).
+
+        Returns a tuple of (coords, offsets) where arc i is coords[offsets[i]:offsets[i + 1]]. Arcs of a street join
+        end to end and their inner vertices wiggle a few metres off the straight line."""
+
+        positions = np.asarray(positions, dtype='int64')
+        counts = self.arc_vertices[positions]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        owner = np.repeat(positions, counts)
+        vertex = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+        along = (self.arc_step[owner] + vertex / (counts.repeat(counts) - 1)) * ARC_LENGTH
+        inner = (vertex > 0) & (vertex < counts.repeat(counts) - 1)
+        # a hash of the vertex picks the wiggle so the same arc always gets the same shape
+        across = np.where(inner, (owner * 7919 + vertex * 104729) % 1000 / 1000 * 6 - 3, 0.0)
+
+        street = self.arc_street[owner]
+        angle = self.street_angle[street]
+        x = self.street_origin[street, 0] + along * np.cos(angle) - across * np.sin(angle)
+        y = self.street_origin[street, 1] + along * np.sin(angle) + across * np.cos(angle)
+        return np.column_stack([x, y]), offsets
+
+    def arc_lines(self, positions):
+        """Shapely lines of the arcs at positions, as the staged NGD_AL returns them."""
+
+        coords, offsets = self.arc_coords(positions)
+        counts = np.diff(offsets)
+        return shapely.linestrings(coords, indices=np.repeat(np.arange(len(counts)), counts))
+
+    def ngdal_with_shapes(self, positions):
+        """NGD_AL records at positions with their SHAPE."""
+
+        records = self.ngdal.iloc[positions].reset_index(drop=True)
+        records['SHAPE'] = self.arc_lines(positions)
+        return records
+
+    def redline(self, edit_share=0.01, mix=None, duplicate_share=DUPLICATE_SHARE, seed=None):
+        """Redline edits of edit_share of the arcs, as downloaded from AGOL.
+
+        mix maps each kind of edit in CHANGE_MIX to its share. The change_kind column records the kind of every
+        edit and the position column the arc it was made to. SHAPE holds Esri JSON polylines and CSD UIDs are text,
+        the way the redline layer stores them."""
+
+        rng = np.random.default_rng(self.seed + 1 if seed is None else seed)
+        mix = mix or CHANGE_MIX
+        kinds = np.array(list(mix), dtype=object)
+        shares = np.array(list(mix.values()), dtype='float64')
+        edits = max(1, int(self.arcs * edit_share))
+        positions = np.sort(rng.choice(self.arcs, size=min(edits, self.arcs), replace=False))
+        kind = kinds[rng.choice(len(kinds), size=len(positions), p=shares / shares.sum())]
+
+        red = self.ngdal.iloc[positions].reset_index(drop=True)
+        # text comes down from AGOL as plain objects
+        red = red.astype({column: object for column in red.columns if red[column].dtype == 'category'})
+        red['NGD_UID'] = red['NGD_UID'].astype('float64')
+        red['position'] = positions
+        red['change_kind'] = kind
+        street = self.arc_street[positions]
+        red = self.add_street_names(red, street)
+        red['STR_RH_DIFF_FLG'] = 0
+        coords, offsets = self.arc_coords(positions)
+        coords = self.edit_shapes(coords, offsets, kind, street)
+
+        def edited(name):
+            return (kind == name).nonzero()[0]
+
+        red.loc[edited('new_geometry'), 'NGD_UID'] = np.nan
+        red.loc[edited('rh_diff'), 'STR_RH_DIFF_FLG'] = 1
+        boundary = edited('csd_boundary')
+        red.loc[boundary, 'CSD_UID_R'] = self.csd_uids[(self.street_csd[street[boundary]] + 1) % len(self.csd_uids)]
+        # renames take the name of a neighbouring street in the CSD, new streets a name nobody has
+        renamed = edited('street_rename')
+        other = self.neighbour_streets(street[renamed])
+        red.loc[renamed, ['STR_NME', 'STR_TYP', 'STR_DIR']] = self.street_names.iloc[other].to_numpy()
+        new_street = edited('new_street')
+        red.loc[new_street, 'STR_NME'] = [f'NEW STREET {i}' for i in range(len(new_street))]
+        alias = edited('alias')
+        red.loc[alias, ['STR_NME_ALIAS1', 'STR_TYP_ALIAS1', 'STR_DIR_ALIAS1']] = (
+            self.street_names.iloc[self.neighbour_streets(street[alias])].to_numpy())
+        # half of the address edits move the whole range onto the next arc's numbers, the other half trim it
+        address = edited('address')
+        shifted = address[rng.random(len(address)) < 0.5]
+        trimmed = np.setdiff1d(address, shifted)
+        for side in ('L', 'R'):
+            red.loc[shifted, [f'AF{side}_VAL', f'AT{side}_VAL']] += ADDRESS_STEP
+            red.loc[trimmed, f'AT{side}_VAL'] -= 10
+        red.loc[trimmed, 'ADDR_PRTY_L'] = None
+
+        red['CSD_UID_L'] = red['CSD_UID_L'].astype(str)
+        red['CSD_UID_R'] = red['CSD_UID_R'].astype(str)
+        red['SHAPE'] = [{'paths': [coords[start:end].tolist()], 'spatialReference': {'wkid': 3347}}
+                        for start, end in zip(offsets[:-1], offsets[1:])]
+        red['EditDate'] = pd.Timestamp('2020-04-01') + pd.to_timedelta(rng.integers(0, 30 * 86400, len(red)), unit='s')
+        red['CreationDate'] = red['EditDate'] - pd.Timedelta(days=1)
+
+        # an earlier edit of some arcs that the download QC has to drop again
+        earlier = red[red['NGD_UID'].notna()].sample(frac=duplicate_share, random_state=rng.integers(2 ** 31))
+        earlier = earlier.assign(EditDate=earlier['EditDate'] - pd.Timedelta(hours=1), change_kind='duplicate')
+        red = pd.concat([red, earlier], ignore_index=True)
+        red.insert(0, 'OBJECTID', np.arange(1, len(red) + 1))
+        # the redline layer doesn't carry the alias street UIDs
+        return red.drop(columns=['ALIAS1_STR_UID_L', 'ALIAS1_STR_UID_R', 'ALIAS2_STR_UID_L', 'ALIAS2_STR_UID_R'])
+
+    def add_street_names(self, records, street):
+        """Add the left street and alias names of arcs on streets to a frame of NGD_AL records."""
+
+        names = self.street_names.iloc[street].reset_index(drop=True)
+        records = pd.concat([records, names], axis=1)
+        records['NAME_SRC'] = 'NGD'
+        for alias in ('ALIAS1', 'ALIAS2'):
+            uids = records[f'{alias}_STR_UID_L']
+            known = uids.notna().to_numpy()
+            alias_names = self.street_names.iloc[(uids[known] - STREET_UID_BASE).astype(int)].to_numpy()
+            for column, field in enumerate(['STR_NME', 'STR_TYP', 'STR_DIR']):
+                records[f'{field}_{alias}'] = None
+                records.loc[known, f'{field}_{alias}'] = alias_names[:, column]
+        return records
+
+    def neighbour_streets(self, streets):
+        """Another street in the same CSD as each of streets, the same street when it is alone in its CSD."""
+
+        before = np.maximum(streets - 1, 0)
+        after = np.minimum(streets + 1, len(self.street_csd) - 1)
+        csd = self.street_csd[streets]
+        return np.where(self.street_csd[before] == csd, before, np.where(self.street_csd[after] == csd, after, streets))
+
+    def edit_shapes(self, coords, offsets, kind, street):
+        """Apply the geometry edits of kind to the arc vertices: lengthened, shifted sideways or drawn anew."""
+
+        coords = coords.copy()
+        counts = np.diff(offsets)
+        vertex_kind = np.repeat(kind, counts)
+        angle = np.repeat(self.street_angle[street], counts)
+        direction = np.column_stack([np.cos(angle), np.sin(angle)])
+        normal = np.column_stack([-direction[:, 1], direction[:, 0]])
+        # a lengthened arc gets its last vertex pulled 30 m further along the street
+        last = np.zeros(len(coords), dtype=bool)
+        last[offsets[1:] - 1] = True
+        lengthened = last & (vertex_kind == 'length_change')
+        coords[lengthened] += direction[lengthened] * 0.3 * ARC_LENGTH
+        moved = vertex_kind == 'displacement'
+        coords[moved] += normal[moved] * 25
+        new = vertex_kind == 'new_geometry'
+        coords[new] += normal[new] * 60
+        return coords
@@ -0,0 +1,98 @@
+# Structured log of the changes found by detect_changes
+#
+# Every attribute update and every record sent to the geometry workflow becomes one row of a columnar table. The log
+# is stored as a Parquet dataset partitioned by pull date (<log dir>/pull_date=YYYY-MM-DD/part-<run>.parquet), so each
+# run adds a file next to the earlier ones and the whole history can be read back with a single read_parquet call.
+# Writing the log requires pyarrow.
+
+import os
+from datetime import datetime
+
+import pandas as pd
+
+LOG_COLUMNS = ['NGD_UID', 'field', 'old', 'new', 'date_field', 'edit_date', 'route']
+# columns of LOG_COLUMNS stored as text, NGD_UID is an integer and edit_date a timestamp
+TEXT_COLUMNS = ['field', 'old', 'new', 'date_field', 'route']
+
+
+def log_text(value):
+    """Store values as text so the old and new columns keep one type whatever field they came from."""
+
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    # -1 is the filler detect_changes uses for nulls while searching street names
+    if not isinstance(value, str) and value == -1:
+        return None
+    return str(value)
+
+
+class ChangeLog:
+    """Collect change rows during a run and write them out as one partition file."""
+
+    def __init__(self):
+        self._rows = []
+        self._frames = []
+
+    def add(self, uid, field, old, new, date_field, edit_date, route='attribute'):
+        """Log a single change."""
+
+        self._rows.append((uid, field, log_text(old), log_text(new), date_field, edit_date, route))
+
+    def extend(self, changes, route='attribute'):
+        """Log a whole table of changes with uid, field, old, new, date_field and edit_date columns."""
+
+        frame = changes.rename(columns={'uid': 'NGD_UID'})
+        frame = frame.assign(old=frame['old'].map(log_text), new=frame['new'].map(log_text), route=route)
+        self._frames.append(frame[LOG_COLUMNS])
+
+    def add_routes(self, records, uid_field, date_field):
+        """Log every record sent to the geometry workflow with the reason found in its route column."""
+
+        self._frames.append(pd.DataFrame({'NGD_UID': records[uid_field].to_numpy(),
+                                          'field': None,
+                                          'old': None,
+                                          'new': None,
+                                          'date_field': None,
+                                          'edit_date': records[date_field].to_numpy(),
+                                          'route': records['route'].to_numpy()}))
+
+    def frame(self):
+        """Everything logged so far as a single table."""
+
+        frames = [pd.DataFrame(self._rows, columns=LOG_COLUMNS)] + self._frames
+        log = pd.concat([f for f in frames if len(f)] or [frames[0]], ignore_index=True)
+        log['NGD_UID'] = pd.to_numeric(log['NGD_UID']).astype('Int64')
+        log['edit_date'] = pd.to_datetime(log['edit_date'])
+        for column in TEXT_COLUMNS:
+            log[column] = log[column].astype(object)
+        return log
+
+    def write(self, log_dir, pull_date):
+        """Append this run's rows to the log as a new file in the partition of pull_date. Returns the file path."""
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        partition = os.path.join(log_dir, 'pull_date={}'.format(pull_date))
+        os.makedirs(partition, exist_ok=True)
+        path = os.path.join(partition, 'part-{}.parquet'.format(datetime.now().strftime('%Y%m%d%H%M%S%f')))
+        table = pa.Table.from_pandas(self.frame(), schema=log_schema(), preserve_index=False)
+        pq.write_table(table, path)
+        return path
+
+
+def log_schema():
+    """Schema every partition is written with, so a run that logged no attribute changes (and has only nulls in the
+    text columns) still reads back together with the others."""
+
+    import pyarrow as pa
+
+    types = {'NGD_UID': pa.int64(), 'edit_date': pa.timestamp('ns')}
+    return pa.schema([(column, types.get(column, pa.string())) for column in LOG_COLUMNS])
+
+
+def read_change_log(log_dir, pull_dates=None):
+    """Read the change log back, optionally only the given pull dates. pull_date comes back as a column."""
+
+    filters = [('pull_date', 'in', list(pull_dates))] if pull_dates else None
+    return pd.read_parquet(log_dir, filters=filters)
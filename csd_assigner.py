@@ -0,0 +1,140 @@
+# CSD assignment for the left and right side of lines
+#
+# Each line gets sample points a few metres off its left and right side (relative to the direction it was digitized
+# in) and every point is matched to the CSD polygon that holds it through an STRtree over the CSD polygons. This gives
+# the same answer as a one-sided buffer spatially joined to the CSDs without writing any intermediate feature class.
+
+import numpy as np
+import shapely
+
+from geometry_engine import coordinate_buffer
+
+# positions along each line (as fractions of its length) that are sampled, the first one breaks ties
+SAMPLE_FRACTIONS = (0.5, 0.25, 0.75)
+
+
+def as_lines(shapes):
+    """Shapely lines for a sequence of shapes, either shapely geometries or Esri JSON polylines with 'paths'.
+
+    Shapes that are null or have no path of two or more vertices come back as None."""
+
+    shapes = list(shapes)
+    if all(shape is None or isinstance(shape, shapely.Geometry) for shape in shapes):
+        return np.array(shapes, dtype=object)
+
+    coords, offsets, owners = coordinate_buffer(shapes)
+    lines = np.full(len(shapes), None, dtype=object)
+    # a path with a single vertex has no sides to sample, and GEOS won't build a linestring from it
+    vertices = np.diff(offsets)
+    keep = vertices >= 2
+    if not keep.any():
+        return lines
+    coords = coords[np.repeat(keep, vertices)]
+    owners = owners[keep]
+    # one linestring per path, then one multilinestring per shape holding its paths
+    paths = shapely.linestrings(coords, indices=np.repeat(np.arange(len(owners)), vertices[keep]))
+    positions, path_owners = np.unique(owners, return_inverse=True)
+    lines[positions] = shapely.multilinestrings(paths, indices=path_owners)
+    return lines
+
+
+def side_points(lines, fraction, offset):
+    """The points offset metres to the left and right of each line at fraction of its length.
+
+    The side is found from the direction of the line around the sampled position. Returns two arrays of points, None
+    where the line is null or empty."""
+
+    lines = np.asarray(lines, dtype=object)
+    valid = ~shapely.is_missing(lines) & ~shapely.is_empty(lines)
+    left = np.full(len(lines), None, dtype=object)
+    right = np.full(len(lines), None, dtype=object)
+    if not valid.any():
+        return left, right
+
+    valid_lines = lines[valid]
+    length = shapely.length(valid_lines)
+    at = length * fraction
+    # a short step either side of the sample gives the local direction of the line
+    step = np.minimum(0.5, length / 4)
+    before = shapely.get_coordinates(shapely.line_interpolate_point(valid_lines, np.maximum(at - step, 0)))
+    after = shapely.get_coordinates(shapely.line_interpolate_point(valid_lines, np.minimum(at + step, length)))
+    centre = shapely.get_coordinates(shapely.line_interpolate_point(valid_lines, at))
+
+    direction = after - before
+    norm = np.hypot(direction[:, 0], direction[:, 1])
+    norm[norm == 0] = 1.0
+    # the left normal of (dx, dy) is (-dy, dx)
+    normal = np.column_stack([-direction[:, 1], direction[:, 0]]) / norm[:, None] * offset
+    left[valid] = shapely.points(centre + normal)
+    right[valid] = shapely.points(centre - normal)
+    return left, right
+
+
+def vote(samples):
+    """Pick one value per row from an (n, k) array of sampled values: the first one that another sample agrees with,
+    otherwise the first sample that has a value."""
+
+    result = np.full(samples.shape[0], None, dtype=object)
+    decided = np.zeros(samples.shape[0], dtype=bool)
+    present = samples != None
+    for i in range(samples.shape[1]):
+        agreed = np.zeros(samples.shape[0], dtype=bool)
+        for j in range(samples.shape[1]):
+            if i != j:
+                agreed |= present[:, i] & (samples[:, i] == samples[:, j])
+        pick = agreed & ~decided
+        result[pick] = samples[pick, i]
+        decided |= pick
+    for i in range(samples.shape[1]):
+        pick = present[:, i] & ~decided
+        result[pick] = samples[pick, i]
+        decided |= pick
+    return result
+
+
+class CsdAssigner:
+    """Point in polygon lookups of CSD_UIDs backed by an STRtree of the CSD polygons."""
+
+    def __init__(self, csd_uids, polygons):
+        self.csd_uids = np.asarray(csd_uids, dtype=object)
+        self.polygons = np.asarray(polygons, dtype=object)
+        self.tree = shapely.STRtree(self.polygons)
+
+    def lookup(self, points):
+        """CSD_UID of the polygon holding each point, None when no polygon does. A point on a shared boundary gets
+        the first polygon found."""
+
+        points = np.asarray(points, dtype=object)
+        result = np.full(len(points), None, dtype=object)
+        present = ~shapely.is_missing(points)
+        if not present.any():
+            return result
+        positions = np.flatnonzero(present)
+        point_index, polygon_index = self.tree.query(points[present], predicate='intersects')
+        first_point, first = np.unique(point_index, return_index=True)
+        result[positions[first_point]] = self.csd_uids[polygon_index[first]]
+        return result
+
+    def assign(self, shapes, offset=5.0):
+        """CSD_UID on the left and right side of each line, sampled offset metres away from it.
+
+        Returns two object arrays (left, right) with None where no CSD was found."""
+
+        lines = as_lines(shapes)
+        left_samples = []
+        right_samples = []
+        for fraction in SAMPLE_FRACTIONS:
+            left, right = side_points(lines, fraction, offset)
+            left_samples.append(self.lookup(left))
+            right_samples.append(self.lookup(right))
+        return vote(np.column_stack(left_samples)), vote(np.column_stack(right_samples))
+
+
+def load_csd_assigner(source, layer=None, uid_field='CSD_UID', crs='EPSG:3347'):
+    """Build an assigner from a CSD polygon layer, read through the Parquet staging cache."""
+
+    from ngd_staging import read_staged
+
+    csd = read_staged(source, layer, columns=[uid_field, 'SHAPE'], uid_field=uid_field, csd_field=uid_field, crs=crs)
+    csd = csd[~csd.geometry.isna()]
+    return CsdAssigner(csd[uid_field].to_numpy(dtype=object), csd.geometry.to_numpy())
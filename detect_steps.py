@@ -0,0 +1,279 @@
+# The change detection steps of detect_changes
+#
+# Every step is a function over the redline and NGD_AL frames, so detect_changes and the benchmarks run the same code.
+# Steps 1 to 5 route records to the geometry workflow by setting the 'route' column of the redline in place, the
+# reason the record was routed. Steps 5 and 6 send the attribute updates they find to a SqlWriter and a ChangeLog.
+
+import numpy as np
+import pandas as pd
+
+from address_parity import parity_conflicts
+from attr_diff import ADDRESS_FIELDS, ATTRBT_FIELDS, address_date_field, diff_fields
+from csd_assigner import load_csd_assigner
+from geometry_engine import max_displacement, polyline_lengths
+from street_match import STREET_NAME_SEARCHERS, build_street_index, resolve_street_uids
+
+# NGD_AL alias street UIDs, which the redline layer doesn't carry
+ALIAS_UID_FIELDS = ['ALIAS1_STR_UID_L', 'ALIAS1_STR_UID_R', 'ALIAS2_STR_UID_L', 'ALIAS2_STR_UID_R']
+# NGD_AL fields the street name updates of step 5 replace, read so the change log holds their old values
+STREET_LOG_FIELDS = ['NGD_STR_UID_L', 'NGD_STR_UID_R', 'NAME_SRC_L', 'NAME_SRC_R', 'EC_STR_ID_L', 'EC_STR_ID_R']
+# the only NGD_AL fields besides the NGD_UID that any step reads
+NGDAL_FIELDS = ALIAS_UID_FIELDS + STREET_LOG_FIELDS + ATTRBT_FIELDS + ADDRESS_FIELDS + ['SHAPE']
+
+
+def route_records(records, uids, reason, uid_field='NGD_UID'):
+    """Route every record that has no route yet and whose NGD_UID is in uids to the geometry workflow."""
+
+    mask = records['route'].isna() & records[uid_field].isin(uids)
+    records.loc[mask, 'route'] = reason
+
+
+def route_counts(records):
+    """Number of records sent down each route, with attribute changes counted as 'attribute'."""
+
+    return records['route'].fillna('attribute').value_counts().to_dict()
+
+
+def find_new_geometries(redline, uid_field='NGD_UID', csd_path=None, csd_layer=None):
+    """Step 1 - route the records without an NGD_UID as new geometries and make the CSD UIDs numeric.
+
+    New geometries missing a CSD on a side get one from the CSD polygons at csd_path when it is given, which also
+    shows the new boundary arcs."""
+
+    # Every record carries the reason it was routed to the geometry workflow, records without a route are attribute
+    # changes
+    redline['route'] = None
+
+    print("Looking for new geometries...")
+    redline.loc[redline[uid_field].isna(), 'route'] = 'new_geometry'
+
+    # With geometry changes isolated, some cleaning can be applied to the remaining redline data
+    redline['CSD_UID_L'] = pd.to_numeric(redline['CSD_UID_L'])
+    redline['CSD_UID_R'] = pd.to_numeric(redline['CSD_UID_R'])
+
+    new_geometry = (redline['route'] == 'new_geometry').to_numpy()
+    no_csd = new_geometry & (redline['CSD_UID_L'].isna() | redline['CSD_UID_R'].isna()).to_numpy()
+    if csd_path and no_csd.any():
+        print("Assigning CSD_UIDs to", no_csd.sum(), "new geometries.")
+        csd_l, csd_r = load_csd_assigner(csd_path, csd_layer).assign(redline.loc[no_csd, 'SHAPE'])
+        for side, csd_uids in [('L', csd_l), ('R', csd_r)]:
+            field = 'CSD_UID_' + side
+            found = pd.Series(pd.to_numeric(csd_uids), index=redline.index[no_csd])
+            redline.loc[no_csd, field] = redline.loc[no_csd, field].fillna(found)
+    on_boundary = (redline['CSD_UID_L'].notna() & redline['CSD_UID_R'].notna()
+                   & (redline['CSD_UID_L'] != redline['CSD_UID_R']))
+    print("New geometries on a CSD boundary:", (new_geometry & on_boundary.to_numpy()).sum())
+
+    print("Routes:", route_counts(redline))
+
+
+def find_geometry_changes(redline, ngdal, uid_field='NGD_UID', rounding_factor=0.1, displacement_tolerance=10):
+    """Step 2 - route the records whose length changed past the rounding of rounding_factor, or that strayed further
+    than displacement_tolerance metres from their NGD_AL line."""
+
+    print("Looking for changed geometries...")
+    print("Using length change tolerance of", rounding_factor)
+
+    # measure every line in one batched pass per data frame: the redline holds Esri JSON shapes and the NGD_AL the
+    # shapely geometries of the staging cache
+    unrouted = redline['route'].isna()
+    redline['geom'] = np.nan
+    redline.loc[unrouted, 'geom'] = polyline_lengths(redline.loc[unrouted, 'SHAPE'])
+    redline['geom_threshold'] = round((redline['geom'] * rounding_factor), 0)
+
+    ngdal['geom'] = polyline_lengths(ngdal['SHAPE'])
+    ngdal['length_threshold'] = round((ngdal['geom'] * rounding_factor), 0)
+
+    print("Comparing redline vs NGD_AL geometry lengths.")
+    geom_change_detect = (redline.loc[unrouted, [uid_field, 'geom_threshold']]
+                         .merge(ngdal[[uid_field, 'length_threshold']], on=uid_field))
+    is_geom_change = geom_change_detect[geom_change_detect['geom_threshold'] != geom_change_detect['length_threshold']]
+    route_records(redline, is_geom_change[uid_field], 'length_change', uid_field)
+
+    # lines can be moved or reshaped without their length changing, so also measure how far the redline line strays from
+    # the NGD_AL line (the furthest vertex of either from the other)
+    print("Comparing redline vs NGD_AL geometry positions with a tolerance of", displacement_tolerance, "m.")
+    unrouted = redline['route'].isna()
+    ngdal_shapes = ngdal.drop_duplicates(subset=uid_field).set_index(uid_field)['SHAPE']
+    paired_shapes = ngdal_shapes.reindex(redline.loc[unrouted, uid_field])
+    displacement = max_displacement(redline.loc[unrouted, 'SHAPE'], paired_shapes.where(paired_shapes.notna(), None))
+    redline['displacement'] = np.nan
+    redline.loc[unrouted, 'displacement'] = displacement
+    route_records(redline, redline.loc[redline['displacement'] > displacement_tolerance, uid_field], 'displacement',
+                  uid_field)
+
+    print("Routes:", route_counts(redline))
+
+
+def find_rh_diff_flags(redline, uid_field='NGD_UID'):
+    """Step 3 - route the records flagged as having a different street name on either side of the arc."""
+
+    print("Looking for right side street name difference flag...")
+    diff_rh = redline['route'].isna() & (redline['STR_RH_DIFF_FLG'] == 1)
+    route_records(redline, redline.loc[diff_rh, uid_field], 'rh_diff_flag', uid_field)
+
+    print("Routes:", route_counts(redline))
+
+
+def find_csd_boundaries(redline, uid_field='NGD_UID'):
+    """Step 4 - route the records whose CSD_UID L/R values don't match, boundary arcs take the new geometry process."""
+
+    print("Looking for CSD boundary arcs...")
+    csd_mask = redline['route'].isna() & (redline['CSD_UID_L'] != redline['CSD_UID_R'])
+    route_records(redline, redline.loc[csd_mask, uid_field], 'csd_boundary', uid_field)
+
+    print("Routes:", route_counts(redline))
+
+
+def match_street_names(redline, ngdal, ngdstreet, linkage, sql_writer, change_log, change_type, uid_field='NGD_UID',
+                       date_field='EditDate'):
+    """Step 5 - look for changes in street names among the records that haven't been routed yet.
+
+    Names found in the NGD_STREET become street UID updates (with their name source and EC_STR_ID), names that
+    aren't there route the record as a new street. change_type counts the outcomes. Returns the records left for the
+    attribute comparison of step 6."""
+
+    attr_change = redline.loc[redline['route'].isna()].copy()
+    attr_change[uid_field] = attr_change[uid_field].astype(int)
+
+    print("Looking for changes in street names")
+
+    ngdstreet = ngdstreet.fillna(-1)
+    # index the street names once so every searcher can resolve its groups with a join instead of scanning the table
+    street_index = build_street_index(ngdstreet)
+
+    print("Filling NULL values with -1 to enable searching")
+    attr_change = attr_change.fillna(-1)
+
+    # NGD_AL values by NGD_UID, the old values of the street updates logged below
+    ngdal_by_uid = ngdal.drop_duplicates(subset=uid_field).set_index(uid_field)
+    # iterate through the search criteria, looking for street updates
+    for searcher in STREET_NAME_SEARCHERS:
+        print("Processing redline based on", searcher['grouper'])
+        groups = attr_change.groupby(searcher['grouper'], sort=False)
+        street_matches = resolve_street_uids(attr_change[searcher['grouper']], street_index)
+        # EC street IDs of every matched street, resolved in one call for the searchers that update a street UID
+        ec_matches = {}
+        if searcher['ngdal_uid_field'].startswith('NGD_STR_UID'):
+            matched_uids = list(street_matches.values())
+            ec_matches = dict(zip(matched_uids, linkage.resolve(matched_uids, searcher['grouper'][0][-2:])))
+
+        for name, group in groups:
+            # if this is all null values skip it (nulls were filled with -1, remember)
+            if (name[1] == -1 and name[2] == -1 and name[3] == -1):
+                # this is a null record, don't waste time looking for a match
+                continue
+
+            # look for a match in the NGD_STREET data
+            street_uid = street_matches.get(name)
+
+            if street_uid is not None:
+                # found a match, the index already holds the street ID from the first record
+
+                # If the UIDs already match then this was a no change
+                if (group[searcher['redline_uid_field']] == street_uid).all():
+                    change_type['same'] += 1
+                    continue
+
+                # this is an attribute update
+                change_type['update'] += 1
+                edit_date = group[date_field].tolist()[0]
+                uid = group[uid_field].tolist()[0]
+                sql_writer.update(uid, [(searcher['ngdal_uid_field'], street_uid), (searcher['date_field'], 'sysdate')],
+                                  searcher['date_field'])
+                change_log.add(uid, searcher['ngdal_uid_field'], ngdal_by_uid[searcher['ngdal_uid_field']].get(uid),
+                               street_uid, searcher['date_field'], edit_date)
+
+                # name changes also have a source attribute that needs to be updated
+                if searcher['grouper'][1] == 'STR_NME':
+                    src_side = searcher['grouper'][0][-2:]
+                    name_source_field = f'NAME_SRC{src_side}'
+                    name_source_value = group['NAME_SRC'].tolist()[0]
+                    # If the user left it blank, set to 'NGD'
+                    if name_source_value == -1:
+                        name_source_value = 'NGD'
+                    sql_writer.update(uid, [(name_source_field, f"'{name_source_value}'")], searcher['date_field'])
+                    change_log.add(uid, name_source_field, ngdal_by_uid[name_source_field].get(uid), name_source_value,
+                                   searcher['date_field'], edit_date)
+
+                # reset EC name UID attributes to trigger a change on their side
+                if searcher['ngdal_uid_field'].startswith('NGD_STR_UID'):
+                    ec_field_name = searcher['ngdal_uid_field'].replace('NGD_STR_UID', 'EC_STR_ID')
+                    src_side = searcher['grouper'][0][-2:]
+                    # Add the EC_STREET_ID linked to the new street to the statement
+                    ec_str_id = ec_matches.get(street_uid, pd.NA)
+                    if pd.isna(ec_str_id):
+                        change_type['ec_missing'] += 1
+                        print(f'No EC_STR_ID linked to NGD_STR_UID{src_side} {street_uid}, {ec_field_name} not set for',
+                              uid)
+                    else:
+                        ec_str_id = int(ec_str_id)
+                        sql_writer.update(uid, [(ec_field_name, ec_str_id)], searcher['date_field'])
+                        change_log.add(uid, ec_field_name, ngdal_by_uid[ec_field_name].get(uid), ec_str_id,
+                                       searcher['date_field'], edit_date)
+
+            else:
+                # this is a new street name so it is added to the new geometries workflow
+                change_type['geom'] += 1
+                # records already in the geometry workflow keep their original route
+                route_records(redline, group[uid_field], 'new_street', uid_field)
+
+        print("Changes:", change_type)
+    # remove any geometries that were added onto the new geometry workflow
+    attr_change = attr_change[~attr_change[uid_field].isin(redline.loc[redline['route'].notna(), uid_field])]
+    # reset the filler values
+    return attr_change.replace(-1, np.nan)
+
+
+def write_address_updates(changes, sql_writer, change_log, date_field='EditDate'):
+    """Send a table of changes produced by attr_diff.diff_fields to the SQL writer and the change log."""
+
+    change_log.extend(changes.rename(columns={date_field: 'edit_date'}))
+    for change in changes.itertuples(index=False):
+        red_val = change.new
+        # need to put quotes on string values for the SQL query
+        if type(red_val) is str:
+            red_val = f"'{red_val}'"
+        # -1 values are due to the fillna operation, so set those to NULL
+        if red_val == -1 or red_val == None:
+            red_val = "NULL"
+        sql_writer.update(change.uid, [(change.field, red_val), (change.date_field, 'sysdate')], change.date_field)
+
+
+def diff_address_ranges(attr_change, ngdal, sql_writer, change_log, change_type, uid_field='NGD_UID',
+                        date_field='EditDate'):
+    """Step 6 - look for changes to the attribute and address range fields of the records left by step 5.
+
+    Returns the number of field updates written."""
+
+    print("Looking for changes to address range attributes...")
+
+    # process the fields that set the ATTRBT_DTE field when they change
+    target_date_field = 'ATTRBT_DTE'
+    print(f"Processing fields that set {target_date_field}.")
+    changes, donotexist, same = diff_fields(attr_change, ngdal, uid_field,
+                                           {f: target_date_field for f in ATTRBT_FIELDS}, carry=[date_field])
+    # warn about parity updates that don't agree with the address range they describe
+    for side in ['L', 'R']:
+        prty_uids = changes.loc[changes['field'] == f'ADDR_PRTY_{side}', 'uid']
+        conflicts = attr_change.loc[parity_conflicts(attr_change, side) & attr_change[uid_field].isin(prty_uids)]
+        if len(conflicts):
+            print(f'ADDR_PRTY_{side} does not match the address range for:', conflicts[uid_field].tolist())
+    write_address_updates(changes, sql_writer, change_log, date_field)
+    updates = len(changes)
+    change_type['update'] += len(changes)
+    change_type['same'] += same
+    print(f'DO NOT EXIST: {donotexist}')
+    print("Changes:", change_type)
+    # process address values on the NGD_AL, which have a date field that matches their name
+    print(f"Processing address fields.")
+    # determine the name of the date field based on the field value being set
+    changes, donotexist2, same = diff_fields(attr_change, ngdal, uid_field,
+                                            {f: address_date_field(f) for f in ADDRESS_FIELDS}, carry=[date_field])
+    write_address_updates(changes, sql_writer, change_log, date_field)
+    updates += len(changes)
+    change_type['update'] += len(changes)
+    change_type['same'] += same
+    print(f'DO NOT EXIST2: {donotexist2}')
+    print("Changes:", change_type)
+    return updates
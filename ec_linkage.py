@@ -0,0 +1,120 @@
+# Indexed NGD_STR_UID to EC_STR_ID linkage
+#
+# The NGD_AL links the street UID on each side of an arc to an EC street ID. Rather than scanning a csv export of those
+# four columns for every street UID update, the pairs of each side are kept as sorted NumPy arrays in a small .npz file
+# next to the NGD_AL stage. The file records the stage it was built from so it is rebuilt whenever a new vintage of the
+# NGD_AL is staged, and a whole array of street UIDs is resolved with a single binary search.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from ngd_staging import cache_root, ensure_stage, iter_staged, stage_path
+
+SIDES = ['_L', '_R']
+LINK_FIELDS = ['NGD_STR_UID_L', 'NGD_STR_UID_R', 'EC_STR_ID_L', 'EC_STR_ID_R']
+# bump when the layout of the index file changes so older files are rebuilt
+INDEX_FORMAT = 1
+
+
+class LinkageIndex:
+    """Sorted street UID and EC street ID arrays for each side of the NGD_AL."""
+
+    def __init__(self, sides=None, version=None):
+        empty = np.empty(0, dtype='int64')
+        self.sides = sides or {side: (empty, empty) for side in SIDES}
+        self.version = version
+
+    def __len__(self):
+        return sum(len(uids) for uids, _ in self.sides.values())
+
+    def update(self, records):
+        """Add the pairs found in a frame with the LINK_FIELDS columns, skipping the ones with a null on either side.
+
+        A street UID already in the index keeps its EC street ID and within records the first pair read wins, so the
+        index can be built one chunk at a time."""
+
+        for side in SIDES:
+            ngd = pd.to_numeric(records[f'NGD_STR_UID{side}'], errors='coerce')
+            ec = pd.to_numeric(records[f'EC_STR_ID{side}'], errors='coerce')
+            keep = (ngd.notna() & ec.notna()).to_numpy()
+            old_ngd, old_ec = self.sides[side]
+            all_ngd = np.concatenate([old_ngd, ngd.to_numpy(dtype='float64')[keep].astype('int64')])
+            all_ec = np.concatenate([old_ec, ec.to_numpy(dtype='float64')[keep].astype('int64')])
+            # np.unique gives the first position of every UID, which is the existing pair when there is one
+            uids, first = np.unique(all_ngd, return_index=True)
+            self.sides[side] = (uids, all_ec[first])
+        return self
+
+    def resolve(self, uids, side):
+        """EC street IDs of an array of street UIDs on side ('_L' or '_R').
+
+        Returns an Int64 array with <NA> for every street UID that is null or not in the index."""
+
+        ngd, ec = self.sides[side]
+        values = pd.to_numeric(pd.Series(uids, dtype=object), errors='coerce').to_numpy(dtype='float64')
+        known = np.flatnonzero(~np.isnan(values))
+        lookup = values[known].astype('int64')
+
+        result = pd.array(np.full(len(values), pd.NA), dtype='Int64')
+        if len(ngd) == 0 or len(lookup) == 0:
+            return result
+        positions = np.minimum(np.searchsorted(ngd, lookup), len(ngd) - 1)
+        found = ngd[positions] == lookup
+        result[known[found]] = ec[positions[found]]
+        return result
+
+    def save(self, path):
+        """Write the index to an .npz file, replacing any older file in one step."""
+
+        arrays = {'format': INDEX_FORMAT, 'version': str(self.version)}
+        for side in SIDES:
+            arrays[f'ngd{side}'], arrays[f'ec{side}'] = self.sides[side]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save, or None when it was written in another format."""
+
+        with np.load(path) as arrays:
+            if int(arrays['format']) != INDEX_FORMAT:
+                return None
+            return cls({side: (arrays[f'ngd{side}'], arrays[f'ec{side}']) for side in SIDES}, str(arrays['version']))
+
+
+def index_path(source, layer=None, cache_dir=None):
+    """Location of the linkage index of an NGD_AL source and the stage version it has to match."""
+
+    path, prefix = stage_path(str(source), layer, cache_dir)
+    return os.path.join(cache_root(cache_dir), 'ec_links_' + prefix.rstrip('_') + '.npz'), os.path.basename(path)
+
+
+def build_linkage_index(source, layer=None, cache_dir=None, chunk_size=500000):
+    """Build the linkage index from the NGD_AL stage, staging the NGD_AL first when needed."""
+
+    version = os.path.basename(ensure_stage(source, layer, cache_dir=cache_dir))
+    index = LinkageIndex(version=version)
+    for chunk in iter_staged(source, layer, LINK_FIELDS, chunk_size, cache_dir=cache_dir):
+        index.update(chunk)
+    return index
+
+
+def load_linkage_index(source, layer=None, cache_dir=None):
+    """The linkage index of the NGD_AL as it is now: read from disk when it is up to date, rebuilt and saved
+    otherwise."""
+
+    path, version = index_path(source, layer, cache_dir)
+    if os.path.exists(path):
+        index = LinkageIndex.load(path)
+        if index is not None and index.version == version:
+            return index
+
+    print('Building NGD_STR_UID and EC_STR_ID linkage index at', path)
+    index = build_linkage_index(source, layer, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    index.save(path)
+    return index
@@ -0,0 +1,186 @@
+# Batched geometry helpers for comparing redline and NGD_AL shapes
+#
+# Building an arcgis Polyline for every row just to read its length is the slowest part of a national change detection
+# run. These helpers pull the path coordinates of a whole column of shapes into one flat NumPy buffer and do the maths
+# on every segment at once.
+
+import numpy as np
+
+# most point to segment pairs measured at once by max_displacement, bounds its memory use
+PAIR_CHUNK = 2000000
+
+
+def coordinate_buffer(shapes):
+    """Flatten the paths of a sequence of polyline shapes into one coordinate buffer.
+
+    Shapes can be Esri JSON polylines (with 'paths') or shapely lines. Returns a tuple of (coords, offsets, owners)
+    where coords is an (n, 2) float array of every vertex, offsets marks where each path starts and ends in coords
+    (path i is coords[offsets[i]:offsets[i + 1]]) and owners gives the position of the shape each path belongs to.
+    Shapes that are null or have no paths contribute nothing."""
+
+    shapes = list(shapes)
+    if shapes and all(is_shapely(shape) or shape is None for shape in shapes):
+        return shapely_buffer(shapes)
+
+    xs = []
+    ys = []
+    offsets = [0]
+    owners = []
+    for position, shape in enumerate(shapes):
+        # null geometries and curves (no 'paths' key) are left for the caller to handle
+        if not shape:
+            continue
+        if is_shapely(shape):
+            paths = [line.coords for line in (shape.geoms if hasattr(shape, 'geoms') else [shape])]
+        else:
+            paths = shape.get('paths') if hasattr(shape, 'get') else None
+        if not paths:
+            continue
+        for path in paths:
+            for point in path:
+                xs.append(point[0])
+                ys.append(point[1])
+            offsets.append(len(xs))
+            owners.append(position)
+
+    coords = np.column_stack([np.asarray(xs, dtype='float64'), np.asarray(ys, dtype='float64')])
+    return coords, np.asarray(offsets, dtype='int64'), np.asarray(owners, dtype='int64')
+
+
+def is_shapely(shape):
+    return type(shape).__module__.startswith('shapely')
+
+
+def shapely_buffer(shapes):
+    """coordinate_buffer for a sequence of shapely lines (or None), without a Python loop over the shapes."""
+
+    import shapely
+
+    geoms = np.array(shapes, dtype=object)
+    parts, owners = shapely.get_parts(geoms, return_index=True)
+    keep = ~shapely.is_empty(parts)
+    parts = parts[keep]
+    owners = owners[keep]
+    coords, part_index = shapely.get_coordinates(parts, return_index=True)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(part_index, minlength=len(parts)))])
+    return coords.astype('float64'), offsets.astype('int64'), np.asarray(owners, dtype='int64')
+
+
+def path_lengths(coords, offsets):
+    """Planar length of every path in a coordinate buffer, computed in a single pass over all segments."""
+
+    path_count = len(offsets) - 1
+    if path_count <= 0 or len(coords) < 2:
+        return np.zeros(max(path_count, 0), dtype='float64')
+
+    segments = np.hypot(np.diff(coords[:, 0]), np.diff(coords[:, 1]))
+    # a segment that ends on the first vertex of the next path joins two different paths, so it doesn't count
+    segments[offsets[1:-1][offsets[1:-1] > 0] - 1] = 0.0
+    running = np.concatenate([[0.0], np.cumsum(segments)])
+
+    starts = offsets[:-1]
+    ends = np.maximum(offsets[1:] - 1, starts)
+    return running[ends] - running[starts]
+
+
+def polyline_lengths(shapes):
+    """Length of each polyline in shapes, matching Polyline(shape).length for every row.
+
+    Shapes without paths (nulls, true curves) fall back to the geometry's own length property, or NaN when there is
+    nothing to measure. Shapely lines, as read from the staging cache, are measured by GEOS in a single call."""
+
+    shapes = list(shapes)
+    if shapes and all(is_shapely(shape) or shape is None for shape in shapes):
+        import shapely
+        # null geometries measure as NaN, like the Esri shapes without paths
+        return shapely.length(np.array(shapes, dtype=object)).astype('float64')
+
+    coords, offsets, owners = coordinate_buffer(shapes)
+    lengths = np.bincount(owners, weights=path_lengths(coords, offsets), minlength=len(shapes))
+
+    has_paths = np.zeros(len(shapes), dtype=bool)
+    has_paths[owners] = True
+    for position in np.flatnonzero(~has_paths):
+        shape = shapes[position]
+        lengths[position] = getattr(shape, 'length', np.nan) if shape else np.nan
+    return lengths
+
+
+def path_segments(coords, offsets, owners):
+    """Start and end vertex positions of every segment in a coordinate buffer, with the shape each belongs to.
+
+    A path with a single vertex becomes one zero length segment so it can still be measured against."""
+
+    first = offsets[:-1]
+    vertices = offsets[1:] - first
+    counts = np.maximum(vertices - 1, 1)
+    starts = np.repeat(first, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    ends = np.where(np.repeat(vertices == 1, counts), starts, starts + 1)
+    return starts, ends, np.repeat(owners, counts)
+
+
+def directed_displacement(a, b, count):
+    """For every shape, the largest distance from one of its vertices in buffer a to the nearest segment of the same
+    shape in buffer b. a and b are (coords, offsets, owners) tuples from coordinate_buffer. Returns count values, NaN
+    for shapes missing from either buffer."""
+
+    a_coords, a_offsets, a_owners = a
+    b_coords, b_offsets, b_owners = b
+    result = np.full(count, np.nan)
+    if len(a_owners) == 0 or len(b_owners) == 0:
+        return result
+
+    point_owner = np.repeat(a_owners, np.diff(a_offsets))
+    seg_start, seg_end, seg_owner = path_segments(b_coords, b_offsets, b_owners)
+    order = np.argsort(seg_owner, kind='stable')
+    seg_start = seg_start[order]
+    seg_end = seg_end[order]
+    seg_count = np.bincount(seg_owner, minlength=count)
+    seg_first = np.cumsum(seg_count) - seg_count
+
+    # every vertex is measured against every segment of its shape, as many vertices at a time as fit in PAIR_CHUNK
+    pairs_per_point = seg_count[point_owner]
+    cumulative = np.cumsum(pairs_per_point)
+    nearest = np.full(len(point_owner), np.nan)
+    start = 0
+    while start < len(point_owner):
+        done = cumulative[start - 1] if start else 0
+        stop = max(int(np.searchsorted(cumulative, done + PAIR_CHUNK, side='right')), start + 1)
+        points = np.arange(start, stop)
+        start = stop
+        pairs = pairs_per_point[points]
+        if pairs.sum() == 0:
+            continue
+        pair_point = np.repeat(points, pairs)
+        step = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+        pair_seg = np.repeat(seg_first[point_owner[points]], pairs) + step
+
+        p = a_coords[pair_point]
+        s0 = b_coords[seg_start[pair_seg]]
+        d = b_coords[seg_end[pair_seg]] - s0
+        length2 = (d * d).sum(axis=1)
+        t = np.clip(((p - s0) * d).sum(axis=1) / np.where(length2 == 0, 1.0, length2), 0.0, 1.0)
+        gap = p - (s0 + d * t[:, None])
+        distance = np.hypot(gap[:, 0], gap[:, 1])
+
+        # pairs are grouped by vertex, so the nearest segment of each vertex is the minimum over its run of pairs
+        measured = pairs > 0
+        runs = (np.cumsum(pairs) - pairs)[measured]
+        nearest[points[measured]] = np.minimum.reduceat(distance, runs)
+
+    measured = ~np.isnan(nearest)
+    np.fmax.at(result, point_owner[measured], nearest[measured])
+    return result
+
+
+def max_displacement(shapes_a, shapes_b):
+    """Discrete Hausdorff distance between each pair of polylines in shapes_a and shapes_b, in the units of their
+    coordinates: how far the furthest vertex of either line is from the other line.
+
+    Unlike a length comparison this catches lines that were moved or reshaped without changing length. Pairs where
+    either shape is null come back as NaN."""
+
+    shapes_a = list(shapes_a)
+    a = coordinate_buffer(shapes_a)
+    b = coordinate_buffer(shapes_b)
+    return np.maximum(directed_displacement(a, b, len(shapes_a)), directed_displacement(b, a, len(shapes_a)))
@@ -0,0 +1,320 @@
+# Stage timing and memory instrumentation shared by the scripts
+#
+# A script calls start_run once and wraps each of its steps in a stage (a context manager, or the timed decorator for
+# functions). A stage records its wall time, CPU time, peak memory and the rows it read and wrote, and is appended as
+# one JSON line to the metrics log named by NGD_METRICS_LOG as soon as it ends. Counters, such as the change_type
+# counter of detect_changes, are recorded the same way. When the script exits a summary table of its stages is
+# printed, so the step that dominates a pull shows without adding print statements.
+#
+# On Linux the peak RSS of the process is reset when a stage starts, so the peak of a stage is its own. Elsewhere it
+# is the peak of the whole process so far, read through psutil when it is installed.
+#
+# Stages can run on several threads at once, such as the loaders detect_changes starts in the background. Every thread
+# nests its stages on its own, and only stages of the main thread reset the peak RSS: the peak of a stage on another
+# thread is that of the process since the last reset, and is logged with a 'process' peak scope.
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from functools import wraps
+
+# file the JSON lines are appended to, nothing is written when it isn't set
+METRICS_LOG_ENV = 'NGD_METRICS_LOG'
+# run ID handed down to worker processes so their stages are logged under the run that started them
+RUN_ID_ENV = 'NGD_METRICS_RUN_ID'
+
+# run of this process, see start_run and current_run
+_run = None
+
+
+def status_kb(field):
+    """A memory figure of this process from /proc/self/status in kB, None where there is no /proc."""
+
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process so it only covers what runs next. Returns False where that isn't possible."""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def memory_mb():
+    """Current and peak RSS of this process in MB, None for what the platform doesn't report."""
+
+    rss = status_kb('VmRSS')
+    if rss is not None:
+        return rss / 1024, status_kb('VmHWM') / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None, None
+    info = psutil.Process().memory_info()
+    # Windows reports the peak working set, other platforms only the current RSS
+    return info.rss / 2 ** 20, getattr(info, 'peak_wset', info.rss) / 2 ** 20
+
+
+def rounded(value, digits=1):
+    return None if value is None else round(value, digits)
+
+
+class Stage:
+    """One measured step of a run. rows_in and rows_out can be set (or added to with count) while it runs."""
+
+    def __init__(self, run, name, rows_in=None, rows_out=None):
+        self.run = run
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.parent = None
+        self.peak_mb = None
+        # whether the stage runs on the main thread, the only one that resets the peak RSS
+        self.on_main = None
+
+    def count(self, rows_in=0, rows_out=0):
+        """Add to the input and output row counts."""
+
+        if rows_in:
+            self.rows_in = (self.rows_in or 0) + rows_in
+        if rows_out:
+            self.rows_out = (self.rows_out or 0) + rows_out
+
+    def __enter__(self):
+        self.run._enter(self)
+        self.started = datetime.now()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        self.run._exit(self, wall, cpu, exc_type)
+        return False
+
+    def path(self):
+        """Names of the stage and the stages it runs in, outermost first."""
+
+        return (self.parent.path() if self.parent else ()) + (self.name,)
+
+
+class Metrics:
+    """The stages and counters recorded by one run of a script."""
+
+    def __init__(self, script, log_path=None, run_id=None):
+        self.script = script
+        self.log_path = log_path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.records = []
+        self.counters = {}
+        self.started = datetime.now()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        # stages open on each thread, innermost last
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # order in which every stage path first started, for the summary
+        self._order = {}
+        self._resettable = reset_peak_rss()
+        self._finished = False
+
+    def stage(self, name, rows_in=None, rows_out=None):
+        """Context manager measuring the code it wraps as the stage name."""
+
+        return Stage(self, name, rows_in, rows_out)
+
+    def _opened(self):
+        """The stages open on the calling thread."""
+
+        if not hasattr(self._local, 'open'):
+            self._local.open = []
+        return self._local.open
+
+    def _enter(self, stage):
+        opened = self._opened()
+        stage.parent = opened[-1] if opened else None
+        stage.on_main = threading.current_thread() is threading.main_thread()
+        with self._lock:
+            self._order.setdefault('/'.join(stage.path()), len(self._order))
+        if self._resettable and stage.on_main:
+            # the peak so far belongs to the stage running now, before the new stage takes the counter over
+            if stage.parent is not None:
+                stage.parent.peak_mb = max(stage.parent.peak_mb or 0, memory_mb()[1])
+            reset_peak_rss()
+        opened.append(stage)
+
+    def _exit(self, stage, wall, cpu, exc_type):
+        self._opened().remove(stage)
+        rss, peak = memory_mb()
+        if peak is not None:
+            stage.peak_mb = max(stage.peak_mb or 0, peak)
+            if stage.parent is not None:
+                stage.parent.peak_mb = max(stage.parent.peak_mb or 0, stage.peak_mb)
+        rows = stage.rows_out if stage.rows_out is not None else stage.rows_in
+        record = {'type': 'stage',
+                  'stage': stage.name,
+                  'path': '/'.join(stage.path()),
+                  'started': stage.started.isoformat(timespec='seconds'),
+                  'wall_seconds': round(wall, 4),
+                  'cpu_seconds': round(cpu, 4),
+                  'peak_rss_mb': rounded(stage.peak_mb),
+                  'peak_scope': 'stage' if self._resettable and stage.on_main else 'process',
+                  'rss_mb': rounded(rss),
+                  'rows_in': None if stage.rows_in is None else int(stage.rows_in),
+                  'rows_out': None if stage.rows_out is None else int(stage.rows_out),
+                  'rows_per_second': round(rows / wall, 1) if rows and wall > 0 else None}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        with self._lock:
+            self.records.append(record)
+        self.emit(record)
+
+    def timed(self, name=None, rows_in=None, rows_out=None):
+        """Decorator measuring every call of a function as a stage, named after the function unless name is given.
+
+        rows_in is called with the first argument of the call and rows_out with its result to count rows, so len
+        counts tables on both ends."""
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__) as stage:
+                    if rows_in is not None:
+                        stage.rows_in = rows_in(*args[:1])
+                    result = function(*args, **kwargs)
+                    if rows_out is not None and result is not None:
+                        stage.rows_out = rows_out(result)
+                    return result
+            return wrapper
+        return decorator
+
+    def counter(self, name, counts):
+        """Record the current values of a counter (any mapping), replacing what was recorded under name before."""
+
+        self.counters[name] = {str(key): value for key, value in dict(counts).items()}
+        self.emit({'type': 'counter', 'counter': name, 'counts': self.counters[name]})
+
+    def emit(self, record):
+        """Append a record to the metrics log as one JSON line."""
+
+        if not self.log_path:
+            return
+        record = {'run': self.run_id, 'script': self.script, 'pid': os.getpid(), **record}
+        with self._lock, open(self.log_path, 'a') as log:
+            log.write(json.dumps(record, default=str) + '\n')
+
+    def summary(self):
+        """Table of the stages recorded so far, stages run more than once added up, followed by the counters."""
+
+        total_wall = time.perf_counter() - self._wall
+        rows = {}
+        for record in self.records:
+            row = rows.setdefault(record['path'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': None,
+                                                   'rows_in': None, 'rows_out': None})
+            row['calls'] += 1
+            row['wall'] += record['wall_seconds']
+            row['cpu'] += record['cpu_seconds']
+            if record['peak_rss_mb'] is not None:
+                row['peak'] = max(row['peak'] or 0, record['peak_rss_mb'])
+            for field in ('rows_in', 'rows_out'):
+                if record[field] is not None:
+                    row[field] = (row[field] or 0) + record[field]
+
+        header = (f"{'stage':<40}{'calls':>6}{'wall s':>10}{'% run':>7}{'cpu s':>10}{'peak MB':>10}"
+                  f"{'rows in':>11}{'rows out':>11}")
+        lines = [f'{self.script} run {self.run_id}: {total_wall:.1f} s wall, '
+                 f'{time.process_time() - self._cpu:.1f} s CPU', header, '-' * len(header)]
+        # inner stages finish first, so list every stage in the order it started, under the one it ran in
+        for path in sorted(rows, key=lambda path: self._order[path]):
+            row = rows[path]
+            depth = path.count('/')
+            name = '  ' * depth + path.rsplit('/', 1)[-1]
+            share = row['wall'] / total_wall * 100 if total_wall > 0 else 0
+            lines.append(f"{name[:39]:<40}{row['calls']:>6}{row['wall']:>10.2f}{share:>6.0f}%{row['cpu']:>10.2f}"
+                         f"{row['peak'] if row['peak'] is not None else '':>10}"
+                         f"{row['rows_in'] if row['rows_in'] is not None else '':>11}"
+                         f"{row['rows_out'] if row['rows_out'] is not None else '':>11}")
+        for name, counts in self.counters.items():
+            lines.append(f'{name}: ' + ', '.join(f'{key}={value}' for key, value in counts.items()))
+        return os.linesep.join(lines)
+
+    def finish(self, quiet=False):
+        """Log the totals of the run and print the summary table, only the first time it is called."""
+
+        if self._finished:
+            return
+        self._finished = True
+        rss, peak = memory_mb()
+        self.emit({'type': 'run',
+                   'started': self.started.isoformat(timespec='seconds'),
+                   'wall_seconds': round(time.perf_counter() - self._wall, 4),
+                   'cpu_seconds': round(time.process_time() - self._cpu, 4),
+                   'peak_rss_mb': rounded(peak),
+                   'stages': len(self.records)})
+        if not quiet:
+            print(self.summary())
+
+
+def start_run(script=None, log_path=None):
+    """Start the run of this process, printing its summary when the process exits.
+
+    script defaults to the name of the file run and log_path to NGD_METRICS_LOG. Worker processes started after this
+    log their stages under the same run."""
+
+    global _run
+    script = script or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    _run = Metrics(script, log_path or os.getenv(METRICS_LOG_ENV))
+    os.environ[RUN_ID_ENV] = _run.run_id
+    atexit.register(_run.finish)
+    return _run
+
+
+def current_run():
+    """The run of this process. A process that didn't call start_run, such as a pool worker, gets a quiet run that
+    only writes to the metrics log."""
+
+    global _run
+    if _run is None:
+        _run = Metrics(os.path.splitext(os.path.basename(sys.argv[0]))[0], os.getenv(METRICS_LOG_ENV),
+                       os.getenv(RUN_ID_ENV))
+    return _run
+
+
+def stage(name, rows_in=None, rows_out=None):
+    """Context manager measuring a stage of the current run."""
+
+    return current_run().stage(name, rows_in, rows_out)
+
+
+def timed(name=None, rows_in=None, rows_out=None):
+    """Decorator measuring every call of a function as a stage of the run current when it is called."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            return current_run().timed(name or function.__name__, rows_in, rows_out)(function)(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_counter(name, counts):
+    """Record the current values of a counter in the current run."""
+
+    current_run().counter(name, counts)
@@ -0,0 +1,296 @@
+# Parquet staging cache for the NGD_AL and NGD_STREET
+#
+# Decoding the national NGD_AL out of a file geodatabase is the slowest read most scripts make. The first read of a
+# layer converts it into a Parquet dataset partitioned by province (PR, the first two digits of the CSD_UID) and sorted
+# on its UID field, so row group statistics let a read skip straight to the UIDs it asks for. Layers with a geometry
+# are stored as GeoParquet with the geometry in the SHAPE column. The stage is keyed on the source path, layer and
+# modification time: a new vintage of the data is staged again automatically and older stages of it are removed.
+#
+# Staging a geodatabase layer requires pyogrio, reading geometries back requires geopandas.
+
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+GEOMETRY_FIELD = 'SHAPE'
+PARTITION_FIELD = 'PR'
+# file written last, a stage without it was interrupted and is rebuilt
+MANIFEST_NAME = '_stage.json'
+ROW_GROUP_SIZE = 50000
+# files that don't hold data: ArcGIS locks, and in a file geodatabase everything besides its tables
+LOCK_SUFFIX = '.lock'
+GDB_TABLE_SUFFIXES = ('.gdbtable', '.gdbtablx')
+
+
+def cache_root(cache_dir=None):
+    """Directory holding every stage: cache_dir, the NGD_STAGING_DIR setting or ./staging."""
+
+    return cache_dir or os.getenv('NGD_STAGING_DIR', os.path.join(os.getcwd(), 'staging'))
+
+
+def source_mtime(source):
+    """Latest modification time of the data in a file, or in a directory such as a file geodatabase.
+
+    Opening a geodatabase in ArcGIS creates and removes *.lock files in it, which also changes the modification time of
+    the directory, so neither counts. In a file geodatabase only its tables (.gdbtable and .gdbtablx files) do."""
+
+    if not os.path.isdir(source):
+        return os.stat(source).st_mtime_ns
+    gdb = source.rstrip('/\\').lower().endswith('.gdb')
+    latest = 0
+    for folder, _, files in os.walk(source):
+        for name in files:
+            suffix = os.path.splitext(name)[1].lower()
+            if suffix == LOCK_SUFFIX or (gdb and suffix not in GDB_TABLE_SUFFIXES):
+                continue
+            latest = max(latest, os.stat(os.path.join(folder, name)).st_mtime_ns)
+    return latest
+
+
+def stage_path(source, layer=None, cache_dir=None):
+    """Path of the stage of a layer as it is now, and the prefix shared by every stage of that layer."""
+
+    source = os.path.abspath(source)
+    name = layer or os.path.splitext(os.path.basename(source))[0]
+    source_key = hashlib.sha1('{}|{}'.format(source, layer).encode()).hexdigest()[:12]
+    prefix = '{}_{}_'.format(name, source_key)
+    return os.path.join(cache_root(cache_dir), prefix + str(source_mtime(source))), prefix
+
+
+def source_batches(source, layer=None, batch_size=100000, columns=None):
+    """Read a layer as Arrow record batches, with the geometry as WKB in the SHAPE column.
+
+    Only the listed columns are read when columns is given, the geometry only when SHAPE is one of them. Returns a
+    tuple of (batches, crs) where crs is None for tables without a geometry. csv files are read with pyarrow,
+    everything else with pyogrio."""
+
+    if source.lower().endswith('.csv'):
+        import pyarrow.csv as pa_csv
+        options = pa_csv.ConvertOptions(include_columns=list(columns) if columns else None)
+        return iter(pa_csv.read_csv(source, convert_options=options).to_batches(max_chunksize=batch_size)), None
+
+    import pyogrio
+
+    options = {}
+    if columns is not None:
+        options = {'columns': [name for name in columns if name != GEOMETRY_FIELD],
+                   'read_geometry': GEOMETRY_FIELD in columns}
+
+    def batches():
+        with pyogrio.open_arrow(source, layer=layer, batch_size=batch_size, use_pyarrow=True, **options) as (meta, 
+                                                                                                             reader):
+            geometry = meta['geometry_name'] or 'wkb_geometry'
+            for batch in reader:
+                if geometry in batch.schema.names:
+                    batch = batch.rename_columns([GEOMETRY_FIELD if name == geometry else name
+                                                  for name in batch.schema.names])
+                yield batch
+
+    return batches(), pyogrio.read_info(source, layer=layer)['crs']
+
+
+def geo_metadata(crs):
+    """GeoParquet metadata for a WKB SHAPE column in the given crs."""
+
+    column = {'encoding': 'WKB', 'geometry_types': []}
+    if crs:
+        from pyproj import CRS
+        column['crs'] = CRS.from_user_input(crs).to_json_dict()
+    return {'version': '1.0.0', 'primary_column': GEOMETRY_FIELD, 'columns': {GEOMETRY_FIELD: column}}
+
+
+def province_codes(values):
+    """Two digit province code of each CSD_UID, '__null' where there is none so every row has a partition."""
+
+    codes = pd.Series(pd.to_numeric(values.to_pandas(), errors='coerce')).astype('Int64').astype('string').str[:2]
+    return pa.array(codes.fillna('__null').to_numpy(dtype=object), type=pa.string())
+
+
+def build_stage(source, layer, path, uid_field, csd_field, batch_size=100000):
+    """Convert a layer into a stage at path: one Parquet file per province, sorted on uid_field."""
+
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    batches, crs = source_batches(source, layer, batch_size)
+
+    writers = {}
+    schema = None
+    rows = 0
+    for batch in batches:
+        table = pa.Table.from_batches([batch])
+        if schema is None:
+            schema = table.schema
+            if GEOMETRY_FIELD in schema.names:
+                schema = schema.with_metadata({b'geo': json.dumps(geo_metadata(crs)).encode()})
+        table = table.cast(schema)
+        provinces = (province_codes(table[csd_field]) if csd_field in table.column_names
+                     else pa.array(['__null'] * len(table), type=pa.string()))
+        for province in pc.unique(provinces).to_pylist():
+            if province not in writers:
+                folder = os.path.join(tmp_path, '{}={}'.format(PARTITION_FIELD, province))
+                os.makedirs(folder)
+                writers[province] = pq.ParquetWriter(os.path.join(folder, 'part-0.parquet'), schema)
+            writers[province].write_table(table.filter(pc.equal(provinces, province)))
+        rows += len(table)
+    for writer in writers.values():
+        writer.close()
+
+    # sort each province on the UID so reads filtered on it only open the row groups holding those UIDs
+    for province in writers:
+        part = os.path.join(tmp_path, '{}={}'.format(PARTITION_FIELD, province), 'part-0.parquet')
+        table = pq.read_table(part)
+        if uid_field in table.column_names:
+            table = table.sort_by(uid_field)
+        pq.write_table(table, part, row_group_size=ROW_GROUP_SIZE)
+
+    os.makedirs(tmp_path, exist_ok=True)
+    with open(os.path.join(tmp_path, MANIFEST_NAME), 'w') as f:
+        json.dump({'source': os.path.abspath(source), 'layer': layer, 'rows': rows, 'crs': crs,
+                   'uid_field': uid_field, 'partitions': sorted(writers)}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def ensure_stage(source, layer=None, uid_field='NGD_UID', csd_field='CSD_UID_L', cache_dir=None):
+    """Path of an up to date stage of the layer, staging it first when the source changed since the last one."""
+
+    source = str(source)
+    path, prefix = stage_path(source, layer, cache_dir)
+    if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        return path
+
+    print('Staging {} {} to {}'.format(source, layer or '', path))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    build_stage(source, layer, path, uid_field, csd_field)
+    # the older vintages of this layer won't be read again
+    for name in os.listdir(os.path.dirname(path)):
+        old = os.path.join(os.path.dirname(path), name)
+        if name.startswith(prefix) and old != path:
+            shutil.rmtree(old, ignore_errors=True)
+    return path
+
+
+def uid_filter(uid_field, uids):
+    """An 'in' filter on uid_field for the non-null values of uids."""
+
+    values = pd.Series(list(uids), dtype='float64').dropna().astype('int64').unique().tolist()
+    return (uid_field, 'in', values)
+
+
+def combine_filters(filters, extra):
+    """Add the extra conditions to every conjunction of filters, which may be a list of tuples or a list of lists."""
+
+    if not extra:
+        return filters
+    if not filters:
+        return extra
+    if isinstance(filters[0], tuple):
+        return list(filters) + extra
+    return [list(conjunction) + extra for conjunction in filters]
+
+
+def read_staged(source, layer=None, columns=None, uids=None, filters=None, uid_field='NGD_UID', csd_field='CSD_UID_L',
+                crs=None, cache_dir=None):
+    """Read a layer through its stage, staging it first when needed.
+
+    Only the listed columns are read and uids (on uid_field) and filters (pyarrow DNF filters, which can also name
+    the PR partition) are pushed down to the Parquet reader. The result is a GeoDataFrame when the SHAPE column is
+    read, reprojected to crs when one is given, and a DataFrame otherwise."""
+
+    path = ensure_stage(source, layer, uid_field, csd_field, cache_dir)
+    if uids is not None:
+        filters = combine_filters(filters, [uid_filter(uid_field, uids)])
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != PARTITION_FIELD]
+    table = pq.read_table(path, columns=list(columns), filters=filters or None, partitioning='hive')
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        stage_crs = json.load(f)['crs']
+    return table_frame(table, stage_crs, crs)
+
+
+def table_frame(table, source_crs, crs=None):
+    """Turn an Arrow table into a DataFrame, or a GeoDataFrame in crs when it has a WKB SHAPE column."""
+
+    if GEOMETRY_FIELD not in table.column_names:
+        return table.to_pandas()
+
+    import geopandas as gpd
+    frame = table.to_pandas()
+    frame[GEOMETRY_FIELD] = gpd.GeoSeries.from_wkb(frame[GEOMETRY_FIELD], crs=source_crs)
+    frame = gpd.GeoDataFrame(frame, geometry=GEOMETRY_FIELD)
+    if crs is not None and frame.crs is not None and not frame.crs.equals(crs):
+        frame = frame.to_crs(crs)
+    return frame
+
+
+def current_stage(source, layer=None, cache_dir=None):
+    """Path of the stage of the layer when it is up to date with the source, None otherwise."""
+
+    path, _ = stage_path(str(source), layer, cache_dir)
+    return path if os.path.exists(os.path.join(path, MANIFEST_NAME)) else None
+
+
+def stream_uids(source, layer, uids, uid_field='NGD_UID', columns=None, crs=None, batch_size=100000):
+    """Read the records whose uid_field is in uids straight from the source, without staging it.
+
+    The layer is read in record batches of batch_size and each batch is filtered on the UIDs while the geometry is
+    still WKB, so only the matching records are ever turned into geometries and memory follows the number of matches
+    rather than the size of the layer. Only the listed columns are read when columns is given."""
+
+    source = str(source)
+    read_columns = None if columns is None else list(dict.fromkeys([uid_field] + list(columns)))
+    values = pa.array(uid_filter(uid_field, uids)[2], type=pa.int64())
+    batches, source_crs = source_batches(source, layer, batch_size, read_columns)
+
+    kept = []
+    schema = None
+    for batch in batches:
+        schema = batch.schema
+        matches = pc.is_in(batch[uid_field], value_set=values.cast(batch.schema.field(uid_field).type))
+        if pc.any(matches).as_py():
+            kept.append(batch.filter(matches))
+    table = pa.Table.from_batches(kept, schema=schema) if schema is not None else pa.table({})
+    if columns is not None:
+        table = table.select(list(columns))
+    return table_frame(table, source_crs, crs)
+
+
+def read_uids(source, layer, uids, uid_field='NGD_UID', columns=None, crs=None, cache_dir=None):
+    """Read the records whose uid_field is in uids, from the stage when it is up to date and by streaming the source
+    (see stream_uids) otherwise. A region of interest doesn't start a national staging run."""
+
+    if current_stage(source, layer, cache_dir):
+        return read_staged(source, layer, columns, uids, uid_field=uid_field, crs=crs, cache_dir=cache_dir)
+    return stream_uids(source, layer, uids, uid_field, columns, crs)
+
+
+def iter_staged(source, layer=None, columns=None, batch_size=100000, uid_field='NGD_UID', csd_field='CSD_UID_L',
+                cache_dir=None):
+    """Read a layer through its stage as a sequence of DataFrames of at most batch_size rows."""
+
+    path = ensure_stage(source, layer, uid_field, csd_field, cache_dir)
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(columns=list(columns) if columns else None, batch_size=batch_size):
+        yield batch.to_pandas()
+
+
+def read_ngdal(source, layer=None, columns=None, uids=None, filters=None, crs=None, cache_dir=None):
+    """Read the NGD_AL through the staging cache, see read_staged."""
+
+    return read_staged(source, layer, columns, uids, filters, 'NGD_UID', 'CSD_UID_L', crs, cache_dir)
+
+
+def read_ngdstreet(source, layer=None, columns=None, uids=None, filters=None, cache_dir=None):
+    """Read the NGD_STREET table through the staging cache, see read_staged."""
+
+    return read_staged(source, layer, columns, uids, filters, 'NGD_STR_UID', 'CSD_UID', None, cache_dir)
@@ -4,8 +4,13 @@ import geopandas as gpd
 from dotenv import load_dotenv
 import os
 
+from instrumentation import stage, start_run
+from ngd_staging import read_uids
+
 # load environment to get settings
 load_dotenv()
+# stage times are printed when the script exits, and logged to NGD_METRICS_LOG when it is set
+start_run('ngdal_roi')
 
 # paths
 redline_path = os.getenv('NGD_REDLINE_DATA')
@@ -15,20 +20,31 @@ ngdal_layer = os.getenv('NGD_NGDAL_LAYER')
 ngdal_affected_path = os.getenv('NGD_NGDAL_AFFECTED_FILE')
 
 uid_field = os.getenv('NGD_UID_FIELD')
+# optional comma separated list of NGD_AL fields to keep, every field is kept when it isn't set
+roi_fields = os.getenv('NGD_NGDAL_ROI_FIELDS')
+roi_fields = [field.strip() for field in roi_fields.split(',')] if roi_fields else None
+if roi_fields is not None and 'SHAPE' not in roi_fields:
+    # the records are written out as GeoJSON, which needs their geometry whatever the list leaves out
+    roi_fields.append('SHAPE')
 
 # read the redline data and get a list of attributes that have changed
 print("Reading redline data")
-rdf = gpd.read_file(redline_path)
+with stage("read redline") as reading:
+    rdf = gpd.read_file(redline_path)
+    reading.rows_out = len(rdf)
 # make a list of the NGD_UIDs that have changed so that we can filter the NGD_AL later
 # null will end up in this list, but that won't hurt later
 modified_ngduids = rdf[uid_field].unique().tolist()
 
-# read the NGD_AL source data, but only keep records that are in the redline layer
-print("Reading NGD_AL")
-ngdal = gpd.read_file(ngd_db_path, layer=ngdal_layer)
-print("Filtering NGD_AL to only modified records")
-ngdal = ngdal.loc[ngdal[uid_field].isin(modified_ngduids)]
+# read only the NGD_AL records that are in the redline layer, from the staging cache when it is up to date and otherwise
+# by streaming the layer and filtering every batch on the NGD_UIDs before any geometry is built
+print("Reading NGD_AL records found in the redline")
+with stage("read NGD_AL", rows_in=len(modified_ngduids)) as reading:
+    ngdal = read_uids(ngd_db_path, ngdal_layer, modified_ngduids, uid_field=uid_field, columns=roi_fields)
+    reading.rows_out = len(ngdal)
+print("Found", len(ngdal), "records")
 
 # write out the NGD_AL records that have an entry in the redline data
 print("Writing records that have a correlated redline entry")
-ngdal.to_file(ngdal_affected_path, driver='GeoJSON')
\ No newline at end of file
+with stage("write GeoJSON", rows_out=len(ngdal)):
+    ngdal.to_file(ngdal_affected_path, driver='GeoJSON')
\ No newline at end of file
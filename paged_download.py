@@ -0,0 +1,142 @@
+# Paged, parallel download of a FeatureServer layer with resume
+#
+# The OBJECTIDs matching a query are requested first and split into pages. Pages are then fetched by a bounded pool of
+# worker threads and each one is written to a local staging directory as soon as it arrives. If a run fails part way
+# through, calling download_pages again with the same query only fetches the pages that are still missing.
+#
+# Only the plain FeatureServer /query JSON protocol is used, so any server that speaks it can stand in for AGOL.
+# Requests go through a session when one is given (such as the authenticated GIS.session of the arcgis API), and
+# otherwise through urllib with an optional token.
+
+import json
+import os
+import shutil
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def query_layer(layer_url, params, token=None, timeout=300, session=None):
+    """POST a query to a FeatureServer layer and return the decoded JSON response.
+
+    session is any requests style session, it signs the request itself so token is only used without one."""
+
+    params = dict(params, f='json')
+    query_url = layer_url.rstrip('/') + '/query'
+    if session is not None:
+        response = session.post(query_url, data=params, timeout=timeout)
+        response.raise_for_status()
+        result = response.json()
+    else:
+        if token:
+            params['token'] = token
+        data = urllib.parse.urlencode(params).encode('utf-8')
+        with urllib.request.urlopen(query_url, data=data, timeout=timeout) as response:
+            result = json.load(response)
+    # the server reports errors in the body of a successful HTTP response
+    if 'error' in result:
+        raise RuntimeError('FeatureServer query failed: {}'.format(result['error']))
+    return result
+
+
+def page_path(staging_dir, page):
+    return os.path.join(staging_dir, 'page_{:06d}.json'.format(page))
+
+
+def plan_pages(layer_url, where, staging_dir, page_size=1000, token=None, session=None):
+    """Split the OBJECTIDs matching where into pages, reusing the plan already in staging_dir for the same query."""
+
+    os.makedirs(staging_dir, exist_ok=True)
+    manifest_path = os.path.join(staging_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest['url'], manifest['where'], manifest['page_size']) == (layer_url, where, page_size):
+            return manifest
+        # a different query was staged here, so nothing in the directory can be reused
+        clear_staging(staging_dir)
+        os.makedirs(staging_dir)
+
+    result = query_layer(layer_url, {'where': where, 'returnIdsOnly': 'true'}, token, session=session)
+    ids = sorted(result.get('objectIds') or [])
+    manifest = {'url': layer_url,
+                'where': where,
+                'page_size': page_size,
+                'oid_field': result.get('objectIdFieldName', 'OBJECTID'),
+                'pages': [ids[i:i + page_size] for i in range(0, len(ids), page_size)]}
+    write_json(manifest_path, manifest)
+    return manifest
+
+
+def fetch_page(layer_url, manifest, page, staging_dir, token=None, out_sr='3347', retries=3, session=None):
+    """Fetch one page of features and stage it. Failed requests are retried with a growing delay."""
+
+    params = {'objectIds': ','.join(str(oid) for oid in manifest['pages'][page]),
+              'outFields': '*',
+              'returnGeometry': 'true',
+              'outSR': out_sr}
+    for attempt in range(retries + 1):
+        try:
+            result = query_layer(layer_url, params, token, session=session)
+            break
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print('Page {} failed ({}), retrying'.format(page, e))
+            time.sleep(2 ** attempt)
+    write_json(page_path(staging_dir, page), result)
+    return page
+
+
+def download_pages(layer_url, where, staging_dir, page_size=1000, workers=4, token=None, out_sr='3347', session=None):
+    """Download every feature matching where into staging_dir, skipping pages staged by an earlier run.
+
+    Returns the manifest describing the staged pages."""
+
+    manifest = plan_pages(layer_url, where, staging_dir, page_size, token, session)
+    pending = [page for page in range(len(manifest['pages'])) if not os.path.exists(page_path(staging_dir, page))]
+    print('Downloading {} of {} pages of up to {} records'.format(len(pending), len(manifest['pages']), page_size))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_page, layer_url, manifest, page, staging_dir, token, out_sr, session=session) 
+                   for page in pending]
+        for done, future in enumerate(futures, start=1):
+            # result() re-raises the error of a page that ran out of retries, staged pages are kept for the next run
+            future.result()
+            if done % 10 == 0 or done == len(futures):
+                print('Staged {} of {} pages'.format(done, len(futures)))
+    return manifest
+
+
+def read_staged_features(staging_dir):
+    """Combine the staged pages into a single FeatureSet style dict."""
+
+    with open(os.path.join(staging_dir, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    featureset = {'features': []}
+    for page in range(len(manifest['pages'])):
+        with open(page_path(staging_dir, page)) as f:
+            result = json.load(f)
+        featureset['features'].extend(result.get('features', []))
+        for key in ['objectIdFieldName', 'geometryType', 'spatialReference', 'fields']:
+            if key in result and key not in featureset:
+                featureset[key] = result[key]
+    return featureset
+
+
+def clear_staging(staging_dir):
+    """Remove a staging directory once its contents have been saved elsewhere."""
+
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+
+
+def write_json(path, data):
+    # write to a temporary file first so an interrupted run never leaves a partial page behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
@@ -7,17 +7,11 @@
 # Created:     12/05/2020
 #-------------------------------------------------------------------------------
 
-import csv, os
-from collections import OrderedDict
+import csv, os, re
+from collections import Counter, OrderedDict
 from dotenv import load_dotenv
 
-# Setup env
-load_dotenv(os.path.join(os.getcwd(), 'environments.env'))
-
-sql_file = os.getenv('NGD_ATTR_SQL_PATH')
-
-csv_name = os.getenv('FROM_DATE_TIME').split(' ')[0].replace('-', '_') + '_' + os.getenv('TO_DATE_TIME').split(' ')[0].replace('-', '_')
-csv_count_output = os.path.join(os.getenv('NGD_DATA_DIR'), 'redline_count_' + csv_name + '.csv')
+from instrumentation import stage, start_run
 
 field_list = ["AFL_VAL",
 "ATL_VAL",
@@ -51,43 +45,109 @@ field_list = ["AFL_VAL",
 ]
 
 
-def sqlVariableCounts(sql_file, csv_count_output, field_list):
+# One UPDATE statement as written by detect_changes: the SET list, the NGD_UID it targets and the date guard field
+STATEMENT_RE = re.compile(r"UPDATE\s+\S+\s+SET\s+(?P<set>.*?)\s+WHERE\s+NGD_UID\s*=\s*(?P<uid>\d+)"
+                          r"(?:\s+AND\s+\(+\s*(?P<date_field>\w+)\s*<)?", re.IGNORECASE)
+# One FIELD=value assignment in a SET list, quoted values may hold commas
+ASSIGNMENT_RE = re.compile(r"(\w+)\s*=\s*(?:'(?:[^']|'')*'|[^,]*)")
+
+
+def parseStatements(sql_file):
+    """Lazily yield (ngd_uid, set fields, date field) for every UPDATE statement in the SQL file."""
+
+    with open(sql_file, "r") as sf:
+        for line in sf:
+            match = STATEMENT_RE.search(line)
+            if match is None:
+                continue
+            fields = ASSIGNMENT_RE.findall(match.group("set"))
+            yield int(match.group("uid")), fields, match.group("date_field")
+
+
+def readCsdLookup(redline_data, uid_field="NGD_UID", csd_field="CSD_UID_L"):
+    """NGD_UID to CSD_UID lookup read from the redline layer. Returns an empty lookup when arcpy isn't available."""
+
+    try:
+        import arcpy
+    except ImportError:
+        print("arcpy is not available, skipping the per CSD counts")
+        return {}
+    csd_lookup = {}
+    with arcpy.da.SearchCursor(redline_data, [uid_field, csd_field], "{} IS NOT NULL".format(uid_field)) as cursor:
+        for uid, csd in cursor:
+            csd_lookup[int(uid)] = csd
+    return csd_lookup
+
+
+def writeCounts(csv_output, key_name, counts):
+    # counts are keyed on (key, field) pairs
+    with open(csv_output, 'w', newline='') as cf:
+        writer = csv.DictWriter(cf, fieldnames=[key_name, "VARIABLE", "COUNT"])
+        writer.writeheader()
+        for (key, f), c in sorted(counts.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            writer.writerow({key_name: key, "VARIABLE": f, "COUNT": c})
+
+
+def sqlVariableCounts(sql_file, csv_count_output, field_list, csd_lookup=None):
+    """Count how many statements set each field, reading the SQL file one statement at a time.
+
+    Besides the per field counts in csv_count_output, per CSD and per date field breakdowns are written next to it
+    (_by_csd and _by_date_field). Fields are matched exactly, so NGD_STR_UID_L doesn't count NGD_STR_UID_DTE_L."""
+
     field_dict = OrderedDict()
 
     for field in field_list:
         field_dict[field] = 0
 
-    """in case unique ngd counts are requested/can be used as a list
-    for this purpose"""
-    ngd_dict = {}
+    # unique NGD_UIDs with the number of statements for each
+    ngd_dict = Counter()
+    csd_counts = Counter()
+    date_field_counts = Counter()
+    csd_lookup = csd_lookup or {}
 
-    #read SQL file and make dictionaries
-    with open(sql_file, "r") as sf:
-        lines = sf.readlines()
-        for line in lines:
-            #just in case
-            if "WHERE NGD_UID=" in line:
-                ngd_uid = line.split("=")[-1].replace(";", "")
-                if ngd_uid not in ngd_dict:
-                    ngd_dict[ngd_uid] = 1
-                else:
-                    ngd_dict[ngd_uid] += 1
-
-            for f in field_dict.keys():
-                if f in line:
-                    field_dict[f] += 1
+    for ngd_uid, fields, date_field in parseStatements(sql_file):
+        ngd_dict[ngd_uid] += 1
+        csd = csd_lookup.get(ngd_uid)
+        for f in set(fields):
+            if f not in field_dict:
+                continue
+            field_dict[f] += 1
+            date_field_counts[(date_field, f)] += 1
+            if csd is not None:
+                csd_counts[(csd, f)] += 1
 
     #add unique NGD_UID count to field_dict
     field_dict["NGD_UID"] = len(ngd_dict)
 
     #create csv from dictionaries
-    with open(csv_count_output, 'w') as cf:
+    with open(csv_count_output, 'w', newline='') as cf:
         output_fields = ["VARIABLE" ,"COUNT"]
         writer = csv.DictWriter(cf, fieldnames=output_fields)
         writer.writeheader()
         for f, c in field_dict.items():
             writer.writerow({"VARIABLE": f, "COUNT": c})
 
+    base_output = os.path.splitext(csv_count_output)[0]
+    writeCounts(base_output + "_by_date_field.csv", "DATE_FIELD", date_field_counts)
+    if csd_lookup:
+        writeCounts(base_output + "_by_csd.csv", "CSD_UID", csd_counts)
+
     print("{} created!".format(csv_count_output))
 
-sqlVariableCounts(sql_file=sql_file, csv_count_output=csv_count_output, field_list=field_list)
+
+if __name__ == "__main__":
+    # Setup env
+    load_dotenv(os.path.join(os.getcwd(), 'environments.env'))
+    # stage times are printed when the script exits, and logged to NGD_METRICS_LOG when it is set
+    start_run('redline_field_update_counts')
+
+    sql_file = os.getenv('NGD_ATTR_SQL_PATH')
+
+    csv_name = os.getenv('FROM_DATE_TIME').split(' ')[0].replace('-', '_') + '_' + os.getenv('TO_DATE_TIME').split(' ')[0].replace('-', '_')
+    csv_count_output = os.path.join(os.getenv('NGD_DATA_DIR'), 'redline_count_' + csv_name + '.csv')
+
+    with stage('read CSD lookup') as reading:
+        csd_lookup = readCsdLookup(os.path.join(os.getenv('NGD_REDLINE_DATA'), os.getenv('NGD_REDLINE_LAYER')))
+        reading.rows_out = len(csd_lookup)
+    with stage('count SQL updates'):
+        sqlVariableCounts(sql_file=sql_file, csv_count_output=csv_count_output, field_list=field_list, csd_lookup=csd_lookup)
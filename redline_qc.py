@@ -0,0 +1,70 @@
+# Address QC for downloaded redline data
+#
+# The download is loaded into a DataFrame once and every QC rule runs as a column operation on it, so the only
+# feature class written is the final NGD_STREET_Redline. Each function returns a new DataFrame and leaves its input
+# untouched.
+
+import pandas as pd
+
+from address_parity import fill_parity
+
+SIDES = ['L', 'R']
+
+
+def latest_edits(df, uid_field='NGD_UID', date_field='EditDate'):
+    """Keep the latest edit for each UID. On a tie the first row read wins, rows without a UID are dropped."""
+
+    return df.loc[df.groupby(uid_field)[date_field].idxmax()]
+
+
+def address_rule_failures(df):
+    """Flag rows that break the address completeness rules.
+
+    On each side, when either the AF or the AT value is set then the other one, ADDR_TYP and ADDR_PRTY must be set too."""
+
+    failed = pd.Series(False, index=df.index)
+    for d in SIDES:
+        af = df['AF' + d + '_VAL'].notna()
+        at = df['AT' + d + '_VAL'].notna()
+        complete = af & at & df['ADDR_TYP_' + d].notna() & df['ADDR_PRTY_' + d].notna()
+        failed |= (af | at) & ~complete
+    return failed
+
+
+def fill_pairs(df, template):
+    """Fill the AF/AT holes of the field named by template ('{}{}_VAL' style, taking AF/AT then the side) from the
+    other end of the range."""
+
+    df = df.copy()
+    for d in SIDES:
+        af_field = template.format('AF', d)
+        at_field = template.format('AT', d)
+        df[at_field] = df[at_field].where(df[at_field].notna(), df[af_field])
+        df[af_field] = df[af_field].where(df[af_field].notna(), df[at_field])
+    return df
+
+
+def run_qc(df, uid_field='NGD_UID', date_field='EditDate'):
+    """Run every QC step over a downloaded redline.
+
+    Records with a UID are reduced to their latest edit, records without one are all kept. Missing AF/AT values and
+    sources are filled from the other end of the range and missing parities are derived from the address values.
+    Returns the cleaned records and a boolean Series on the same index flagging the records that broke the address
+    rules as they were downloaded."""
+
+    has_uid = df[uid_field].notna()
+    print('Records with NGD_UIDs: {}  Records with NULL NGD_UIDs: {}'.format(has_uid.sum(), (~has_uid).sum()))
+
+    print('Filtering to remove records that contain duplicate NGD_UIDs')
+    uniques = latest_edits(df[has_uid], uid_field, date_field)
+    print('Keeping ' + str(len(uniques)) + ' rows from Redline data')
+    df = pd.concat([df[~has_uid], uniques])
+
+    print('Running address fields QC checks')
+    failed = address_rule_failures(df)
+    print('Good rows: ' + str((~failed).sum()) + ' Rows to QC: ' + str(failed.sum()))
+
+    print('Performing final address QC')
+    df = fill_pairs(df, '{}{}_VAL')
+    df = fill_pairs(df, '{}{}_SRC')
+    return fill_parity(df), failed
@@ -0,0 +1,108 @@
+# Incremental redline sync
+#
+# A checkpoint file records the high-water mark of the last sync: the end of the window it downloaded (or the latest
+# EditDate downloaded, when that is later) and the highest OBJECTID edited at that moment. The next sync only asks AGOL
+# for edits from that second up to shortly before now, drops the ones it has already seen and merges the rest into a
+# local store of redline records.
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+from redline_qc import latest_edits
+
+
+def edit_dates(values):
+    """EditDate values as datetimes, whether they were read as datetimes or as epoch milliseconds."""
+
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_datetime(values, unit='ms')
+    return pd.to_datetime(values)
+
+
+def load_checkpoint(path):
+    """Read the checkpoint saved by the last sync, or None when there hasn't been one."""
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    checkpoint['edit_date'] = pd.Timestamp(checkpoint['edit_date'])
+    return checkpoint
+
+
+def save_checkpoint(path, records, previous=None, window_end=None, date_field='EditDate', oid_field='OBJECTID'):
+    """Move the checkpoint to the end of the downloaded window, or to the latest edit in records when that is later.
+
+    records can be None when nothing was downloaded. The checkpoint never moves back, the previous one is kept when
+    there is nothing later to move to."""
+
+    marks = [] if previous is None else [(previous['edit_date'], previous['objectid'])]
+    if window_end is not None:
+        # -1 as no downloaded edit is known to be at the end of the window, so one made in that second isn't dropped
+        marks.append((pd.Timestamp(window_end), -1))
+    if records is not None and len(records) > 0:
+        dates = edit_dates(records[date_field])
+        latest = dates.max()
+        marks.append((latest, int(records.loc[dates == latest, oid_field].max())))
+    if not marks:
+        return previous
+    latest, objectid = max(marks)
+    if previous is not None and (latest, objectid) == (previous['edit_date'], previous['objectid']):
+        return previous
+    checkpoint = {'edit_date': latest, 'objectid': objectid}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'edit_date': latest.isoformat(), 'objectid': checkpoint['objectid']}, f)
+    os.replace(tmp_path, path)
+    return checkpoint
+
+
+def sync_start(checkpoint, from_date):
+    """Start of the download window: the second of the last checkpoint, or from_date on the first sync.
+
+    Feature service queries only take whole seconds, so anything already seen in that second is removed afterwards by
+    drop_seen."""
+
+    if checkpoint is None:
+        return from_date
+    return checkpoint['edit_date'].strftime('%Y-%m-%d %H:%M:%S')
+
+
+def sync_end(lag_seconds=300, now=None):
+    """End of the download window: now (in UTC, like EditDate) less a safety lag for edits still being applied,
+    truncated to the second."""
+
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    return pd.Timestamp(now - timedelta(seconds=lag_seconds)).floor('s')
+
+
+def drop_seen(records, checkpoint, date_field='EditDate', oid_field='OBJECTID'):
+    """Remove the records at or before the checkpoint's (EditDate, OBJECTID) high-water mark."""
+
+    if checkpoint is None or len(records) == 0:
+        return records
+    dates = edit_dates(records[date_field])
+    newer = (dates > checkpoint['edit_date']) | ((dates == checkpoint['edit_date']) &
+                                               (records[oid_field] > checkpoint['objectid']))
+    return records[newer]
+
+
+def merge_latest(store, records, uid_field='NGD_UID', date_field='EditDate', record_field='GlobalID'):
+    """Merge newly downloaded records into the store, latest edit wins.
+
+    Records with an NGD_UID follow the same rule as redline_qc.latest_edits. New geometries without one are
+    matched on their GlobalID so an edited feature replaces its earlier version. On a tie a downloaded record wins
+    over the stored one, as it was read later."""
+
+    # latest_edits keeps the first row of a tie, so the downloaded records go first
+    merged = pd.concat([records, store], ignore_index=True)
+    merged['_edit_date'] = edit_dates(merged[date_field])
+
+    has_uid = merged[uid_field].notna()
+    with_uid = latest_edits(merged[has_uid], uid_field, '_edit_date')
+    without_uid = latest_edits(merged[~has_uid], record_field, '_edit_date')
+    return pd.concat([with_uid, without_uid]).drop(columns='_edit_date').reset_index(drop=True)
@@ -0,0 +1,67 @@
+# Streaming writer for the UPDATE statements produced by change detection
+#
+# Statements are written to the SQL file as soon as they are produced instead of being held in memory until the end
+# of the run. When coalescing is turned on, every SET clause for the same NGD_UID and date guard field is gathered
+# into a single statement, which is written when the writer is closed.
+
+import os
+
+# ending of an SQL statement
+END_SQL_STMT = ";" + os.linesep
+
+
+class SqlWriter:
+    """Write UPDATE statements against the NGD table to an SQL file."""
+
+    def __init__(self, path, table, uid_field, vintage_date, coalesce=False):
+        self.table = table
+        self.uid_field = uid_field
+        self.vintage_date = vintage_date
+        self.coalesce = coalesce
+        # number of statements written to the file
+        self.count = 0
+        # (uid, date field) -> {field: value} for coalesced statements, in the order they were first seen
+        self._pending = {}
+        self._file = open(path, mode='w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def date_guard(self, date_field):
+        """Predicate that skips records edited in the NGD after the data vintage, unless that edit was our own."""
+
+        return (f"({date_field} < to_date('{self.vintage_date}', 'YYYY-MM-DD')) OR ({date_field} IS NULL) OR "
+                f"({date_field} > (SELECT sysdate - 30/24/60 from dual))")
+
+    def statement(self, uid, assignments, date_field):
+        """Build a single UPDATE statement from a list of (field, SQL value) pairs."""
+
+        set_list = ", ".join(f"{field}={value}" for field, value in assignments)
+        return (f"UPDATE {self.table} SET {set_list} WHERE {self.uid_field}={uid} "
+                f"AND ({self.date_guard(date_field)})")
+
+    def update(self, uid, assignments, date_field):
+        """Write, or hold for coalescing, an update of the (field, SQL value) pairs guarded by date_field."""
+
+        if self.coalesce:
+            # a later value for the same field replaces the earlier one, just like running the statements in order
+            self._pending.setdefault((uid, date_field), {}).update(assignments)
+            return
+        self._write(self.statement(uid, assignments, date_field))
+
+    def close(self):
+        """Flush any coalesced statements and close the file."""
+
+        if self._file.closed:
+            return
+        for (uid, date_field), assignments in self._pending.items():
+            self._write(self.statement(uid, assignments.items(), date_field))
+        self._pending.clear()
+        self._file.close()
+
+    def _write(self, sql):
+        self._file.write(sql + END_SQL_STMT)
+        self.count += 1
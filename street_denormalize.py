@@ -0,0 +1,110 @@
+# Chunked NGD_AL / NGD_STREET denormalization
+#
+# The street name, type, direction and source of the left street and both aliases are looked up for every NGD_AL arc.
+# NGD_STREET is indexed on NGD_STR_UID once and each chunk of the NGD_AL only maps its UID columns against that index,
+# so memory stays flat however large the NGD_AL is. Chunks are processed by a pool of worker processes and written to a
+# single Parquet file in their original order.
+#
+# This module doesn't import arcpy so that worker processes start quickly.
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+STREET_FIELDS = ['STR_NME', 'STR_TYP', 'STR_DIR', 'NAME_SRC']
+
+# NGD_AL street UID columns and the names given to the street fields they look up
+UID_COLUMNS = {'NGD_STR_UID_L': {f: f for f in STREET_FIELDS},
+               'ALIAS1_STR_UID_L': {'STR_NME': 'ALIAS1_STR_NME', 'STR_TYP': 'ALIAS1_STR_TYP',
+                                    'STR_DIR': 'ALIAS1_STR_DIR', 'NAME_SRC': 'ALIAS1_NME_SRC'},
+               'ALIAS2_STR_UID_L': {'STR_NME': 'ALIAS2_STR_NME', 'STR_TYP': 'ALIAS2_STR_TYP',
+                                    'STR_DIR': 'ALIAS2_STR_DIR', 'NAME_SRC': 'ALIAS2_NME_SRC'}}
+
+# key of each arc, carried into the output so it can be joined back to the NGD_AL
+ARC_KEY = 'NGD_UID'
+# NGD_AL columns every chunk has to hold
+CHUNK_COLUMNS = [ARC_KEY] + list(UID_COLUMNS)
+
+# street table shared by the chunks processed in a worker
+_lookup = None
+
+
+def street_lookup(street_df):
+    """Index NGD_STREET on NGD_STR_UID, keeping the first record of each UID. Text fields get a fixed string type so
+    every chunk writes the same schema."""
+
+    lookup = street_df.drop_duplicates(subset='NGD_STR_UID').set_index('NGD_STR_UID')[STREET_FIELDS]
+    # evenly spaced UIDs can come out as a RangeIndex, which pandas fails to reindex on a lone null
+    lookup.index = pd.Index(lookup.index.to_numpy(), name='NGD_STR_UID')
+    return lookup.astype('string')
+
+
+def denormalize_chunk(chunk, lookup):
+    """Add the street fields of every UID column to a chunk of the NGD_AL, keyed on its NGD_UID. Arcs without a street
+    get nulls."""
+
+    out = {ARC_KEY: pd.to_numeric(chunk[ARC_KEY], errors='coerce').astype('Int64').reset_index(drop=True)}
+    for uid_field, names in UID_COLUMNS.items():
+        uids = pd.to_numeric(chunk[uid_field], errors='coerce').astype('Int64').reset_index(drop=True)
+        out[uid_field] = uids
+        matched = lookup.reindex(uids).reset_index(drop=True)
+        for field, name in names.items():
+            out[name] = matched[field]
+    return pd.DataFrame(out)
+
+
+def _init_worker(lookup):
+    global _lookup
+    _lookup = lookup
+
+
+def _denormalize(chunk):
+    return denormalize_chunk(chunk, _lookup)
+
+
+def denormalize_csv(al_csv, street_df, out_path, chunk_size=100000, workers=None):
+    """Denormalize the NGD_AL csv against NGD_STREET into one Parquet file at out_path. Returns the rows written."""
+
+    chunks = pd.read_csv(al_csv, chunksize=chunk_size, usecols=CHUNK_COLUMNS)
+    return denormalize_chunks(chunks, street_df, out_path, workers)
+
+
+def denormalize_chunks(chunks, street_df, out_path, workers=None):
+    """Denormalize a sequence of NGD_AL chunks holding the CHUNK_COLUMNS against NGD_STREET into one Parquet file at
+    out_path. Returns the rows written.
+
+    At most two chunks per worker are held in memory at any time."""
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    lookup = street_lookup(street_df)
+    chunks = iter(chunks)
+    writer = None
+    rows = 0
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(lookup,)) as pool:
+        window = workers * 2
+        pending = deque()
+        exhausted = False
+        while pending or not exhausted:
+            # keep the pool busy without reading the whole csv ahead of the writer
+            while not exhausted and len(pending) < window:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                else:
+                    pending.append(pool.submit(_denormalize, chunk))
+            if not pending:
+                break
+            table = pa.Table.from_pandas(pending.popleft().result(), preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, table.schema)
+            writer.write_table(table)
+            rows += table.num_rows
+            print(f'Denormalized {rows} NGD_AL records')
+    if writer is not None:
+        writer.close()
+    return rows
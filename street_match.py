@@ -0,0 +1,59 @@
+# Street name matching against NGD_STREET
+#
+# Change detection looks up the NGD_STR_UID of the street named on each side of a redline arc, and of its aliases.
+# NGD_STREET is indexed on its name key once and every searcher resolves all of its distinct names with one join.
+
+# fields that make up a street name key on the NGD_STREET table
+STREET_KEY_FIELDS = ['CSD_UID', 'STR_NME', 'STR_TYP', 'STR_DIR']
+
+# searching criteria and which fields to update when change is detected
+STREET_NAME_SEARCHERS = [
+    # left street name
+    {'grouper': ['CSD_UID_L','STR_NME','STR_TYP','STR_DIR'],
+    'redline_uid_field': 'NGD_STR_UID_L',
+    'ngdal_uid_field': 'NGD_STR_UID_L',
+    'date_field': 'NGD_STR_UID_DTE_L'},
+    # right street name
+    {'grouper': ['CSD_UID_R','STR_NME','STR_TYP','STR_DIR'],
+    'redline_uid_field': 'NGD_STR_UID_R',
+    'ngdal_uid_field': 'NGD_STR_UID_R',
+    'date_field': 'NGD_STR_UID_DTE_R'},
+    # left alias 1
+    {'grouper': ['CSD_UID_L','STR_NME_ALIAS1','STR_TYP_ALIAS1','STR_DIR_ALIAS1'],
+    'redline_uid_field': 'ALIAS1_STR_UID_L',
+    'ngdal_uid_field': 'ALIAS1_STR_UID_L',
+    'date_field': 'ATTRBT_DTE'},
+    # right alias 1
+    {'grouper': ['CSD_UID_R','STR_NME_ALIAS1','STR_TYP_ALIAS1','STR_DIR_ALIAS1'],
+    'redline_uid_field': 'ALIAS1_STR_UID_R',
+    'ngdal_uid_field': 'ALIAS1_STR_UID_R',
+    'date_field': 'ATTRBT_DTE'},
+    # left alias 2
+    {'grouper': ['CSD_UID_L','STR_NME_ALIAS2','STR_TYP_ALIAS2','STR_DIR_ALIAS2'],
+    'redline_uid_field': 'ALIAS2_STR_UID_L',
+    'ngdal_uid_field': 'ALIAS2_STR_UID_L',
+    'date_field': 'ATTRBT_DTE'},
+    # right alias 2
+    {'grouper': ['CSD_UID_R','STR_NME_ALIAS2','STR_TYP_ALIAS2','STR_DIR_ALIAS2'],
+    'redline_uid_field': 'ALIAS2_STR_UID_R',
+    'ngdal_uid_field': 'ALIAS2_STR_UID_R',
+    'date_field': 'ATTRBT_DTE'}
+    ]
+
+
+def build_street_index(ngdstreet):
+    """Index NGD_STREET on its name key, keeping the first NGD_STR_UID found for each key."""
+
+    return (ngdstreet.drop_duplicates(subset=STREET_KEY_FIELDS, keep='first')
+            .set_index(STREET_KEY_FIELDS)['NGD_STR_UID'])
+
+
+def resolve_street_uids(keys, street_index):
+    """Match every unique row of keys (given in NGD_STREET key order) against the street index in a single join.
+
+    Returns a dict of key tuple to NGD_STR_UID that only holds the keys that found a match."""
+
+    matched = (keys.drop_duplicates()
+              .set_axis(STREET_KEY_FIELDS, axis=1)
+              .merge(street_index.reset_index(), on=STREET_KEY_FIELDS, how='inner'))
+    return {tuple(row[:-1]): row[-1] for row in matched.itertuples(index=False)}
@@ -0,0 +1,6 @@
+# The modules under test are top-level scripts of the repository, so make them importable from the tests
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,107 @@
+# Local stand-in for a FeatureServer layer
+#
+# Serves the parts of the /query JSON protocol paged_download uses from an in-memory list of features: returnIdsOnly
+# queries and objectIds queries. Every request is logged, the most requests handled at once is tracked, and
+# failures can be injected for the page that starts at a given OBJECTID.
+
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OID_FIELD = 'OBJECTID'
+
+
+def make_features(count):
+    """Point features with OBJECTIDs 1 to count."""
+
+    return [{'attributes': {OID_FIELD: oid, 'NGD_UID': 1000 + oid},
+             'geometry': {'x': float(oid), 'y': float(oid)}} for oid in range(1, count + 1)]
+
+
+class FeatureServerStub:
+    """A FeatureServer layer at url serving features, run on a background thread while used as a context manager.
+
+    delay is slept in every request so concurrent fetches overlap. fail_pages maps the first OBJECTID of a page to
+    the number of times its request fails with an error body before it succeeds."""
+
+    def __init__(self, features, delay=0.0, fail_pages=None):
+        self.features = {feature['attributes'][OID_FIELD]: feature for feature in features}
+        self.delay = delay
+        self.fail_pages = dict(fail_pages or {})
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = 'http://127.0.0.1:{}/FeatureServer/0'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+        return False
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+                self.reply(stub.respond(self.path, params))
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                self.reply(stub.respond(url.path, dict(urllib.parse.parse_qsl(url.query))))
+
+            def reply(self, result):
+                body = json.dumps(result).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, path, params):
+        with self._lock:
+            self.requests.append(params)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if not path.endswith('/query'):
+                return {'error': {'code': 400, 'message': 'Invalid URL'}}
+            if params.get('returnIdsOnly') == 'true':
+                return {'objectIdFieldName': OID_FIELD, 'objectIds': list(self.features)}
+            oids = [int(oid) for oid in params['objectIds'].split(',')]
+            with self._lock:
+                if self.fail_pages.get(oids[0], 0) > 0:
+                    self.fail_pages[oids[0]] -= 1
+                    # FeatureServer errors come back in the body of a successful response
+                    return {'error': {'code': 500, 'message': 'Injected failure'}}
+            return {'objectIdFieldName': OID_FIELD,
+                    'geometryType': 'esriGeometryPoint',
+                    'spatialReference': {'wkid': int(params.get('outSR', 3347))},
+                    'fields': [{'name': OID_FIELD, 'type': 'esriFieldTypeOID'},
+                               {'name': 'NGD_UID', 'type': 'esriFieldTypeInteger'}],
+                    'features': [self.features[oid] for oid in oids if oid in self.features]}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def feature_requests(self):
+        """The objectIds queries received so far, as lists of OBJECTIDs."""
+
+        return [[int(oid) for oid in params['objectIds'].split(',')] for params in self.requests if 'objectIds' in params]
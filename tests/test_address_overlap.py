@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+from address_overlap import overlapping_pairs, shares_address
+
+
+def intervals(*rows, parity=None, typ=None):
+    """Interval frame of (street, lo, hi) rows, in the shape side_intervals returns."""
+
+    frame = pd.DataFrame(rows, columns=['street', 'lo', 'hi']).astype({'lo': 'float64', 'hi': 'float64'})
+    frame['parity'] = parity or [None] * len(frame)
+    frame['typ'] = typ or [None] * len(frame)
+    return frame
+
+
+def pairs(left, right):
+    return list(zip(*(positions.tolist() for positions in overlapping_pairs(left, right))))
+
+
+def test_overlapping_pairs_on_the_same_street():
+    left = intervals((1, 10, 20), (2, 5, 9), (3, 1, 100))
+    right = intervals((1, 20, 30),   # touches the end of the first left interval
+                      (1, 21, 40),   # starts past it
+                      (2, 1, 4),     # ends before the second left interval
+                      (2, 6, 7),     # inside it
+                      (1, 0, 12))    # starts before the first left interval and ends inside it
+
+    assert pairs(left, right) == [(0, 4), (0, 0), (1, 3)]
+
+
+def test_overlapping_pairs_of_empty_frames():
+    assert pairs(intervals(), intervals((1, 1, 2))) == []
+    assert pairs(intervals((1, 1, 2)), intervals()) == []
+
+
+def test_overlapping_pairs_match_a_brute_force_search():
+    rng = np.random.default_rng(0)
+
+    def random_intervals(count):
+        lo = rng.integers(0, 200, count)
+        return intervals(*zip(rng.integers(0, 5, count), lo, lo + rng.integers(0, 40, count)))
+
+    left = random_intervals(60)
+    right = random_intervals(80)
+    expected = sorted((i, j) for i in range(len(left)) for j in range(len(right))
+                      if left['street'][i] == right['street'][j]
+                      and left['lo'][i] <= right['hi'][j] and right['lo'][j] <= left['hi'][i])
+
+    assert sorted(pairs(left, right)) == expected
+    # the pairs come back ordered by left position
+    assert [i for i, _ in pairs(left, right)] == sorted(i for i, _ in pairs(left, right))
+
+
+def test_shares_address_respects_parity_and_type():
+    left = intervals((1, 1, 9), (1, 1, 9), (1, 2, 2), (1, 1, 9), (1, 1, 9),
+                     parity=['O', 'O', 'E', 'M', 'O'], typ=['C', 'C', None, 'C', 'C'])
+    right = intervals((1, 1, 9), (1, 2, 8), (1, 2, 4), (1, 4, 4), (1, 1, 9),
+                      parity=['E', 'O', None, 'E', 'O'], typ=['C', 'C', 'C', 'C', 'R'])
+
+    assert shares_address(left, right).tolist() == [False, True, True, True, False]
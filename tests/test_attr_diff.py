@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+from attr_diff import CHANGE_COLUMNS, address_date_field, diff_fields
+from change_log import ChangeLog
+from detect_steps import write_address_updates
+from sql_writer import SqlWriter
+
+
+def test_diff_fields_finds_changed_values():
+    ngdal = pd.DataFrame({'NGD_UID': [1, 2, 3],
+                          'AFL_VAL': [10.0, 20.0, np.nan],
+                          'AFL_SRC': ['NGD', 'NGD', None]})
+    redline = pd.DataFrame({'NGD_UID': [1, 2, 3],
+                            # 10.0 and 10 are the same value once normalized, two nulls match
+                            'AFL_VAL': [10.0, 22.0, np.nan],
+                            'AFL_SRC': ['NGD', 'ABC', 'ABC'],
+                            'EditDate': pd.to_datetime(['2020-01-01', '2020-01-02', '2020-01-03'])})
+
+    date_fields = {f: address_date_field(f) for f in ['AFL_VAL', 'AFL_SRC']}
+    changes, missing, same = diff_fields(redline, ngdal, 'NGD_UID', date_fields, carry=['EditDate'])
+
+    assert list(changes.columns) == CHANGE_COLUMNS + ['EditDate']
+    assert changes[['uid', 'field', 'new', 'date_field']].values.tolist() == [[2, 'AFL_VAL', 22, 'AFL_DTE'],
+                                                                             [2, 'AFL_SRC', 'ABC', 'AFL_DTE'],
+                                                                             [3, 'AFL_SRC', 'ABC', 'AFL_DTE']]
+    assert changes['old'][:2].tolist() == [20.0, 'NGD']
+    assert pd.isna(changes['old'][2])
+    assert changes['EditDate'].tolist() == list(pd.to_datetime(['2020-01-02', '2020-01-02', '2020-01-03']))
+    assert missing == []
+    assert same == 3
+
+
+def test_diff_fields_clears_values():
+    ngdal = pd.DataFrame({'NGD_UID': [1], 'ADDR_TYP_L': ['C']})
+    redline = pd.DataFrame({'NGD_UID': [1], 'ADDR_TYP_L': [None]})
+
+    changes, _, same = diff_fields(redline, ngdal, 'NGD_UID', {'ADDR_TYP_L': 'ATTRBT_DTE'})
+
+    assert changes[['old', 'new']].values.tolist() == [['C', None]]
+    assert same == 0
+
+
+def test_diff_fields_skips_missing_uids_and_takes_first_duplicate():
+    ngdal = pd.DataFrame({'NGD_UID': [1, 1], 'SGMNT_SRC': ['NGD', 'OLD']})
+    redline = pd.DataFrame({'NGD_UID': [1, 5, 5], 'SGMNT_SRC': ['NGD', 'ABC', 'ABC']})
+
+    changes, missing, same = diff_fields(redline, ngdal, 'NGD_UID', {'SGMNT_SRC': 'ATTRBT_DTE'})
+
+    assert changes.empty
+    assert missing == [5]
+    assert same == 1
+
+
+def test_float_column_with_nulls_writes_integer_sql(tmp_path):
+    # address numbers come out of the redline as floats once a null is among them
+    ngdal = pd.DataFrame({'NGD_UID': [1, 2, 3], 'AFL_VAL': [10.0, 20.0, 30.0]})
+    redline = pd.DataFrame({'NGD_UID': [1, 2, 3], 'AFL_VAL': [12.0, np.nan, 30.0],
+                            'EditDate': pd.to_datetime(['2020-01-01'] * 3)})
+
+    changes, _, _ = diff_fields(redline, ngdal, 'NGD_UID', {'AFL_VAL': 'AFL_DTE'}, carry=['EditDate'])
+    assert [type(value) for value in changes['new']] == [int, type(None)]
+
+    path = tmp_path / 'updates.sql'
+    with SqlWriter(path, 'NGD.NGD_AL', 'NGD_UID', '2020-03-13') as writer:
+        write_address_updates(changes, writer, ChangeLog())
+    with open(path) as sql:
+        statements = sql.read().splitlines()
+
+    assert [statement.split(' WHERE ')[0] for statement in statements] == [
+        'UPDATE NGD.NGD_AL SET AFL_VAL=12, AFL_DTE=sysdate',
+        'UPDATE NGD.NGD_AL SET AFL_VAL=NULL, AFL_DTE=sysdate']
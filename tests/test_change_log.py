@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from change_log import LOG_COLUMNS, ChangeLog, read_change_log
+
+
+def run_log(uid, route_uid):
+    log = ChangeLog()
+    log.add(uid, 'NGD_STR_UID_L', 5.0, 6, 'NGD_STR_UID_DTE_L', pd.Timestamp('2020-01-01'))
+    log.extend(pd.DataFrame({'uid': [uid], 'field': ['AFL_VAL'], 'old': [np.nan], 'new': [-1],
+                             'date_field': ['AFL_DTE'], 'edit_date': [pd.Timestamp('2020-01-02')]}))
+    log.add_routes(pd.DataFrame({'NGD_UID': [route_uid], 'EditDate': [pd.Timestamp('2020-01-03')],
+                                 'route': ['length_change']}), 'NGD_UID', 'EditDate')
+    return log
+
+
+def test_frame_holds_every_kind_of_row():
+    log = run_log(1, 2).frame()
+
+    assert list(log.columns) == LOG_COLUMNS
+    assert log['NGD_UID'].tolist() == [1, 1, 2]
+    # values are stored as text and the -1 filler as a null
+    assert log['old'].tolist() == ['5.0', None, None]
+    assert log['new'].tolist() == ['6', None, None]
+    assert log['route'].tolist() == ['attribute', 'attribute', 'length_change']
+
+
+def test_runs_append_to_their_pull_date_partition(tmp_path):
+    log_dir = str(tmp_path)
+    first = run_log(1, 2).write(log_dir, '2020-01-05')
+    second = run_log(3, 4).write(log_dir, '2020-01-05')
+    other = run_log(5, 6).write(log_dir, '2020-01-06')
+
+    # every run is a file of its own next to the earlier ones
+    assert os.path.dirname(first) == os.path.dirname(second) == os.path.join(log_dir, 'pull_date=2020-01-05')
+    assert first != second
+    assert os.path.dirname(other) == os.path.join(log_dir, 'pull_date=2020-01-06')
+
+    history = read_change_log(log_dir)
+    assert len(history) == 9
+    assert sorted(history['NGD_UID'].tolist()) == [1, 1, 2, 3, 3, 4, 5, 5, 6]
+
+    one_day = read_change_log(log_dir, ['2020-01-06'])
+    assert sorted(one_day['NGD_UID'].tolist()) == [5, 5, 6]
+    assert set(one_day['pull_date'].astype(str)) == {'2020-01-06'}
+
+
+def test_empty_log_still_writes_a_partition(tmp_path):
+    path = ChangeLog().write(str(tmp_path), '2020-01-05')
+
+    assert os.path.exists(path)
+    assert len(read_change_log(str(tmp_path))) == 0
+
+
+def test_history_mixing_empty_and_routed_only_runs(tmp_path):
+    log_dir = str(tmp_path)
+    ChangeLog().write(log_dir, '2020-01-04')
+    routed = ChangeLog()
+    routed.add_routes(pd.DataFrame({'NGD_UID': [7], 'EditDate': [pd.Timestamp('2020-01-03')],
+                                    'route': ['new_street']}), 'NGD_UID', 'EditDate')
+    routed.write(log_dir, '2020-01-05')
+    run_log(1, 2).write(log_dir, '2020-01-06')
+
+    history = read_change_log(log_dir)
+
+    assert sorted(history['NGD_UID'].tolist()) == [1, 1, 2, 7]
+    assert sorted(history['route'].tolist()) == ['attribute', 'attribute', 'length_change', 'new_street']
+    new = history.loc[history['NGD_UID'] == 1, 'new'].tolist()
+    assert new[0] == '6' and pd.isna(new[1])
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+shapely = pytest.importorskip('shapely')
+
+from csd_assigner import CsdAssigner, vote
+
+
+def test_vote_prefers_agreeing_samples():
+    samples = np.array([['A', 'A', 'B'],
+                        ['B', 'A', 'A'],     # the two later samples outvote the first
+                        ['A', 'B', 'C'],     # nobody agrees, the first sample wins
+                        [None, 'B', 'C'],    # the first sample with a value wins
+                        [None, None, None],
+                        [None, 'C', 'C']], dtype=object)
+
+    assert vote(samples).tolist() == ['A', 'A', 'A', 'B', None, 'C']
+
+
+def test_assign_sides_of_a_boundary_line():
+    assigner = CsdAssigner(['100', '200'], [shapely.box(0, 0, 100, 100), shapely.box(100, 0, 200, 100)])
+    lines = [shapely.LineString([(100, 10), (100, 90)]),    # north along the boundary, 100 on the left
+             shapely.LineString([(100, 90), (100, 10)]),    # the same boundary digitized south
+             shapely.LineString([(20, 50), (80, 50)]),      # inside 100
+             shapely.LineString([(500, 50), (600, 50)]),    # outside every CSD
+             None]
+
+    left, right = assigner.assign(lines)
+
+    assert left.tolist() == ['100', '200', '100', None, None]
+    assert right.tolist() == ['200', '100', '100', None, None]
+
+
+def test_assign_votes_over_the_samples_of_a_line():
+    # the middle of the line runs through 200, both ends through the two polygons of 100
+    assigner = CsdAssigner(['100', '200', '100'], [shapely.box(0, 0, 100, 100), shapely.box(100, 0, 200, 100),
+                                                   shapely.box(200, 0, 300, 100)])
+
+    left, right = assigner.assign([shapely.LineString([(0, 50), (300, 50)])])
+
+    assert left.tolist() == ['100']
+    assert right.tolist() == ['100']
+
+
+def test_assign_esri_json_lines():
+    assigner = CsdAssigner(['100', '200'], [shapely.box(0, 0, 100, 100), shapely.box(100, 0, 200, 100)])
+
+    left, right = assigner.assign([{'paths': [[[100, 10], [100, 90]]]}, {'paths': []}])
+
+    assert left.tolist() == ['100', None]
+    assert right.tolist() == ['200', None]
+
+
+def test_assign_skips_single_vertex_paths():
+    assigner = CsdAssigner(['100', '200'], [shapely.box(0, 0, 100, 100), shapely.box(100, 0, 200, 100)])
+    shapes = [{'paths': [[[50, 50]]]},                                 # nothing but a single vertex
+              {'paths': [[[150, 50]], [[100, 10], [100, 90]]]},        # a single vertex path next to a line
+              {'paths': [[[100, 10], [100, 90]]]}]
+
+    left, right = assigner.assign(shapes)
+
+    assert left.tolist() == [None, '100', '100']
+    assert right.tolist() == [None, '200', '200']
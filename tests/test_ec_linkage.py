@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from ec_linkage import LinkageIndex
+
+
+def links(*rows):
+    return pd.DataFrame(rows, columns=['NGD_STR_UID_L', 'NGD_STR_UID_R', 'EC_STR_ID_L', 'EC_STR_ID_R'])
+
+
+def test_resolve_missing_links():
+    index = LinkageIndex().update(links((10, 20, 110, 120),
+                                        (30, 40, np.nan, 140),     # no EC street on the left
+                                        (50, np.nan, 150, 999)))   # no street on the right
+
+    resolved = index.resolve([30, 10, 99, None, np.nan, 50, 5], '_L')
+
+    assert resolved.dtype == 'Int64'
+    assert resolved.tolist() == [pd.NA, 110, pd.NA, pd.NA, pd.NA, 150, pd.NA]
+    assert index.resolve([40, 20, 50], '_R').tolist() == [140, 120, pd.NA]
+
+
+def test_resolve_against_an_empty_index():
+    assert LinkageIndex().resolve([1, 2], '_L').tolist() == [pd.NA, pd.NA]
+    assert LinkageIndex().update(links((1, 2, 3, 4))).resolve([], '_L').tolist() == []
+
+
+def test_first_link_of_a_street_wins():
+    index = LinkageIndex().update(links((10, 20, 110, 120), (10, 20, 111, 121)))
+    index.update(links((10, 30, 112, 130)))
+
+    assert index.resolve([10], '_L').tolist() == [110]
+    assert index.resolve([20, 30], '_R').tolist() == [120, 130]
+    assert len(index) == 3
+
+
+def test_saved_index_resolves_the_same(tmp_path):
+    index = LinkageIndex(version='stage-1').update(links((10, 20, 110, 120), ('30', 40, '130', np.nan)))
+    path = str(tmp_path / 'linkage.npz')
+    index.save(path)
+
+    loaded = LinkageIndex.load(path)
+
+    assert loaded.version == 'stage-1'
+    assert loaded.resolve(['10', 30, 40], '_L').tolist() == [110, 130, pd.NA]
+    assert loaded.resolve([20, 40], '_R').tolist() == [120, pd.NA]
@@ -0,0 +1,112 @@
+import math
+
+import numpy as np
+import pytest
+
+import geometry_engine
+from geometry_engine import coordinate_buffer, max_displacement, path_lengths, polyline_lengths
+
+
+def esri(*paths):
+    return {'paths': [list(map(list, path)) for path in paths], 'spatialReference': {'wkid': 3347}}
+
+
+def test_polyline_lengths_of_esri_paths():
+    shapes = [esri([(0, 0), (3, 4)]),
+              esri([(0, 0), (1, 0), (1, 1)]),
+              # the jump between the paths of a multipart line isn't part of its length
+              esri([(0, 0), (2, 0)], [(10, 10), (10, 13)])]
+
+    assert polyline_lengths(shapes).tolist() == [5.0, 2.0, 5.0]
+
+
+def test_polyline_lengths_of_nulls():
+    lengths = polyline_lengths([None, esri([(0, 0), (0, 2)]), {}, esri()])
+
+    assert np.isnan(lengths[0])
+    assert lengths[1] == 2.0
+    assert np.isnan(lengths[2])
+    assert np.isnan(lengths[3])
+
+
+def test_polyline_lengths_fall_back_to_length_property():
+    class Curve(dict):
+        # a true curve has no 'paths', only the length the geometry reports itself
+        length = 7.5
+
+    assert polyline_lengths([Curve(curvePaths=[]), esri([(0, 0), (1, 0)])]).tolist() == [7.5, 1.0]
+
+
+def test_single_vertex_path_has_no_length():
+    coords, offsets, _ = coordinate_buffer([esri([(5, 5)], [(0, 0), (0, 1)])])
+
+    assert path_lengths(coords, offsets).tolist() == [0.0, 1.0]
+
+
+def test_polyline_lengths_of_shapely_lines():
+    shapely = pytest.importorskip('shapely')
+    shapes = [shapely.LineString([(0, 0), (3, 4)]),
+              None,
+              shapely.MultiLineString([[(0, 0), (2, 0)], [(10, 10), (10, 13)]])]
+
+    lengths = polyline_lengths(shapes)
+
+    assert lengths[0] == 5.0
+    assert math.isnan(lengths[1])
+    assert lengths[2] == 5.0
+
+
+def test_max_displacement_of_moved_line():
+    # same length, shifted 3 units sideways
+    assert max_displacement([esri([(0, 0), (10, 0)])], [esri([(0, 3), (10, 3)])]).tolist() == [3.0]
+
+
+def test_max_displacement_is_symmetric():
+    # the extra vertex of the reshaped line is 4 units from the original, the original is within 4 units of it
+    straight = esri([(0, 0), (10, 0)])
+    bent = esri([(0, 0), (5, 4), (10, 0)])
+
+    assert max_displacement([straight], [bent]).tolist() == max_displacement([bent], [straight]).tolist() == [4.0]
+
+
+def test_max_displacement_measures_to_segments_not_vertices():
+    # the vertices of the short line lie on the long one, away from its vertices
+    assert max_displacement([esri([(2, 0), (8, 0)])], [esri([(0, 0), (10, 0)])]).tolist() == [2.0]
+
+
+def test_max_displacement_of_nulls_and_single_vertices():
+    displacement = max_displacement([None, esri([(0, 0), (4, 0)]), esri([(1, 1)])],
+                                    [esri([(0, 0), (1, 0)]), None, esri([(1, 4)])])
+
+    assert np.isnan(displacement[0])
+    assert np.isnan(displacement[1])
+    assert displacement[2] == 3.0
+
+
+def test_max_displacement_pairs_in_chunks(monkeypatch):
+    rng = np.random.default_rng(0)
+    lines_a = [esri(rng.uniform(0, 100, (rng.integers(2, 6), 2))) for _ in range(50)]
+    lines_b = [esri(rng.uniform(0, 100, (rng.integers(2, 6), 2))) for _ in range(50)]
+    expected = max_displacement(lines_a, lines_b)
+
+    # a chunk smaller than the segments of one line still measures every vertex
+    monkeypatch.setattr(geometry_engine, 'PAIR_CHUNK', 3)
+
+    assert max_displacement(lines_a, lines_b) == pytest.approx(expected)
+
+
+def test_esri_and_shapely_agree():
+    shapely = pytest.importorskip('shapely')
+    rng = np.random.default_rng(1)
+    paths_a = [rng.uniform(0, 100, (rng.integers(2, 8), 2)) for _ in range(40)]
+    paths_b = [rng.uniform(0, 100, (rng.integers(2, 8), 2)) for _ in range(40)]
+    esri_a = [esri(path) for path in paths_a]
+    shapely_a = [shapely.LineString(path) for path in paths_a]
+    shapely_b = [shapely.LineString(path) for path in paths_b]
+
+    assert polyline_lengths(esri_a) == pytest.approx(polyline_lengths(shapely_a))
+    # the redline holds Esri JSON and the NGD_AL shapely lines, which pair up the same either way
+    displacement = max_displacement(esri_a, shapely_b)
+    assert displacement == pytest.approx(max_displacement(shapely_a, shapely_b))
+    # and matches the discrete Hausdorff distance of GEOS, which also measures vertices against segments
+    assert displacement == pytest.approx([shapely.hausdorff_distance(a, b) for a, b in zip(shapely_a, shapely_b)])
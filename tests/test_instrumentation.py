@@ -0,0 +1,41 @@
+import threading
+
+from instrumentation import Metrics
+
+
+def test_threads_nest_their_own_stages():
+    run = Metrics('test')
+    started = threading.Barrier(2)
+
+    def load(name):
+        with run.stage(name):
+            # both outer stages are open before either inner one starts
+            started.wait()
+            with run.stage('read'):
+                pass
+
+    workers = [threading.Thread(target=load, args=(name,)) for name in ('linkage', 'street')]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert sorted(record['path'] for record in run.records) == ['linkage', 'linkage/read', 'street', 'street/read']
+
+
+def test_only_main_thread_stages_own_their_peak():
+    run = Metrics('test')
+
+    def load():
+        with run.stage('background'):
+            pass
+
+    with run.stage('main'):
+        worker = threading.Thread(target=load)
+        worker.start()
+        worker.join()
+
+    scopes = {record['path']: record['peak_scope'] for record in run.records}
+    # the background stage has no parent on its own thread and never resets the peak
+    assert scopes['background'] == 'process'
+    assert scopes['main'] == ('stage' if run._resettable else 'process')
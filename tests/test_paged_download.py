@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+import paged_download
+from featureserver_stub import FeatureServerStub, make_features
+from paged_download import MANIFEST_NAME, download_pages, page_path, read_staged_features
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(paged_download.time, 'sleep', lambda seconds: None)
+
+
+def test_pages_split_on_objectids(tmp_path):
+    with FeatureServerStub(make_features(25)) as server:
+        manifest = download_pages(server.url, '1=1', str(tmp_path), page_size=10, workers=2)
+
+    assert manifest['oid_field'] == 'OBJECTID'
+    assert [len(page) for page in manifest['pages']] == [10, 10, 5]
+    assert sorted(server.feature_requests()) == manifest['pages']
+    featureset = read_staged_features(str(tmp_path))
+    assert [f['attributes']['OBJECTID'] for f in featureset['features']] == list(range(1, 26))
+    assert featureset['geometryType'] == 'esriGeometryPoint'
+    assert featureset['spatialReference'] == {'wkid': 3347}
+
+
+def test_no_matches_stages_no_pages(tmp_path):
+    with FeatureServerStub([]) as server:
+        manifest = download_pages(server.url, '1=1', str(tmp_path), page_size=10)
+
+    assert manifest['pages'] == []
+    assert read_staged_features(str(tmp_path))['features'] == []
+
+
+def test_pages_fetched_concurrently(tmp_path):
+    with FeatureServerStub(make_features(80), delay=0.05) as server:
+        download_pages(server.url, '1=1', str(tmp_path), page_size=10, workers=4)
+
+    assert len(server.feature_requests()) == 8
+    assert 1 < server.max_in_flight <= 4
+
+
+def test_failed_page_retried(tmp_path, no_retry_delay):
+    with FeatureServerStub(make_features(30), fail_pages={11: 2}) as server:
+        download_pages(server.url, '1=1', str(tmp_path), page_size=10)
+
+    assert [page[0] for page in server.feature_requests()].count(11) == 3
+    assert len(read_staged_features(str(tmp_path))['features']) == 30
+
+
+def test_resume_after_failure(tmp_path, no_retry_delay):
+    staging_dir = str(tmp_path)
+    # the second page fails more often than it is retried, so the first run stops with it missing
+    with FeatureServerStub(make_features(30), fail_pages={11: 10}) as server:
+        with pytest.raises(RuntimeError, match='Injected failure'):
+            download_pages(server.url, '1=1', staging_dir, page_size=10)
+        assert os.path.exists(page_path(staging_dir, 0))
+        assert os.path.exists(page_path(staging_dir, 2))
+        assert not os.path.exists(page_path(staging_dir, 1))
+
+        server.fail_pages.clear()
+        server.requests.clear()
+        download_pages(server.url, '1=1', staging_dir, page_size=10)
+
+    # the rerun reuses the plan and only asks for the missing page
+    assert server.feature_requests() == [list(range(11, 21))]
+    assert not any(params.get('returnIdsOnly') for params in server.requests)
+    assert len(read_staged_features(staging_dir)['features']) == 30
+
+
+def test_changed_query_replans(tmp_path):
+    staging_dir = str(tmp_path)
+    with FeatureServerStub(make_features(30)) as server:
+        download_pages(server.url, '1=1', staging_dir, page_size=10)
+        download_pages(server.url, '1=1', staging_dir, page_size=15)
+
+    with open(os.path.join(staging_dir, MANIFEST_NAME)) as f:
+        assert json.load(f)['page_size'] == 15
+    assert len(read_staged_features(staging_dir)['features']) == 30
+    assert not os.path.exists(page_path(staging_dir, 2))
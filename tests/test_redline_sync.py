@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+from redline_sync import drop_seen, load_checkpoint, merge_latest, save_checkpoint, sync_end
+
+
+def records(*rows):
+    return pd.DataFrame(rows, columns=['OBJECTID', 'NGD_UID', 'GlobalID', 'EditDate', 'AFL_VAL']).astype(
+        {'EditDate': 'datetime64[ns]'})
+
+
+def values(merged):
+    return sorted(merged['AFL_VAL'].tolist())
+
+
+def test_merge_latest_edit_wins():
+    store = records((1, 100, 'a', '2020-01-01 10:00:00', 1), (2, 200, 'b', '2020-01-02 10:00:00', 2))
+    downloaded = records((3, 100, 'c', '2020-01-03 10:00:00', 3), (4, 200, 'd', '2020-01-01 10:00:00', 4))
+
+    merged = merge_latest(store, downloaded)
+
+    assert len(merged) == 2
+    assert values(merged) == [2, 3]
+
+
+def test_merge_latest_tie_goes_to_the_download():
+    store = records((1, 100, 'a', '2020-01-01 10:00:00', 1))
+    downloaded = records((2, 100, 'b', '2020-01-01 10:00:00', 2))
+
+    assert values(merge_latest(store, downloaded)) == [2]
+
+
+def test_merge_latest_tie_within_the_download_keeps_the_first_read():
+    downloaded = records((1, 100, 'a', '2020-01-01 10:00:00', 1), (2, 100, 'b', '2020-01-01 10:00:00', 2))
+
+    assert values(merge_latest(records(), downloaded)) == [1]
+
+
+def test_merge_latest_matches_new_geometries_on_globalid():
+    store = records((1, np.nan, 'a', '2020-01-01 10:00:00', 1), (2, np.nan, 'b', '2020-01-01 10:00:00', 2))
+    downloaded = records((1, np.nan, 'a', '2020-01-01 10:00:00', 3), (3, np.nan, 'c', '2020-01-02 10:00:00', 4))
+
+    merged = merge_latest(store, downloaded)
+
+    assert merged.sort_values('GlobalID')['AFL_VAL'].tolist() == [3, 2, 4]
+
+
+def test_checkpoint_follows_window_and_edits(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    downloaded = records((7, 100, 'a', '2020-01-01 10:00:00', 1), (9, 200, 'b', '2020-01-01 10:00:00', 2),
+                         (8, 300, 'c', '2020-01-01 09:00:00', 3))
+
+    first = save_checkpoint(path, downloaded)
+    assert first == {'edit_date': pd.Timestamp('2020-01-01 10:00:00'), 'objectid': 9}
+    assert load_checkpoint(path) == first
+
+    # an empty window still moves the checkpoint to its end
+    second = save_checkpoint(path, None, first, window_end=pd.Timestamp('2020-01-02'))
+    assert second == {'edit_date': pd.Timestamp('2020-01-02'), 'objectid': -1}
+    # and it never moves back
+    assert save_checkpoint(path, downloaded, second, window_end=pd.Timestamp('2020-01-01 12:00:00')) is second
+    assert load_checkpoint(path) == second
+
+
+def test_drop_seen_keeps_later_edits_of_the_checkpoint_second():
+    checkpoint = {'edit_date': pd.Timestamp('2020-01-01 10:00:00'), 'objectid': 8}
+    downloaded = records((7, 100, 'a', '2020-01-01 10:00:00', 1), (9, 200, 'b', '2020-01-01 10:00:00', 2),
+                         (3, 300, 'c', '2020-01-01 10:00:01', 3))
+
+    assert values(drop_seen(downloaded, checkpoint)) == [2, 3]
+
+
+def test_sync_end_lags_behind_now():
+    now = pd.Timestamp('2020-01-01 10:00:00.750').to_pydatetime()
+
+    assert sync_end(300, now) == pd.Timestamp('2020-01-01 09:55:00')
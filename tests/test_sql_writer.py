@@ -0,0 +1,52 @@
+from sql_writer import SqlWriter
+
+
+def statements(path):
+    with open(path) as sql:
+        return [line.rstrip(';') for line in sql.read().splitlines()]
+
+
+def guard(date_field):
+    return (f"({date_field} < to_date('2020-03-13', 'YYYY-MM-DD')) OR ({date_field} IS NULL) OR "
+            f"({date_field} > (SELECT sysdate - 30/24/60 from dual))")
+
+
+def test_statements_written_as_they_come(tmp_path):
+    path = tmp_path / 'updates.sql'
+    with SqlWriter(path, 'NGD.NGD_AL', 'NGD_UID', '2020-03-13') as writer:
+        writer.update(1, [('AFL_VAL', 10), ('AFL_DTE', 'sysdate')], 'AFL_DTE')
+        writer.update(1, [('AFL_SRC', "'NGD'"), ('AFL_DTE', 'sysdate')], 'AFL_DTE')
+        # streamed, not held until the writer closes
+        assert writer.count == 2
+
+    assert statements(path) == [
+        f"UPDATE NGD.NGD_AL SET AFL_VAL=10, AFL_DTE=sysdate WHERE NGD_UID=1 AND ({guard('AFL_DTE')})",
+        f"UPDATE NGD.NGD_AL SET AFL_SRC='NGD', AFL_DTE=sysdate WHERE NGD_UID=1 AND ({guard('AFL_DTE')})"]
+
+
+def test_coalesce_merges_updates_of_a_record(tmp_path):
+    path = tmp_path / 'updates.sql'
+    with SqlWriter(path, 'NGD.NGD_AL', 'NGD_UID', '2020-03-13', coalesce=True) as writer:
+        writer.update(1, [('AFL_VAL', 10), ('AFL_DTE', 'sysdate')], 'AFL_DTE')
+        writer.update(2, [('ADDR_TYP_L', "'C'"), ('ATTRBT_DTE', 'sysdate')], 'ATTRBT_DTE')
+        writer.update(1, [('AFL_SRC', "'NGD'"), ('AFL_DTE', 'sysdate')], 'AFL_DTE')
+        # a later value of a field replaces the earlier one
+        writer.update(1, [('AFL_VAL', 12)], 'AFL_DTE')
+        # a different date guard on the same record is a statement of its own
+        writer.update(1, [('ADDR_TYP_L', "'C'")], 'ATTRBT_DTE')
+        assert writer.count == 0
+
+    assert writer.count == 3
+    assert statements(path) == [
+        f"UPDATE NGD.NGD_AL SET AFL_VAL=12, AFL_DTE=sysdate, AFL_SRC='NGD' WHERE NGD_UID=1 AND ({guard('AFL_DTE')})",
+        f"UPDATE NGD.NGD_AL SET ADDR_TYP_L='C', ATTRBT_DTE=sysdate WHERE NGD_UID=2 AND ({guard('ATTRBT_DTE')})",
+        f"UPDATE NGD.NGD_AL SET ADDR_TYP_L='C' WHERE NGD_UID=1 AND ({guard('ATTRBT_DTE')})"]
+
+
+def test_close_twice(tmp_path):
+    writer = SqlWriter(tmp_path / 'updates.sql', 'NGD.NGD_AL', 'NGD_UID', '2020-03-13', coalesce=True)
+    writer.update(1, [('AFL_VAL', 10)], 'AFL_DTE')
+    writer.close()
+    writer.close()
+
+    assert writer.count == 1
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from street_denormalize import ARC_KEY, denormalize_chunk, denormalize_chunks, street_lookup
+
+
+def street_table():
+    return pd.DataFrame({'NGD_STR_UID': [10, 20, 10],
+                         'STR_NME': ['MAIN', 'KING', 'DUPLICATE'],
+                         'STR_TYP': ['ST', 'AVE', 'RD'],
+                         'STR_DIR': [None, 'N', None],
+                         'NAME_SRC': ['NGD', 'NGD', 'NGD']})
+
+
+def arcs():
+    # a chunk that doesn't start at row 0, like every chunk but the first
+    return pd.DataFrame({'NGD_UID': [1001, 1002, 1003],
+                         'NGD_STR_UID_L': [10, 20, 99],
+                         'ALIAS1_STR_UID_L': [20, np.nan, np.nan],
+                         'ALIAS2_STR_UID_L': [np.nan, np.nan, np.nan]}, index=[5, 6, 7])
+
+
+def test_denormalize_chunk_keeps_the_arc_key():
+    out = denormalize_chunk(arcs(), street_lookup(street_table()))
+
+    assert out[ARC_KEY].tolist() == [1001, 1002, 1003]
+    # the first NGD_STREET record of a UID wins, unknown and null UIDs get nulls
+    assert out['STR_NME'].tolist() == ['MAIN', 'KING', pd.NA]
+    assert out['ALIAS1_STR_NME'].tolist() == ['KING', pd.NA, pd.NA]
+    assert out['ALIAS2_STR_NME'].isna().all()
+
+
+def test_denormalized_file_joins_back_to_the_ngdal(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'joined.parquet')
+
+    rows = denormalize_chunks([arcs().iloc[:2], arcs().iloc[2:]], street_table(), path, workers=1)
+
+    joined = arcs().merge(pd.read_parquet(path), on=[ARC_KEY, 'NGD_STR_UID_L'])
+    assert rows == 3
+    assert joined[ARC_KEY].tolist() == [1001, 1002, 1003]
+    assert joined['STR_TYP'].tolist() == ['ST', 'AVE', pd.NA]